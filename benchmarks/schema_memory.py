@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+"""Memory use of the result tables with and without the compact dtypes.
+
+Each TSV file (e.g. 'all_interactions.miRNA.tsv' or the miRNA-target
+database) is read with all columns as strings, as the tables used to be
+held, with the default dtypes of pandas, and with the dtypes of `Schema`.
+The rows could be repeated to get closer to the size of a real run.
+
+    python benchmarks/schema_memory.py \\
+        examples/circRNAs.gencode_format.all_interactions.miRNA.head_20.tsv -n 1000
+"""
+
+import click
+import pandas as pd
+from circmimi.schema import Schema
+
+
+def read_table(tsv_file, num_copies, dtype=None):
+    df = pd.read_csv(tsv_file, sep='\t', dtype=dtype)
+    return pd.concat([df] * num_copies, ignore_index=True)
+
+
+def get_memory_usages(tsv_file, num_copies):
+    object_df = read_table(tsv_file, num_copies, dtype='object')
+    default_df = read_table(tsv_file, num_copies)
+    schema_df = default_df.pipe(Schema.apply)
+
+    return {
+        'rows': len(schema_df),
+        'object': Schema.get_memory_usage(object_df),
+        'default': Schema.get_memory_usage(default_df),
+        'schema': Schema.get_memory_usage(schema_df),
+        'converted': sorted(Schema.get_dtypes(default_df))
+    }
+
+
+@click.command()
+@click.argument('tsv_files', nargs=-1, required=True)
+@click.option('-n', '--num-copies', default=1, show_default=True,
+              help='Repeat the rows of each table N times.')
+def cli(tsv_files, num_copies):
+    click.echo('\t'.join(['table', 'rows', 'object', 'default', 'schema', 'saved']))
+
+    for tsv_file in tsv_files:
+        usages = get_memory_usages(tsv_file, num_copies)
+
+        click.echo('\t'.join(map(str, [
+            tsv_file,
+            usages['rows'],
+            usages['object'],
+            usages['default'],
+            usages['schema'],
+            '{:.0%}'.format(1 - usages['schema'] / usages['object'])
+        ])))
+        click.echo('  converted: {}'.format(', '.join(usages['converted'])), err=True)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,9 +1,12 @@
+import numpy as np
 import pandas as pd
 import io
 import subprocess as sp
 import tempfile as tp
 from collections import namedtuple
+from itertools import chain
 from operator import itemgetter
+from circmimi import trace
 
 
 class Bed:
@@ -169,15 +172,136 @@ class BedUtils:
         if regions_df.empty:
             bed_df = pd.DataFrame([], columns=Bed.BED_TITLE)
         else:
-            bed_df = regions_df.apply(cls._to_bed, union=union, axis=1)
-            bed_df.columns = Bed.BED_TITLE
+            bed_df = regions_df.pipe(
+                cls.explode_regions
+            ).pipe(
+                cls.blocks_to_bed_df,
+                union=union
+            ).set_axis(
+                regions_df.index
+            )
 
         return bed_df
 
+    @staticmethod
+    def explode_regions(regions_df):
+        num_regions = regions_df['regions'].str.len().values
+
+        blocks_df = pd.DataFrame(
+            list(chain.from_iterable(regions_df['regions'])),
+            columns=['chr', 'start', 'end', 'strand']
+        )
+        blocks_df.insert(
+            0,
+            'regions_id',
+            np.repeat(regions_df['regions_id'].values, num_regions)
+        )
+
+        return blocks_df
+
     @classmethod
-    def _to_bed(cls, s, union=False):
-        bed = Bed(s.regions, name=s.regions_id, union=union)
-        return pd.Series(bed.get_data(all_fields=True))
+    def blocks_to_bed_df(cls, blocks_df, union=False):
+        """
+        Build one BED12 entry for each regions_id from the exploded
+        (regions_id, chr, start, end, strand) table, with 1-based starts.
+        The blocks of an entry are kept in the given order, and reversed
+        on the minus strand, unless `union` is set, in which case the
+        overlapping blocks are merged and sorted by position.
+        """
+        if blocks_df.empty:
+            return pd.DataFrame([], columns=Bed.BED_TITLE)
+
+        codes, names = pd.factorize(blocks_df['regions_id'])
+        chrs = blocks_df['chr'].values
+        strands = blocks_df['strand'].values
+        starts = blocks_df['start'].values.astype(np.int64) - 1
+        ends = blocks_df['end'].values.astype(np.int64)
+
+        num_beds = len(names)
+        first_idx = np.full(num_beds, len(codes))
+        np.minimum.at(first_idx, codes, np.arange(len(codes)))
+        bed_chrs = chrs[first_idx]
+        bed_strands = strands[first_idx]
+
+        assert (strands == bed_strands[codes]).all(), \
+            "Not all regions at the same strand!"
+
+        if union:
+            assert (chrs == bed_chrs[codes]).all(), \
+                "Not all regions in the same chromosome!"
+
+            codes, starts, ends = cls._get_union_blocks(codes, starts, ends)
+        else:
+            codes, starts, ends = cls._sort_blocks(
+                codes,
+                starts,
+                ends,
+                reverse=(bed_strands == '-')[codes]
+            )
+
+        # the blocks are sorted by entry here
+        block_offsets = np.r_[0, np.flatnonzero(np.diff(codes)) + 1]
+        bed_starts = np.minimum.reduceat(starts, block_offsets)
+        bed_ends = np.maximum.reduceat(ends, block_offsets)
+
+        bed_df = pd.DataFrame({
+            'chr': bed_chrs,
+            'start': bed_starts,
+            'end': bed_ends,
+            'name': names,
+            'score': '.',
+            'strand': bed_strands,
+            'thickStart': bed_starts,
+            'thickEnd': bed_ends,
+            'itemRGB': 0,
+            'blockCount': np.diff(np.r_[block_offsets, len(codes)]),
+            'blockSizes': cls._join_by_group(ends - starts, codes),
+            'blockStarts': cls._join_by_group(starts - bed_starts[codes], codes)
+        })
+
+        return bed_df
+
+    @staticmethod
+    def _sort_blocks(codes, starts, ends, reverse):
+        order_in_entry = np.arange(len(codes))
+        order_in_entry[reverse] *= -1
+
+        order = np.lexsort((order_in_entry, codes))
+
+        return codes[order], starts[order], ends[order]
+
+    @staticmethod
+    def _get_union_blocks(codes, starts, ends):
+        order = np.lexsort((starts, codes))
+        codes = codes[order]
+        starts = starts[order]
+        ends = ends[order]
+
+        max_ends = pd.Series(ends).groupby(codes).cummax().values
+
+        # a block starts a new union region if it begins after the end of
+        # all the previous blocks of the same entry
+        is_new_region = np.ones(len(codes), dtype=bool)
+        is_new_region[1:] = (codes[1:] != codes[:-1]) | (max_ends[:-1] <= starts[1:])
+
+        region_offsets = np.flatnonzero(is_new_region)
+
+        return (
+            codes[region_offsets],
+            starts[region_offsets],
+            np.maximum.reduceat(ends, region_offsets)
+        )
+
+    @staticmethod
+    def _join_by_group(values, codes, sep=','):
+        return pd.Series(
+            values.astype(str)
+        ).groupby(
+            codes,
+            sort=False
+        ).agg(
+            sep.join
+        ).values
 
 
 class IntersectBED:
@@ -214,6 +338,11 @@ class IntersectBED:
 
         cmd = self._generate_cmd(bed_tmp_file_1.name, bed_tmp_file_2.name)
 
-        with sp.Popen(cmd, stdout=sp.PIPE, encoding='utf-8') as p:
+        with trace.TracedPopen(
+            cmd,
+            inputs=[bed_tmp_file_1.name, bed_tmp_file_2.name],
+            stdout=sp.PIPE,
+            encoding='utf-8'
+        ) as p:
             for line in p.stdout:
                 yield line.rstrip('\n').split('\t')
@@ -1,9 +1,9 @@
 import io
 import pandas as pd
-import subprocess as sp
 import tempfile as tp
 from functools import partial
 from collections import deque
+from circmimi import trace
 
 
 class Blat:
@@ -17,7 +17,7 @@ class Blat:
     def _run(self, ref_file, fa_file):
         with tp.NamedTemporaryFile(dir=self.work_dir) as tmp_out:
             cmd = self._generate_cmd(ref_file, fa_file, tmp_out.name)
-            sp.run(cmd)
+            trace.run(cmd, inputs=[ref_file, fa_file], outputs=[tmp_out.name])
 
             result = BlatPsl(tmp_out.read().decode('utf-8'))
             return result
@@ -5,6 +5,7 @@ import numpy as np
 from collections import Counter, defaultdict
 from circmimi.annotation import Annotator
 from circmimi.ambiguous import AmbiguousChecker
+from circmimi.schema import Schema
 
 
 class CircEvents:
@@ -50,7 +51,12 @@ class CircEvents:
                 'pos2': 'int',
                 'strand': 'category'
             }
-        ).rename_axis('ev_id')
+        ).rename_axis(
+            'ev_id'
+        ).pipe(
+            Schema.apply,
+            columns=['pos1', 'pos2']
+        )
 
         return df
 
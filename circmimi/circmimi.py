@@ -1,17 +1,36 @@
+import gc
 import logging
+import numpy as np
 import pandas as pd
 from circmimi.circ import CircEvents
 from circmimi.bed import BedUtils
 from circmimi.seq import Seq
 from circmimi.miranda import get_binding_sites, MirandaUtils
-from circmimi.rbp import PosMap, RBPBindingSites, RBPBindingSitesFilters
-from circmimi.stats import do_the_hypergeometric_test
+from circmimi.exon_sites import get_exon_level_binding_sites
+from circmimi.rbp import PosMapArray, RBPBindingSites, RBPBindingSitesFilters
+from circmimi.stats import do_the_hypergeometric_test, MiRNATargetBackground
+from circmimi.mir_target import MirTargetDBCache
+from circmimi.output import InteractionJoiner, SQLiteInteractionJoiner, write_table
+from circmimi.schema import Schema
+from circmimi.stage_stats import StageStats
+from circmimi.utils import get_memory_usage, format_size
 
 
 logger = logging.getLogger(__name__)
 
 
 class Circmimi:
+    # the columns of miranda_df used after mapping the binding sites
+    MIRANDA_DF_COLUMNS = (
+        'query_id',
+        'score',
+        'cross_boundary',
+        'ev_id',
+        'aln_id',
+        'genomic_regions',
+        'genomic_regions_id'
+    )
+
     def __init__(self,
                  anno_db_file,
                  ref_file,
@@ -24,7 +43,15 @@ class Circmimi:
                  work_dir='.',
                  num_proc=1,
                  pv_filter=True,
-                 miranda_options=None):
+                 miranda_options=None,
+                 miranda_run_options=None,
+                 engine='miranda',
+                 exon_level=False,
+                 binding_sites_file=None,
+                 mir_target_stats_file=None,
+                 normalized_output=False,
+                 lean=False,
+                 join_backend='pandas'):
 
         self.anno_db_file = anno_db_file
         self.ref_file = ref_file
@@ -38,6 +65,14 @@ class Circmimi:
         self.num_proc = num_proc
         self.pv_filter = pv_filter
         self.miranda_options = miranda_options
+        self.miranda_run_options = miranda_run_options
+        self.engine = engine
+        self.exon_level = exon_level
+        self.binding_sites_file = binding_sites_file
+        self.mir_target_stats_file = mir_target_stats_file
+        self.normalized_output = normalized_output
+        self.lean = lean
+        self.join_backend = join_backend
 
         self.circ_events = None
         self.uniq_exons_df = None
@@ -45,8 +80,12 @@ class Circmimi:
         self.seq_df = None
         self.miranda_df = None
         self.grouped_res_df = None
+        self.res_df = None
+        self.interaction_joiner = None
+        self.stats = StageStats()
 
         self.mir_target_db = get_mir_target_db(self.mir_target_file)
+        self.mir_target_background = self._load_mir_target_background()
 
         if self.AGO_binding_file:
             self.AGO_binding_sites = RBPBindingSites(self.AGO_binding_file)
@@ -54,38 +93,90 @@ class Circmimi:
         else:
             self.check_AGO_support = False
 
-        # if self.RBP_binding_file:
-        #     self.RBP_binding_sites = RBPBindingSites(self.RBP_binding_file)
-        #     self.do_circRNA_RBP = True
-        # else:
-        #     self.do_circRNA_RBP = False
-
-        # if self.RBP_target_file:
-        #     self.RBP_target_db = pd.read_csv(
-        #         self.RBP_target_file,
-        #         sep='\t',
-        #         dtype='object'
-        #     )
-        #     self.do_RBP_mRNA = True
-        # else:
-        #     self.do_RBP_mRNA = False
-        self.do_circRNA_RBP = False
-        self.do_RBP_mRNA = False
+        if self.RBP_binding_file:
+            self.RBP_binding_sites = RBPBindingSites(self.RBP_binding_file)
+            self.do_circRNA_RBP = True
+        else:
+            self.do_circRNA_RBP = False
+
+        if self.do_circRNA_RBP and self.RBP_target_file:
+            self.RBP_target_db = pd.read_csv(
+                self.RBP_target_file,
+                sep='\t',
+                dtype='object'
+            ).astype(
+                {
+                    'RBP': 'category'
+                }
+            )
+            self.do_RBP_mRNA = True
+        else:
+            self.do_RBP_mRNA = False
+
+    def _load_mir_target_background(self):
+        if self.mir_target_stats_file is None:
+            return None
+
+        background = MiRNATargetBackground.load(self.mir_target_stats_file)
+        meta = MiRNATargetBackground.get_meta(
+            self.mir_ref_file,
+            self.mir_target_file
+        )
+
+        if not background.is_compatible(meta):
+            logger.warning(
+                'The precomputed miRNA-target statistics are not compatible '
+                'with the current references, they will not be used.'
+            )
+            return None
+
+        return background
+
+    def _release(self, *attr_names):
+        if not self.lean:
+            return
+
+        for attr_name in attr_names:
+            setattr(self, attr_name, None)
+
+        gc.collect()
+
+    def _log_memory(self, stage):
+        if not self.lean:
+            return
+
+        rss, peak_rss = get_memory_usage()
+        logger.info(
+            'memory after {}: RSS {}, peak RSS {}'.format(
+                stage,
+                format_size(rss),
+                format_size(peak_rss)
+            )
+        )
 
     def _init_results(self):
         res_df_columns = ['ev_id'] + list(CircEvents.INPUT_COLUMNS)
         self.res_df = pd.DataFrame([], columns=res_df_columns)
+        self.circ_mirna_res_df = pd.DataFrame([], columns=res_df_columns + ['mirna'])
         self.circ_target_df_with_pv = pd.DataFrame([])
+        self.RBP_res_df = pd.DataFrame([], columns=res_df_columns)
 
 
     def run(self, circ_file):
+        stage = self.stats.start('annotation')
+
         logger.info('loading circRNAs')
         self.circ_events = CircEvents(circ_file)
+        stage.rows_in = len(self.circ_events.original_df)
 
         logger.info('checking gene annotation for these circRNAs')
         self.circ_events.check_annotation(self.anno_db_file)
 
+        self.stats.stop(stage, rows_out=len(self.circ_events.clear_df))
+
         if self.other_ref_file is not None:
+            stage = self.stats.start('ambiguity', rows_in=len(self.circ_events.clear_df))
+
             logger.info('checking ambiguous alignments')
             self.circ_events.check_ambiguous(
                 self.anno_db_file,
@@ -95,6 +186,8 @@ class Circmimi:
                 num_proc=self.num_proc
             )
 
+            self.stats.stop(stage, rows_out=len(self.circ_events.clear_df))
+
         logger.info('getting all possible isoforms of these circRNAs')
 
         if self.circ_events.clear_df.empty:
@@ -102,34 +195,62 @@ class Circmimi:
             self._init_results()
             return
 
+        stage = self.stats.start('sequence', rows_in=len(self.circ_events.clear_df))
+
         self.uniq_exons_df = self.circ_events.clear_anno_df.pipe(
             self._get_uniq_exons
         )
         self.uniq_exons_regions_df = self.uniq_exons_df.pipe(
             BedUtils.to_regions_df
         )
-        self.bed_df = self.uniq_exons_regions_df.pipe(
-            BedUtils.to_bed_df
-        )
+        self.pos_map_db = PosMapArray(self.uniq_exons_regions_df)
 
-        self.seq_df = self.bed_df.pipe(
-            Seq.get_extended_seq,
-            ref_file=self.ref_file
-        )
+        if not self.exon_level:
+            self.bed_df = self.uniq_exons_regions_df.pipe(
+                BedUtils.to_bed_df
+            )
 
-        self.pos_map_db = {
-            regions_id: PosMap(regions)
-            for regions_id, regions in self.uniq_exons_regions_df.values
-        }
+            self.seq_df = self.bed_df.pipe(
+                Seq.get_extended_seq,
+                ref_file=self.ref_file
+            )
+
+            self.stats.stop(stage, rows_out=len(self.seq_df))
+        else:
+            self.stats.stop(stage, rows_out=len(self.uniq_exons_regions_df))
 
         # miRNAs part
+        stage = self.stats.start('miRNA_binding_sites', rows_in=stage.rows_out)
+
         logger.info('predicting miRNA-binding sites on circRNAs')
-        self.miranda_df = self.seq_df.pipe(
-            get_binding_sites,
-            mir_ref_file=self.mir_ref_file,
-            work_dir=self.work_dir,
-            num_proc=self.num_proc,
-            miranda_options=self.miranda_options
+        if self.exon_level:
+            self.miranda_df = self.uniq_exons_regions_df.pipe(
+                get_exon_level_binding_sites,
+                ref_file=self.ref_file,
+                mir_ref_file=self.mir_ref_file,
+                work_dir=self.work_dir,
+                num_proc=self.num_proc,
+                miranda_options=self.miranda_options,
+                engine=self.engine,
+                binding_sites_file=self.binding_sites_file,
+                miranda_run_options=self.miranda_run_options
+            )
+        else:
+            self.miranda_df = self.seq_df.pipe(
+                get_binding_sites,
+                mir_ref_file=self.mir_ref_file,
+                work_dir=self.work_dir,
+                num_proc=self.num_proc,
+                miranda_options=self.miranda_options,
+                engine=self.engine,
+                miranda_run_options=self.miranda_run_options
+            )
+
+        self._release('bed_df', 'seq_df')
+        self._log_memory('predicting miRNA-binding sites')
+
+        self.miranda_df = self.miranda_df.pipe(
+            Schema.apply
         ).pipe(
             MirandaUtils.append_exons_len,
             exons_len_df=self.uniq_exons_df[['exons_id', 'total_len']]
@@ -141,13 +262,7 @@ class Circmimi:
             MirandaUtils.append_ev_id,
             exons_ev_id_df=self.uniq_exons_df[['exons_id', 'ev_id']]
         ).pipe(
-            MirandaUtils.append_merged_aln
-        ).pipe(
-            MirandaUtils.generate_uniq_id,
-            column_name='aln'
-        ).drop(
-            'aln',
-            axis=1
+            MirandaUtils.append_aln_id
         ).pipe(
             MirandaUtils.get_genomic_position,
             pos_map_db=self.pos_map_db
@@ -156,8 +271,17 @@ class Circmimi:
             column_name='genomic_regions'
         )
 
+        if self.lean:
+            self.miranda_df = self.miranda_df[list(self.MIRANDA_DF_COLUMNS)]
+
+        self._release('pos_map_db')
+        self._log_memory('mapping miRNA-binding sites to the genome')
+        self.stats.stop(stage, rows_out=len(self.miranda_df))
+
         # AGO overlap
         if self.check_AGO_support:
+            stage = self.stats.start('AGO_overlap', rows_in=len(self.miranda_df))
+
             logger.info('filtering AGO-supported miRNA-binding sites')
             logger.debug('getting miRNA_binding_sites_bed')
             self.miRNA_binding_sites_bed = self.miranda_df[[
@@ -205,7 +329,7 @@ class Circmimi:
             ).reset_index(
             ).astype(
                 {
-                    'AGO_support': 'object'
+                    'genomic_regions_id': self.miranda_df['genomic_regions_id'].dtype
                 }
             )
 
@@ -218,109 +342,84 @@ class Circmimi:
                 {
                     'AGO_support': 0
                 }
+            ).astype(
+                {
+                    'AGO_support': np.int32
+                }
             ).assign(
-                AGO_support_yn=lambda df: (df['AGO_support'] > 0).apply(int)
+                AGO_support_yn=lambda df: (df['AGO_support'] > 0).astype(np.int8)
+            )
+
+            stage.rows_out = len(self.AGO_overlap_count)
+
+            self._release(
+                'miRNA_binding_sites_bed',
+                'AGO_overlap_raw_data',
+                'AGO_overlap',
+                'AGO_overlap_count'
             )
+            self._log_memory('checking AGO support')
+            self.stats.stop(stage, rows_out=stage.rows_out)
+
+        stage = self.stats.start('grouping', rows_in=len(self.miranda_df))
 
         logger.debug('grouping results (miranda_df)')
         self.grouped_res_df = MirandaUtils.get_grouped_results(
             self.miranda_df,
             with_AGO=self.check_AGO_support
         )
+        self._release('miranda_df')
+        self._log_memory('grouping miRNA-binding sites')
+        self.stats.stop(stage, rows_out=len(self.grouped_res_df))
 
         # RBP part
         if self.do_circRNA_RBP:
+            stage = self.stats.start('RBP_overlap', rows_in=len(self.uniq_exons_regions_df))
+
             logger.info('predicting RBP-binding sites on circRNAs')
             self.union_bed_df = self.uniq_exons_regions_df.pipe(
                 BedUtils.to_bed_df,
                 union=True
             )
 
-            self.RBP_overlap_raw_data = self.RBP_binding_sites.overlap(
-                self.union_bed_df
-            )
-            self.RBP_overlap = self.RBP_overlap_raw_data.pipe(
-                RBPBindingSitesFilters.RBP_overlap_filter
-            ).merge(
-                self.uniq_exons_df[['exons_id', 'ev_id']],
-                left_on='name',
-                right_on='exons_id',
-                how='left'
-            ).drop(
-                'exons_id',
-                axis=1
-            )
-            self.RBP_overlap_count = self.RBP_overlap[[
-                'ev_id',
-                'RBP',
-                'chr_rbp',
-                'start_rbp',
-                'end_rbp',
-                'strand_rbp',
-                'sample_id'
-            ]].drop_duplicates(
-            ).groupby(
-                [
-                    'ev_id',
-                    'RBP',
-                    'chr_rbp',
-                    'start_rbp',
-                    'end_rbp',
-                    'strand_rbp'
-                ]
-            ).agg(
-                {
-                    'sample_id': 'nunique'
-                }
-            ).reset_index(
-            ).assign(
-                count=1
-            ).groupby(
-                [
-                    'ev_id',
-                    'RBP'
-                ]
-            ).agg(
-                {
-                    'sample_id': 'max',
-                    'count': 'sum'
-                }
-            ).reset_index(
-            ).rename(
-                {
-                    'sample_id': 'MaxRbpExpNum',
-                    'count': 'num_RBP_binding_sites'
-                },
-                axis=1
+            self.RBP_overlap_count = self.union_bed_df.pipe(
+                self._get_RBP_overlap_count
             )
+            self._release('union_bed_df')
+            self._log_memory('predicting RBP-binding sites')
+            self.stats.stop(stage, rows_out=len(self.RBP_overlap_count))
+
+        self._release('uniq_exons_df', 'uniq_exons_regions_df')
 
         # final result table
+        stage = self.stats.start('final_merge', rows_in=len(self.grouped_res_df))
+
         logger.info('getting final results')
-        logger.debug('getting res_df')
-        self.res_df = self.circ_events.clear_df.pipe(
+        logger.debug('getting circ_mirna_res_df')
+        self.circ_mirna_res_df = self.circ_events.clear_df.pipe(
             debug_log,
             msg='merging res_df'
         ).merge(
             self.grouped_res_df,
             on='ev_id',
             how='inner'
+        ).astype(
+            {
+                'mirna': self.mir_target_db['mirna'].dtype
+            }
         ).pipe(
-            debug_log,
-            msg='merging mir_target'
-        ).merge(
-            self.mir_target_db,
-            on='mirna',
-            how='inner'
+            lambda df: df[df['mirna'].notna()]
         ).sort_values(
             [
                 'ev_id',
-                'mirna',
-                'target_gene'
+                'mirna'
             ]
-        ).reset_index(drop=True)
-
-        self.category_df = self.res_df.pipe(self._get_category_df, to_binary=True)
-        self.res_df = pd.concat([self.res_df, self.category_df], axis=1)
+        ).reset_index(
+            drop=True
+        ).pipe(
+            Schema.apply
+        )
+        self._release('grouped_res_df')
 
         if self.do_circRNA_RBP:
             logger.debug('getting RBP_res_df')
@@ -336,106 +435,92 @@ class Circmimi:
 
             if self.do_RBP_mRNA:
                 logger.debug('merging RBP_target')
-                self.RBP_res_df = self.RBP_res_df.merge(
+                self.RBP_res_df = self.RBP_res_df.astype(
+                    {
+                        'RBP': self.RBP_target_db['RBP'].dtype
+                    }
+                ).merge(
                     self.RBP_target_db,
                     on='RBP',
                     how='inner'
                 )
+            self._release('RBP_overlap_count')
         else:
             self.RBP_res_df = None
 
+        self._log_memory('getting final results')
+        self.stats.stop(stage, rows_out=len(self.circ_mirna_res_df))
+
         # calculate P-value
         logger.info('calculating the P-values for the interactions of circRNAs and target genes')
-        self.circ_mir_target_df = self.res_df[['circ_id', 'mirna', 'target_gene']].drop_duplicates().reset_index(drop=True)
+        self.circ_mirna_df = self.circ_mirna_res_df[[
+            'circ_id',
+            'mirna'
+        ]].drop_duplicates().reset_index(drop=True)
+        stage = self.stats.start('p_values', rows_in=len(self.circ_mirna_df))
+
         self.circ_target_df_with_pv = do_the_hypergeometric_test(
-            self.circ_mir_target_df,
+            self.circ_mirna_df,
             self.mir_ref_file,
-            self.mir_target_db
-        )
-        self.res_df = self.res_df.merge(
-            self.circ_target_df_with_pv[[
-                'circ_id',
-                'target_gene',
-                'p_value',
-                'bh_corrected_p_value',
-                'bonferroni_corrected_p_values',
-            ]],
-            on=['circ_id', 'target_gene'],
-            how='left'
+            self.mir_target_db,
+            background=self.mir_target_background
+        ).astype(
+            {
+                'circ_id': self.circ_mirna_res_df['circ_id'].dtype,
+                'target_gene': self.mir_target_db['target_gene'].dtype
+            }
         )
+        self._release('circ_mirna_df')
+        self._log_memory('calculating the P-values')
+        self.stats.stop(stage, rows_out=len(self.circ_target_df_with_pv))
+
+        # stream the interactions chunk by chunk instead of keeping res_df
+        stream_results = self.normalized_output or (self.join_backend == 'sqlite')
+        num_circ_mirna = len(self.circ_mirna_res_df)
+
+        if self.join_backend == 'sqlite':
+            self.interaction_joiner = SQLiteInteractionJoiner(
+                self.circ_mirna_res_df,
+                self.mir_target_db,
+                self.circ_target_df_with_pv,
+                pv_filter=self.pv_filter,
+                chunk_size=100000,
+                work_dir=self.work_dir
+            )
 
-        # only retain interactions with 'bh_corrected_p_value < 0.05'
-        if self.pv_filter:
-            self.res_df = self.res_df[self.res_df['bh_corrected_p_value'] < 0.05]
+            # the tables are only kept in the database of the joiner
+            self.circ_mirna_res_df = None
+            self.mir_target_db = None
+            self.circ_target_df_with_pv = None
+            gc.collect()
+            self._log_memory('spilling the results')
+        else:
+            self.interaction_joiner = InteractionJoiner(
+                self.circ_mirna_res_df,
+                self.mir_target_db,
+                self.circ_target_df_with_pv,
+                pv_filter=self.pv_filter,
+                chunk_size=(100000 if stream_results else None)
+            )
 
         # submit summary
+        stage = self.stats.start('summary', rows_in=num_circ_mirna)
+
         logger.info('generating summary')
-        circ_miRNA_count = self.res_df[['ev_id', 'mirna']].drop_duplicates().rename(
-            {
-                'mirna': '#circRNA_miRNA'
-            },
-            axis=1
-        ).groupby(
-            'ev_id'
-        ).agg(
-            'count'
-        ).pipe(
-            self.circ_events.expand_to_all_events,
-            fillna_value=0
-        ).astype('int')
-        self.circ_events.submit_to_summary(circ_miRNA_count, type_='summary')
+        if stream_results:
+            summary_counts = self._get_streamed_summary_counts(self.interaction_joiner)
+        else:
+            logger.debug('getting res_df')
+            self.res_df = self.interaction_joiner.join(self.circ_mirna_res_df)
+            summary_counts = self._get_summary_counts(self.res_df)
 
-        circ_mRNA_count = self.res_df[['ev_id', 'target_gene']].drop_duplicates().rename(
-            {
-                'target_gene': '#circRNA_mRNA'
-            },
-            axis=1
-        ).groupby(
-            'ev_id'
-        ).agg(
-            'count'
-        ).pipe(
-            self.circ_events.expand_to_all_events,
-            fillna_value=0
-        ).astype('int')
-        self.circ_events.submit_to_summary(circ_mRNA_count, type_='summary')
+        stage.rows_out = int(summary_counts['#circRNA_miRNA_mRNA'].sum())
 
-        total_count = self.res_df[['ev_id', 'mirna', 'target_gene']].drop_duplicates().assign(
-            circRNA_miRNA_mRNA=1
-        ).drop(
-            ['mirna', 'target_gene'],
-            axis=1
-        ).groupby(
-            'ev_id'
-        ).agg(
-            'count'
-        ).pipe(
+        summary_counts = summary_counts.pipe(
             self.circ_events.expand_to_all_events,
             fillna_value=0
-        ).astype('int').rename(
-            {
-                'circRNA_miRNA_mRNA': '#circRNA_miRNA_mRNA'
-            },
-            axis=1
-        )
-        self.circ_events.submit_to_summary(total_count, type_='summary')
-
-        category_count = self.res_df[['ev_id', 'category_1', 'category_2', 'category_3']].groupby(
-            'ev_id'
-        ).agg(
-            'sum'
-        ).pipe(
-            self.circ_events.expand_to_all_events,
-            fillna_value=0
-        ).astype('int').rename(
-            {
-                'category_1': '#category_1',
-                'category_2': '#category_2',
-                'category_3': '#category_3',
-            },
-            axis=1
-        )
-        self.circ_events.submit_to_summary(category_count, type_='summary')
+        ).astype('int')
+        self.circ_events.submit_to_summary(summary_counts, type_='summary')
 
         if self.do_circRNA_RBP:
             circ_RBP_count = self.RBP_res_df[['ev_id', 'RBP']].drop_duplicates().rename(
@@ -489,14 +574,193 @@ class Circmimi:
                 )
                 self.circ_events.submit_to_summary(circ_RBP_mRNA_count, type_='summary')
 
-    def save_result(self, out_file):
-        self.res_df.drop('ev_id', axis=1).to_csv(out_file, sep='\t', index=False)
+        self._log_memory('generating summary')
+        self.stats.stop(stage, rows_out=stage.rows_out)
 
-    def save_RBP_result(self, out_file):
-        self.RBP_res_df.drop('ev_id', axis=1).to_csv(out_file, sep='\t', index=False)
+    def _get_RBP_overlap_count(self, union_bed_df):
+        exons_ev_id_df = self.uniq_exons_df[['exons_id', 'ev_id']]
 
-    def save_circRNAs_summary(self, out_file):
-        self.circ_events.get_summary().to_csv(out_file, sep='\t', index=False)
+        all_chr_counts = [
+            chr_overlap_df.pipe(
+                RBPBindingSitesFilters.RBP_overlap_filter
+            ).merge(
+                exons_ev_id_df,
+                left_on='name',
+                right_on='exons_id',
+                how='left'
+            ).pipe(
+                self._count_RBP_binding_sites
+            )
+            for chr_overlap_df in self.RBP_binding_sites.overlap_by_chr(union_bed_df)
+        ]
+
+        if not all_chr_counts:
+            return pd.DataFrame(
+                [],
+                columns=['ev_id', 'RBP', 'MaxRbpExpNum', 'num_RBP_binding_sites']
+            )
+
+        # each binding site lies on a single chromosome, so the per-chromosome
+        # counts only have to be combined by (ev_id, RBP)
+        RBP_overlap_count = pd.concat(
+            all_chr_counts
+        ).groupby(
+            [
+                'ev_id',
+                'RBP'
+            ]
+        ).agg(
+            {
+                'MaxRbpExpNum': 'max',
+                'num_RBP_binding_sites': 'sum'
+            }
+        ).reset_index()
+
+        return RBP_overlap_count
+
+    @staticmethod
+    def _count_RBP_binding_sites(RBP_overlap):
+        RBP_overlap_count = RBP_overlap[[
+            'ev_id',
+            'RBP',
+            'chr_rbp',
+            'start_rbp',
+            'end_rbp',
+            'strand_rbp',
+            'sample_id'
+        ]].drop_duplicates(
+        ).groupby(
+            [
+                'ev_id',
+                'RBP',
+                'chr_rbp',
+                'start_rbp',
+                'end_rbp',
+                'strand_rbp'
+            ]
+        ).agg(
+            {
+                'sample_id': 'nunique'
+            }
+        ).reset_index(
+        ).assign(
+            count=1
+        ).groupby(
+            [
+                'ev_id',
+                'RBP'
+            ]
+        ).agg(
+            {
+                'sample_id': 'max',
+                'count': 'sum'
+            }
+        ).reset_index(
+        ).rename(
+            {
+                'sample_id': 'MaxRbpExpNum',
+                'count': 'num_RBP_binding_sites'
+            },
+            axis=1
+        )
+
+        return RBP_overlap_count
+
+    @staticmethod
+    def _get_summary_counts(res_df):
+        is_uniq_interaction = ~res_df.duplicated(['ev_id', 'mirna', 'target_gene'])
+
+        summary_counts = res_df.assign(
+            is_uniq_interaction=is_uniq_interaction
+        ).groupby(
+            'ev_id',
+            observed=True
+        ).agg(**{
+            '#circRNA_miRNA': ('mirna', 'nunique'),
+            '#circRNA_mRNA': ('target_gene', 'nunique'),
+            '#circRNA_miRNA_mRNA': ('is_uniq_interaction', 'sum'),
+            '#category_1': ('category_1', 'sum'),
+            '#category_2': ('category_2', 'sum'),
+            '#category_3': ('category_3', 'sum')
+        })
+
+        return summary_counts
+
+    @classmethod
+    def _get_streamed_summary_counts(cls, interaction_joiner):
+        summary_counts = [
+            cls._get_summary_counts(res_df)
+            for res_df in interaction_joiner
+        ]
+
+        # no chunk is yielded if there is no circRNA-miRNA hit
+        if not summary_counts:
+            summary_counts = [
+                cls._get_summary_counts(interaction_joiner.get_empty_result())
+            ]
+
+        return pd.concat(summary_counts)
+
+    def _is_spilled(self):
+        return isinstance(self.interaction_joiner, SQLiteInteractionJoiner)
+
+    def save_result(self, out_file, format_='tsv'):
+        if self.res_df is not None:
+            write_table(self.res_df.drop('ev_id', axis=1), out_file, format_=format_)
+        else:
+            self.interaction_joiner.write(out_file, format_=format_)
+
+    def save_normalized_results(self, circ_mirna_file, mir_target_file, format_='tsv'):
+        if self._is_spilled():
+            self.interaction_joiner.write_spilled_table(
+                'circ_mirna',
+                circ_mirna_file,
+                format_=format_,
+                drop_columns=('ev_id',)
+            )
+            self.interaction_joiner.write_spilled_table(
+                'mir_target',
+                mir_target_file,
+                format_=format_,
+                where='mirna IN (SELECT mirna FROM circ_mirna)',
+                order_by=('mirna', 'target_gene', 'rid')
+            )
+            return
+
+        write_table(
+            self.circ_mirna_res_df.drop('ev_id', axis=1),
+            circ_mirna_file,
+            format_=format_
+        )
+
+        write_table(
+            self.mir_target_db[
+                self.mir_target_db['mirna'].isin(self.circ_mirna_res_df['mirna'].unique())
+            ].sort_values(
+                [
+                    'mirna',
+                    'target_gene'
+                ]
+            ),
+            mir_target_file,
+            format_=format_
+        )
+
+    def save_pvalue_result(self, out_file, format_='tsv'):
+        if self._is_spilled():
+            self.interaction_joiner.write_spilled_table('pv', out_file, format_=format_)
+        else:
+            write_table(self.circ_target_df_with_pv, out_file, format_=format_)
+
+    def save_RBP_result(self, out_file, format_='tsv'):
+        write_table(self.RBP_res_df.drop('ev_id', axis=1), out_file, format_=format_)
+
+    def save_circRNAs_summary(self, out_file, format_='tsv'):
+        write_table(self.circ_events.get_summary(), out_file, format_=format_)
+
+    def close(self):
+        if self.interaction_joiner is not None:
+            self.interaction_joiner.close()
 
     @staticmethod
     def _get_total_length(list_of_obj):
@@ -526,44 +790,9 @@ class Circmimi:
 
         return uniq_exons_df
 
-    @staticmethod
-    def _get_category_df(res_df, to_binary=False):
-        def get_category(AGO, MTB, MDB, ECR):
-            if AGO:
-                if MTB or ECR:
-                    return '1'
-                else:
-                    return '2'
-            else:
-                if MTB or ECR:
-                    return '2'
-                else:
-                    return '3'
-
-        category_df = res_df.assign(
-            AGO=res_df['num_AGO_supported_binding_sites'] > 0,
-            MTB=res_df['miRTarBase'] == '1',
-            MDB=res_df['miRDB'] == '1',
-            ECR=res_df['ENCORI'] == '1'
-        )[['AGO', 'MTB', 'MDB', 'ECR']].assign(
-            category=lambda df: df.apply(lambda s: get_category(*s), axis=1)
-        )[['category']]
-
-        if to_binary:
-            category_df = category_df.assign(
-                category_1=(category_df['category'] == '1').apply(int),
-                category_2=(category_df['category'] == '2').apply(int),
-                category_3=(category_df['category'] == '3').apply(int)
-            ).drop(
-                'category',
-                axis=1
-            )
-
-        return category_df
-
 
 def get_mir_target_db(mir_tar_db_path):
-    db = pd.read_csv(mir_tar_db_path, sep='\t', dtype='object')
+    db = MirTargetDBCache.load(mir_tar_db_path).db.pipe(Schema.apply)
 
     assert list(db.columns[:2]) == ['mirna', 'target_gene'], \
         ("The column names of the first two columns"
@@ -0,0 +1,455 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+from circmimi.bed import BedUtils
+from circmimi.seq import Seq
+from circmimi.miranda import Miranda, get_engine, predict_uniq_seqs
+
+
+logger = logging.getLogger(__name__)
+
+
+class ExonLevelScan:
+    """Scan units of the exon-level prediction of miRNA-binding sites.
+
+    Instead of the whole extended sequence of every isoform, the binding
+    sites are predicted on the unique exons and on the windows around each
+    exon-exon (and back-splice) junction of the isoforms. Every position of
+    an isoform is owned by exactly one unit, which contains `site_span` of
+    flanking sequence around the sites starting there. With the seed
+    engine, whose sites have a fixed length, the assembled sites are the
+    same as those found on the whole sequence. With miRanda,
+    `site_span` is only an estimate, so the sites are the same as long as
+    an alignment does not span more than the longest miRNA plus 10 bases
+    and is not affected by the sequence beyond 10 more bases.
+
+    Isoforms not longer than two windows are scanned as a whole.
+    """
+
+    EXT_LEN = 30
+    UNIT_TITLE = ('unit_id', 'reference_id', 'offset', 'own_start', 'own_end')
+
+    def __init__(self, regions_df, ref_file, site_span, exon_sites_index=None):
+        self.max_site_len, self.flank_len = site_span
+        self.padding = self.max_site_len + 2 * self.flank_len
+
+        self.exons_df = self._get_exons_df(regions_df)
+        self.exon_seqs = self._get_exon_seqs(self.exons_df, ref_file)
+
+        self.seq_df, self.units_df = self._get_units(regions_df)
+
+        if exon_sites_index is None:
+            self.indexed_sites_df = pd.DataFrame(
+                [],
+                columns=Miranda.RESULT_TITLE
+            ).astype(Miranda.RESULT_DTYPES)
+        else:
+            indexed_exons_df = self.exons_df[
+                exon_sites_index.has_exons(self.exons_df['region'])
+            ]
+            self.indexed_sites_df = exon_sites_index.get_sites(
+                indexed_exons_df['exon_id'],
+                indexed_exons_df['region']
+            )
+
+            # the sites on these exons are not needed to be predicted again
+            self.seq_df = self.seq_df[
+                ~self.seq_df['name'].isin(indexed_exons_df['exon_id'])
+            ].reset_index(
+                drop=True
+            )
+
+    @staticmethod
+    def _get_exons_df(regions_df):
+        exons_df = regions_df['regions'].explode().apply(
+            tuple
+        ).drop_duplicates(
+        ).to_frame(
+            'region'
+        ).reset_index(
+            drop=True
+        ).assign(
+            exon_id=lambda df: 'exon_' + df.index.astype(str)
+        )
+
+        return exons_df
+
+    @staticmethod
+    def _get_exon_seqs(exons_df, ref_file):
+        exons_bed_df = pd.DataFrame({
+            'regions_id': exons_df['exon_id'],
+            'regions': exons_df['region'].apply(lambda region: [region])
+        }).pipe(
+            BedUtils.to_bed_df
+        )
+
+        exon_seqs = dict(Seq.get_seq(exons_bed_df, ref_file).values)
+
+        return exon_seqs
+
+    def _get_units(self, regions_df):
+        exon_ids = dict(self.exons_df[['region', 'exon_id']].values)
+
+        all_seqs = [
+            (exon_id, self.exon_seqs[exon_id])
+            for exon_id in self.exons_df['exon_id']
+        ]
+        all_units = []
+
+        for regions_id, regions in regions_df[['regions_id', 'regions']].values:
+            iso_exon_ids = [exon_ids[tuple(region)] for region in regions]
+            iso_seq = ''.join(self.exon_seqs[exon_id] for exon_id in iso_exon_ids)
+            ext_seq = iso_seq + iso_seq[:self.EXT_LEN]
+
+            seqs, units = self._get_isoform_units(
+                regions_id,
+                iso_exon_ids,
+                ext_seq,
+                len(iso_seq)
+            )
+
+            all_seqs.extend(seqs)
+            all_units.extend(units)
+
+        units_df = pd.DataFrame(all_units, columns=self.UNIT_TITLE)
+        seq_df = pd.DataFrame(all_seqs, columns=['name', 'seq']).pipe(
+            lambda df: df[df['name'].isin(units_df['unit_id'])]
+        ).reset_index(
+            drop=True
+        )
+
+        return seq_df, units_df
+
+    def _get_isoform_units(self, regions_id, iso_exon_ids, ext_seq, total_len):
+        if total_len <= 2 * self.padding:
+            full_id = f'{regions_id}_full'
+            return [(full_id, ext_seq)], [(full_id, regions_id, 0, 0, total_len)]
+
+        seqs = []
+        units = []
+
+        # `own_start` is exclusive and `own_end` is inclusive (1-based),
+        # the sites starting in this range are taken from the unit.
+        junction_pos = 0
+        own_start = 0
+        for i, exon_id in enumerate(iso_exon_ids, start=1):
+            exon_start = junction_pos
+            junction_pos += len(self.exon_seqs[exon_id])
+
+            exon_own_end = junction_pos - self.max_site_len - self.flank_len
+            if exon_own_end > own_start:
+                units.append(
+                    (exon_id, regions_id, exon_start, own_start, exon_own_end)
+                )
+
+            window_start = max(junction_pos - self.padding, 0)
+            window_end = min(junction_pos + self.padding, len(ext_seq))
+            window_id = f'{regions_id}_j{i}'
+
+            seqs.append((window_id, ext_seq[window_start:window_end]))
+            units.append((
+                window_id,
+                regions_id,
+                window_start,
+                max(own_start, exon_own_end),
+                min(junction_pos + self.flank_len, total_len)
+            ))
+
+            own_start = junction_pos + self.flank_len
+
+        return seqs, units
+
+    def assemble(self, unit_sites_df):
+        sites_df = pd.concat(
+            [self.indexed_sites_df, unit_sites_df],
+            ignore_index=True
+        ).rename_axis(
+            'hit_order'
+        ).reset_index(
+        ).merge(
+            self.units_df,
+            left_on='reference_id',
+            right_on='unit_id',
+            how='inner',
+            suffixes=('_unit', '')
+        ).assign(
+            ref_start=lambda df: df['ref_start'] + df['offset'],
+            ref_end=lambda df: df['ref_end'] + df['offset']
+        )
+
+        is_owned = (sites_df['own_start'] < sites_df['ref_start']) & \
+            (sites_df['ref_start'] <= sites_df['own_end'])
+
+        ref_order = pd.Index(self.units_df['reference_id'].unique())
+
+        sites_df = sites_df[is_owned].assign(
+            ref_order=lambda df: ref_order.get_indexer(df['reference_id'])
+        ).sort_values(
+            ['ref_order', 'ref_start', 'hit_order']
+        ).reset_index(
+            drop=True
+        ).loc[:, unit_sites_df.columns]
+
+        return sites_df
+
+    @property
+    def num_scanned_bases(self):
+        return int(self.seq_df['seq'].drop_duplicates().str.len().sum())
+
+
+class ExonSitesIndex:
+    """Precomputed miRNA-binding sites of the annotated exons.
+
+    The sites are stored by exon in a compressed npz file, together with
+    the engine, the engine options and the miRNA reference used to
+    predict them, so that the index is only used by compatible runs.
+    """
+
+    STR_COLS = ('query_id', 'aln_mirna', 'aln_map', 'aln_utr')
+    NUM_COLS = (
+        'score',
+        'energy',
+        'query_start',
+        'query_end',
+        'ref_start',
+        'ref_end',
+        'aln_length',
+        'identity',
+        'similarity'
+    )
+
+    def __init__(self, exons_df, sites_df, meta):
+        self.exons_df = exons_df
+        self.sites_df = sites_df
+        self.meta = meta
+
+        self._exons_index = pd.MultiIndex.from_frame(
+            self.exons_df[['chr', 'start', 'end', 'strand']]
+        )
+
+    @staticmethod
+    def get_meta(engine_name, options, mir_ref_file):
+        meta = {
+            'engine': engine_name,
+            'options': ' '.join(options) if options else '',
+            'mir_ref': os.path.basename(mir_ref_file),
+            'mir_ref_size': str(os.path.getsize(mir_ref_file))
+        }
+
+        return meta
+
+    def is_compatible(self, meta):
+        return self.meta == meta
+
+    @classmethod
+    def build(cls,
+              exons_df,
+              ref_file,
+              mir_ref_file,
+              work_dir='.',
+              num_proc=1,
+              miranda_options=None,
+              engine='miranda',
+              miranda_run_options=None):
+
+        engine_class = get_engine(engine)
+        binding_site_engine = engine_class(
+            mir_ref_file,
+            work_dir=work_dir,
+            num_proc=num_proc,
+            options=miranda_options,
+            run_options=miranda_run_options
+        )
+
+        exons_df = exons_df[
+            ['chr', 'start', 'end', 'strand']
+        ].drop_duplicates(
+        ).sort_values(
+            ['chr', 'start', 'end', 'strand']
+        ).reset_index(
+            drop=True
+        ).assign(
+            exon_id=lambda df: 'exon_' + df.index.astype(str)
+        )
+
+        exons_bed_df = pd.DataFrame({
+            'regions_id': exons_df['exon_id'],
+            'regions': [[tuple(exon)] for exon in exons_df.iloc[:, :4].values]
+        }).pipe(
+            BedUtils.to_bed_df
+        )
+
+        exons_seq_df = Seq.get_seq(exons_bed_df, ref_file)
+        sites_df = predict_uniq_seqs(binding_site_engine, exons_seq_df)
+
+        meta = cls.get_meta(
+            binding_site_engine.name,
+            miranda_options,
+            mir_ref_file
+        )
+
+        return cls(exons_df.drop(columns='exon_id'), sites_df, meta)
+
+    def save(self, index_file):
+        exon_codes = pd.Index(
+            'exon_' + self.exons_df.index.astype(str)
+        ).get_indexer(self.sites_df['reference_id'])
+
+        order = np.argsort(exon_codes, kind='stable')
+        sites_df = self.sites_df.iloc[order]
+        exon_codes = exon_codes[order]
+
+        site_offsets = np.searchsorted(
+            exon_codes,
+            np.arange(len(self.exons_df) + 1)
+        )
+
+        chr_codes, chr_names = pd.factorize(self.exons_df['chr'])
+        strand_codes, strand_names = pd.factorize(self.exons_df['strand'])
+
+        arrays = {
+            'exon_chr': chr_codes.astype(np.int32),
+            'chr_names': np.array(chr_names, dtype=str),
+            'exon_start': self.exons_df['start'].values.astype(np.int64),
+            'exon_end': self.exons_df['end'].values.astype(np.int64),
+            'exon_strand': strand_codes.astype(np.int8),
+            'strand_names': np.array(strand_names, dtype=str),
+            'site_offsets': site_offsets.astype(np.int64)
+        }
+
+        for col in self.STR_COLS:
+            codes, values = pd.factorize(sites_df[col])
+            arrays[col] = codes.astype(np.int32)
+            arrays[f'{col}_values'] = np.array(values, dtype=str)
+
+        for col in self.NUM_COLS:
+            arrays[col] = sites_df[col].values
+
+        for key, value in self.meta.items():
+            arrays[f'meta_{key}'] = np.array(value)
+
+        with open(index_file, 'wb') as out:
+            np.savez_compressed(out, **arrays)
+
+    @classmethod
+    def load(cls, index_file):
+        with np.load(index_file) as data:
+            exons_df = pd.DataFrame({
+                'chr': data['chr_names'][data['exon_chr']],
+                'start': data['exon_start'],
+                'end': data['exon_end'],
+                'strand': data['strand_names'][data['exon_strand']]
+            })
+
+            site_offsets = data['site_offsets']
+            exon_codes = np.repeat(
+                np.arange(len(exons_df)),
+                np.diff(site_offsets)
+            )
+
+            sites_data = {'reference_id': exon_codes}
+            for col in cls.STR_COLS:
+                sites_data[col] = data[f'{col}_values'][data[col]]
+
+            for col in cls.NUM_COLS:
+                sites_data[col] = data[col]
+
+            sites_df = pd.DataFrame(
+                sites_data,
+                columns=Miranda.RESULT_TITLE
+            )
+
+            meta = {
+                key[len('meta_'):]: str(data[key])
+                for key in data.files if key.startswith('meta_')
+            }
+
+        return cls(exons_df, sites_df, meta)
+
+    def _get_exon_codes(self, regions):
+        return self._exons_index.get_indexer(
+            [tuple(region) for region in regions]
+        )
+
+    def has_exons(self, regions):
+        return self._get_exon_codes(regions) >= 0
+
+    def get_sites(self, exon_ids, regions):
+        exon_codes = self._get_exon_codes(regions)
+        is_found = (exon_codes >= 0)
+
+        exon_map = pd.Series(
+            np.asarray(exon_ids)[is_found],
+            index=exon_codes[is_found]
+        )
+
+        sites_df = self.sites_df[
+            self.sites_df['reference_id'].isin(exon_map.index)
+        ].assign(
+            reference_id=lambda df: exon_map.loc[df['reference_id']].values
+        ).reset_index(
+            drop=True
+        ).astype(
+            Miranda.RESULT_DTYPES
+        )
+
+        return sites_df
+
+
+def get_exon_level_binding_sites(regions_df,
+                                 ref_file,
+                                 mir_ref_file,
+                                 work_dir='.',
+                                 num_proc=1,
+                                 miranda_options=None,
+                                 engine='miranda',
+                                 binding_sites_file=None,
+                                 miranda_run_options=None):
+
+    engine_class = get_engine(engine)
+    binding_site_engine = engine_class(
+        mir_ref_file,
+        work_dir=work_dir,
+        num_proc=num_proc,
+        options=miranda_options,
+        run_options=miranda_run_options
+    )
+
+    exon_sites_index = None
+    if binding_sites_file is not None:
+        exon_sites_index = ExonSitesIndex.load(binding_sites_file)
+        meta = ExonSitesIndex.get_meta(
+            binding_site_engine.name,
+            miranda_options,
+            mir_ref_file
+        )
+
+        if not exon_sites_index.is_compatible(meta):
+            logger.warning(
+                'The precomputed binding sites are not compatible with '
+                'the current engine or options, they will not be used.'
+            )
+            exon_sites_index = None
+
+    exon_level_scan = ExonLevelScan(
+        regions_df,
+        ref_file,
+        binding_site_engine.site_span,
+        exon_sites_index=exon_sites_index
+    )
+
+    logger.debug(
+        'scanning {} bases for exon-level binding sites'.format(
+            exon_level_scan.num_scanned_bases
+        )
+    )
+
+    unit_sites_df = predict_uniq_seqs(
+        binding_site_engine,
+        exon_level_scan.seq_df
+    )
+
+    miranda_df = exon_level_scan.assemble(unit_sites_df)
+
+    return miranda_df
@@ -0,0 +1,104 @@
+import os
+import numpy as np
+import pandas as pd
+import tempfile as tp
+
+
+class MirTargetDBCache:
+    """Binary copy of the miRNA-target database.
+
+    Every column is dictionary-encoded with sorted categories, so that the
+    table is loaded as categorical columns with small integer codes. The
+    cache is saved next to the TSV file, and rebuilt if the TSV file is
+    changed.
+    """
+
+    CACHE_SUFFIX = '.cache.npz'
+    CACHE_VERSION = 1
+
+    def __init__(self, db):
+        self.db = db
+
+    @staticmethod
+    def _get_source_stat(db_file):
+        stat = os.stat(db_file)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    @staticmethod
+    def _get_codes_dtype(num_categories):
+        for dtype in (np.int8, np.int16, np.int32):
+            if num_categories < np.iinfo(dtype).max:
+                return dtype
+
+        return np.int64
+
+    @classmethod
+    def from_tsv(cls, db_file):
+        db = pd.read_csv(db_file, sep='\t', dtype='object')
+
+        db = pd.DataFrame({
+            col: pd.Categorical.from_codes(*pd.factorize(db[col], sort=True))
+            for col in db.columns
+        })
+
+        return cls(db)
+
+    def save(self, cache_file, source_stat):
+        arrays = {
+            'version': np.array(self.CACHE_VERSION),
+            'source_stat': source_stat,
+            'columns': np.array(self.db.columns, dtype=str)
+        }
+
+        for i, col in enumerate(self.db.columns):
+            categories = self.db[col].cat.categories
+            arrays[f'codes_{i}'] = self.db[col].cat.codes.values.astype(
+                self._get_codes_dtype(len(categories))
+            )
+            arrays[f'categories_{i}'] = np.array(categories, dtype=str)
+
+        with tp.NamedTemporaryFile(
+            dir=os.path.dirname(cache_file),
+            prefix=os.path.basename(cache_file) + '.tmp.',
+            delete=False
+        ) as tmp_file:
+            np.savez_compressed(tmp_file, **arrays)
+
+        os.replace(tmp_file.name, cache_file)
+
+    @classmethod
+    def _read_cache(cls, cache_file, source_stat):
+        try:
+            with np.load(cache_file) as data:
+                if (int(data['version']) != cls.CACHE_VERSION) or \
+                        (not np.array_equal(data['source_stat'], source_stat)):
+                    return None
+
+                db = pd.DataFrame({
+                    col: pd.Categorical.from_codes(
+                        data[f'codes_{i}'],
+                        categories=data[f'categories_{i}'].astype(object)
+                    )
+                    for i, col in enumerate(data['columns'].tolist())
+                })
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return cls(db)
+
+    @classmethod
+    def load(cls, db_file):
+        source_stat = cls._get_source_stat(db_file)
+        cache_file = db_file + cls.CACHE_SUFFIX
+
+        db_cache = cls._read_cache(cache_file, source_stat)
+
+        if db_cache is None:
+            db_cache = cls.from_tsv(db_file)
+
+            try:
+                db_cache.save(cache_file, source_stat)
+            except OSError:
+                pass
+
+        return db_cache
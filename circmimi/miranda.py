@@ -2,13 +2,20 @@ import os
 import shutil
 import subprocess as sp
 import tempfile as tp
-import random
 import re
+import json
+import hashlib
+import logging
+import threading
+import numpy as np
 import pandas as pd
-from itertools import cycle
 from functools import reduce
-from contextlib import contextmanager
-from circmimi.seq import Seq
+from concurrent.futures import ThreadPoolExecutor
+from circmimi import trace
+from circmimi.seq import Seq, parse_fasta
+
+
+logger = logging.getLogger(__name__)
 
 
 class Miranda:
@@ -28,12 +35,29 @@ class Miranda:
         'aln_map',
         'aln_utr'
     )
+    RESULT_DTYPES = {
+        'score': 'float',
+        'energy': 'float',
+        'query_start': 'int',
+        'query_end': 'int',
+        'ref_start': 'int',
+        'ref_end': 'int',
+        'aln_length': 'int',
+        'identity': 'float',
+        'similarity': 'float'
+    }
+
+    MANIFEST = 'manifest.json'
 
     def __init__(self, ref_file, work_dir='.',
-                 bin_path='miranda', options=None):
+                 bin_path='miranda', options=None,
+                 batch_size=100, timeout=None, max_retries=2):
         self.ref_file = ref_file
         self.work_dir = work_dir
         self.bin_path = bin_path
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.max_retries = max_retries
 
         if options:
             self.options = options
@@ -42,6 +66,8 @@ class Miranda:
         self.options += ['-keyval']
         self.options = list(map(str, self.options))
 
+        self._manifest_lock = threading.Lock()
+
     def _generate_cmd(self, seq_file, out_file=None):
         cmd = [self.bin_path, self.ref_file, seq_file] + self.options
 
@@ -50,59 +76,140 @@ class Miranda:
 
         return cmd
 
-    @staticmethod
-    def _rand_id(n=5):
-        return '{{:0>{}}}'.format(n).format(random.randrange(10**n))
-
-    @contextmanager
-    def _split_file(self, seq_file, num):
-        tmp_dir = os.path.join(
+    def _get_batch_dir(self, seq_file):
+        # the same inputs and options always use the same directory, so that
+        # the finished batches could be reused by a rerun, even with another
+        # number of processes.
+        run_hash = hashlib.sha1(str(self.batch_size).encode())
+        for file_ in (self.ref_file, seq_file):
+            with open(file_, 'rb') as f_in:
+                for chunk in iter(lambda: f_in.read(1 << 20), b''):
+                    run_hash.update(chunk)
+        run_hash.update(' '.join([self.bin_path] + self.options).encode())
+
+        return os.path.join(
             self.work_dir,
-            'miranda_tmp_{}'.format(self._rand_id())
+            'miranda_tmp_{}'.format(run_hash.hexdigest()[:12])
         )
-        os.makedirs(tmp_dir)
 
-        filenames = ['seq_file.part{}.fa'.format(i) for i in range(1, num + 1)]
-        file_paths = [os.path.join(tmp_dir, fname) for fname in filenames]
-        tmp_files = [open(path, 'w') for path in file_paths]
-
-        tmp_files_iter = cycle(tmp_files)
-        with open(seq_file) as seq_in:
-            for line in seq_in:
-                if line.startswith('>'):
-                    tmp_f = next(tmp_files_iter)
-                tmp_f.write(line)
+    @staticmethod
+    def _get_batch_file(batch_dir, batch_no):
+        return os.path.join(batch_dir, 'seq_file.part{}.fa'.format(batch_no))
 
-        for tmp_f in tmp_files:
-            tmp_f.close()
+    def _split_file(self, seq_file, batch_dir):
+        # contiguous blocks of `batch_size` sequences, written one batch
+        # after another, so that only one file is open at a time and a batch
+        # always gets the same sequences.
+        file_paths = [self._get_batch_file(batch_dir, 1)]
+        batch_out = open(file_paths[0], 'w')
+        num_seqs = 0
 
         try:
-            yield file_paths
+            with open(seq_file) as seq_in:
+                for line in seq_in:
+                    if line.startswith('>'):
+                        if num_seqs and (num_seqs % self.batch_size == 0):
+                            batch_out.close()
+                            file_paths.append(
+                                self._get_batch_file(batch_dir, len(file_paths) + 1)
+                            )
+                            batch_out = open(file_paths[-1], 'w')
+                        num_seqs += 1
+                    batch_out.write(line)
         finally:
-            shutil.rmtree(tmp_dir)
+            batch_out.close()
+
+        return file_paths
+
+    def _read_manifest(self, batch_dir):
+        manifest_file = os.path.join(batch_dir, self.MANIFEST)
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as json_in:
+                return json.load(json_in)
+        else:
+            return {}
+
+    def _update_manifest(self, batch_dir, manifest, batch_file, status):
+        with self._manifest_lock:
+            manifest[os.path.basename(batch_file)] = status
+
+            manifest_file = os.path.join(batch_dir, self.MANIFEST)
+            with open(manifest_file + '.tmp', 'w') as json_out:
+                json.dump(manifest, json_out, indent=2)
+            os.replace(manifest_file + '.tmp', manifest_file)
+
+    def _run_batch(self, batch_file, batch_dir, manifest):
+        out_file = "{}.result".format(batch_file)
+        tmp_out_file = "{}.tmp".format(out_file)
+
+        if manifest.get(os.path.basename(batch_file), {}).get('status') == 'done' \
+                and os.path.exists(out_file):
+            return out_file
+
+        cmd = self._generate_cmd(batch_file, tmp_out_file)
+
+        for attempt in range(1, self.max_retries + 2):
+            try:
+                res = trace.run(
+                    cmd,
+                    inputs=[self.ref_file, batch_file],
+                    outputs=[tmp_out_file],
+                    stdout=sp.DEVNULL,
+                    timeout=self.timeout
+                )
+                returncode = res.returncode
+            except sp.TimeoutExpired:
+                returncode = 'timeout'
+
+            if returncode == 0:
+                os.replace(tmp_out_file, out_file)
+                self._update_manifest(
+                    batch_dir,
+                    manifest,
+                    batch_file,
+                    {'status': 'done', 'attempts': attempt}
+                )
+                return out_file
+
+            logger.warning('miRanda failed on {} (attempt {}, return code: {})'.format(
+                os.path.basename(batch_file),
+                attempt,
+                returncode
+            ))
+            self._update_manifest(
+                batch_dir,
+                manifest,
+                batch_file,
+                {'status': 'failed', 'attempts': attempt}
+            )
+
+        raise MirandaError(
+            'miRanda failed on {} after {} attempts.'.format(batch_file, attempt)
+        )
 
     def run(self, seq_file, num_proc=1):
-        if num_proc == 1:
-            cmd = self._generate_cmd(seq_file)
-            res = sp.run(cmd, stdout=sp.PIPE, encoding='utf-8')
-            return res.stdout
-        elif num_proc > 1:
-            with self._split_file(seq_file, num=num_proc) as tmp_files:
-                out_files = ["{}.result".format(tmp_f) for tmp_f in tmp_files]
+        batch_dir = self._get_batch_dir(seq_file)
+        os.makedirs(batch_dir, exist_ok=True)
+
+        batch_files = self._split_file(seq_file, batch_dir)
+        manifest = self._read_manifest(batch_dir)
 
-                cmds = [self._generate_cmd(tmp_f, out_f)
-                        for tmp_f, out_f in zip(tmp_files, out_files)]
-                procs = [sp.Popen(cmd) for cmd in cmds]
+        with ThreadPoolExecutor(max_workers=num_proc) as executor:
+            # the other batches are still finished if any batch fails
+            futures = [
+                executor.submit(self._run_batch, batch_file, batch_dir, manifest)
+                for batch_file in batch_files
+            ]
+            out_files = [future.result() for future in futures]
 
-                for p in procs:
-                    p.wait()
+        result = ''
+        for out_f in out_files:
+            with open(out_f) as res_in:
+                result += res_in.read()
 
-                result = ''
-                for out_f in out_files:
-                    with open(out_f) as res_in:
-                        result += res_in.read()
+        shutil.rmtree(batch_dir)
 
-            return result
+        return result
 
     @staticmethod
     def _get_value(res_line):
@@ -115,43 +222,129 @@ class Miranda:
             yield cls._get_value(m.group(1))
 
 
+class MirandaEngine:
+    name = 'miranda'
+
+    def __init__(self, mir_ref_file, work_dir='.', num_proc=1, options=None,
+                 run_options=None):
+        self.mir_ref_file = mir_ref_file
+        self.work_dir = work_dir
+        self.num_proc = num_proc
+
+        if options is None:
+            options = []
+
+        if run_options is None:
+            run_options = {}
+
+        self.miranda = Miranda(
+            mir_ref_file,
+            work_dir=work_dir,
+            options=['-quiet'] + options,
+            **run_options
+        )
+
+        with open(mir_ref_file) as fa_in:
+            max_mir_len = max(
+                (len(seq) for _, seq in parse_fasta(fa_in.read())),
+                default=0
+            )
+
+        # (the longest site on the target, the flanking length which may
+        # still affect the alignment), the alignment could contain gaps.
+        self.site_span = (max_mir_len + 10, 10)
+
+    def predict(self, seq_df):
+        with tp.NamedTemporaryFile(dir=self.work_dir) as tmp_fa_file:
+            with open(tmp_fa_file.name, 'w') as fa_out:
+                fa_txt = Seq.to_fasta(seq_df)
+                fa_out.write(fa_txt)
+
+            raw_result = self.miranda.run(
+                tmp_fa_file.name,
+                num_proc=self.num_proc
+            )
+            miranda_df = pd.DataFrame(
+                Miranda.parse_result(raw_result),
+                columns=Miranda.RESULT_TITLE
+            ).astype(Miranda.RESULT_DTYPES)
+
+            return miranda_df
+
+
+def get_engine(engine):
+    if not isinstance(engine, str):
+        return engine
+
+    if engine == 'miranda':
+        return MirandaEngine
+    elif engine == 'seed':
+        from circmimi.seed import SeedMatcher
+        return SeedMatcher
+    else:
+        raise EngineNotSupportError(engine)
+
+
 def get_binding_sites(seq_df,
                       mir_ref_file,
                       work_dir='.',
                       num_proc=1,
-                      miranda_options=None):
+                      miranda_options=None,
+                      engine='miranda',
+                      miranda_run_options=None):
 
-    if miranda_options is None:
-        miranda_options = []
-
-    miranda = Miranda(
+    engine_class = get_engine(engine)
+    binding_site_engine = engine_class(
         mir_ref_file,
         work_dir=work_dir,
-        options=['-quiet'] + miranda_options
+        num_proc=num_proc,
+        options=miranda_options,
+        run_options=miranda_run_options
     )
 
-    with tp.NamedTemporaryFile(dir=work_dir) as tmp_fa_file:
-        with open(tmp_fa_file.name, 'w') as fa_out:
-            fa_txt = Seq.to_fasta(seq_df)
-            fa_out.write(fa_txt)
-
-        raw_result = miranda.run(tmp_fa_file.name, num_proc=num_proc)
-        miranda_df = pd.DataFrame(
-            Miranda.parse_result(raw_result),
-            columns=Miranda.RESULT_TITLE
-        ).astype({
-            'score': 'float',
-            'energy': 'float',
-            'query_start': 'int',
-            'query_end': 'int',
-            'ref_start': 'int',
-            'ref_end': 'int',
-            'aln_length': 'int',
-            'identity': 'float',
-            'similarity': 'float'
-        })
-
-        return miranda_df
+    miranda_df = predict_uniq_seqs(binding_site_engine, seq_df)
+
+    return miranda_df
+
+
+def predict_uniq_seqs(binding_site_engine, seq_df):
+    # identical sequences are scanned only once
+    uniq_seq_df = seq_df.drop_duplicates('seq')
+    miranda_df = binding_site_engine.predict(uniq_seq_df)
+
+    if len(uniq_seq_df) < len(seq_df):
+        miranda_df = _fan_out_binding_sites(miranda_df, seq_df)
+
+    return miranda_df
+
+
+def _fan_out_binding_sites(miranda_df, seq_df):
+    seq_codes, _ = pd.factorize(seq_df['seq'])
+    _, first_idx = np.unique(seq_codes, return_index=True)
+
+    ref_map = pd.DataFrame({
+        'uniq_reference_id': seq_df['name'].values[first_idx][seq_codes],
+        'ref_order': np.arange(len(seq_df))
+    }, index=seq_df['name'].values)
+
+    all_miranda_df = miranda_df.reset_index(
+        drop=True
+    ).rename_axis(
+        'hit_order'
+    ).reset_index(
+    ).merge(
+        ref_map.rename_axis('reference_id').reset_index(),
+        left_on='reference_id',
+        right_on='uniq_reference_id',
+        how='inner',
+        suffixes=('_uniq', '')
+    ).sort_values(
+        ['ref_order', 'hit_order']
+    ).reset_index(
+        drop=True
+    ).loc[:, miranda_df.columns]
+
+    return all_miranda_df
 
 
 class MirandaUtils:
@@ -170,49 +363,42 @@ class MirandaUtils:
     def remove_redundant_result(cls, miranda_df):
         filtered_df = miranda_df.query('ref_start <= total_len')
 
-        dropped_index = filtered_df.query(
-            'ref_start == 1'
-        ).assign(
-            ext_ref_end=lambda df: df['ref_end'] + df['total_len']
-        ).loc[:, [
-            'query_id',
-            'reference_id',
-            'ext_ref_end'
-        ]].reset_index(
-        ).merge(
-            filtered_df,
-            left_on=['query_id', 'reference_id', 'ext_ref_end'],
-            right_on=['query_id', 'reference_id', 'ref_end'],
-            how='inner'
-        ).loc[:, 'index']
-
-        filtered_df = filtered_df.drop(dropped_index).reset_index(drop=True)
+        # a hit starting at 1 is redundant if the same miRNA also hits the
+        # same target at the same site in the extended part of the sequence.
+        pair_codes = cls._get_pair_codes(
+            filtered_df['query_id'],
+            filtered_df['reference_id']
+        )
+        ref_end = filtered_df['ref_end'].values.astype(np.int64)
+        ext_ref_end = ref_end + filtered_df['total_len'].values.astype(np.int64)
+
+        radix = max(ref_end.max(initial=0), ext_ref_end.max(initial=0)) + 1
+        keys = pair_codes * radix + ref_end
+        ext_keys = pair_codes * radix + ext_ref_end
+
+        is_redundant = (filtered_df['ref_start'].values == 1) & \
+            np.isin(ext_keys, keys)
+
+        filtered_df = filtered_df[~is_redundant].reset_index(drop=True)
 
         return filtered_df
 
     @staticmethod
-    def _is_cross_boundary(s):
-        exons_len = s['total_len']
-        ref_start = s['ref_start']
-        ref_end = s['ref_end']
+    def _get_pair_codes(col_1, col_2):
+        codes_1, uniq_1 = pd.factorize(col_1)
+        codes_2, _ = pd.factorize(col_2)
 
-        if (ref_start <= exons_len) and (exons_len < ref_end):
-            return '1'
-        else:
-            return '0'
+        return codes_2.astype(np.int64) * max(len(uniq_1), 1) + codes_1
 
-    @classmethod
-    def append_cross_boundary(cls, miranda_df_with_len):
-        if miranda_df_with_len.empty:
-            cross_boundary_res = pd.Series()
-        else:
-            cross_boundary_res = miranda_df_with_len.apply(
-                cls._is_cross_boundary,
-                axis=1
-            )
+    @staticmethod
+    def append_cross_boundary(miranda_df_with_len):
+        is_cross_boundary = (
+            (miranda_df_with_len['ref_start'] <= miranda_df_with_len['total_len']) &
+            (miranda_df_with_len['total_len'] < miranda_df_with_len['ref_end'])
+        )
 
         appended_res_df = miranda_df_with_len.assign(
-            cross_boundary=cross_boundary_res
+            cross_boundary=is_cross_boundary.astype(np.int8)
         )
 
         return appended_res_df
@@ -234,34 +420,29 @@ class MirandaUtils:
         return df_with_ev_id
 
     @staticmethod
-    def append_merged_aln(miranda_df):
-        miranda_df_with_merged_aln = miranda_df.assign(
-            aln=lambda df: df['aln_mirna'] + df['aln_map'] + df['aln_utr']
+    def append_aln_id(miranda_df):
+        aln_id = miranda_df.groupby(
+            ['aln_mirna', 'aln_map', 'aln_utr'],
+            sort=False,
+            dropna=False
+        ).ngroup()
+
+        miranda_df_with_aln_id = miranda_df.assign(
+            aln_id=aln_id.astype(np.int32)
+        ).reset_index(
+            drop=True
         )
 
-        return miranda_df_with_merged_aln
+        return miranda_df_with_aln_id
 
-    @classmethod
-    def generate_uniq_id(cls, miranda_df, column_name):
-        all_uniq_items = pd.Series(
-            miranda_df[column_name].unique(),
-            name=column_name
-        ).reset_index(
-        ).astype(
-            {
-                'index': str
-            }
-        ).rename(
-            {
-                'index': f'{column_name}_id'
-            },
-            axis=1
-        )
+    @staticmethod
+    def generate_uniq_id(miranda_df, column_name):
+        codes, _ = pd.factorize(miranda_df[column_name], use_na_sentinel=False)
 
-        miranda_df_with_id = miranda_df.merge(
-            all_uniq_items,
-            on=column_name,
-            how='left'
+        miranda_df_with_id = miranda_df.assign(
+            **{f'{column_name}_id': codes.astype(np.int32)}
+        ).reset_index(
+            drop=True
         )
 
         return miranda_df_with_id
@@ -278,10 +459,13 @@ class MirandaUtils:
                 'AGO_support',
                 'AGO_support_yn'
             ]].drop_duplicates(
-            ).groupby([
-                'ev_id',
-                'query_id'
-            ]).agg({
+            ).groupby(
+                [
+                    'ev_id',
+                    'query_id'
+                ],
+                observed=True
+            ).agg({
                 'score': 'max',
                 'aln_id': 'nunique',
                 'cross_boundary': 'max',
@@ -299,7 +483,6 @@ class MirandaUtils:
                 axis=1
             ).astype(
                 {
-                    'ev_id': 'object',
                     'num_binding_sites': 'Int64',
                     'MaxAgoExpNum': 'Int64',
                     'num_AGO_supported_binding_sites': 'Int64'
@@ -313,10 +496,13 @@ class MirandaUtils:
                 'aln_id',
                 'cross_boundary'
             ]].drop_duplicates(
-            ).groupby([
-                'ev_id',
-                'query_id'
-            ]).agg({
+            ).groupby(
+                [
+                    'ev_id',
+                    'query_id'
+                ],
+                observed=True
+            ).agg({
                 'score': 'max',
                 'aln_id': 'nunique',
                 'cross_boundary': 'max'
@@ -330,7 +516,6 @@ class MirandaUtils:
                 axis=1
             ).astype(
                 {
-                    'ev_id': 'object',
                     'num_binding_sites': 'Int64'
                 }
             )
@@ -339,21 +524,31 @@ class MirandaUtils:
 
     @staticmethod
     def get_genomic_position(miranda_df, pos_map_db):
-        genomic_regions = miranda_df.apply(
-            lambda s: pos_map_db[s['reference_id']].get_real_blocks(
-                s['ref_start'],
-                s['ref_end']
-            ),
-            axis=1
-        )
-
-        if genomic_regions.empty:
+        if miranda_df.empty:
             miranda_df_with_genomic_position = miranda_df.assign(
                 genomic_regions='NA'
             )
         else:
+            blocks_df = pos_map_db.get_real_blocks(
+                miranda_df['reference_id'],
+                miranda_df['ref_start'],
+                miranda_df['ref_end']
+            )
+            genomic_regions = pos_map_db.to_regions(
+                blocks_df,
+                len(miranda_df)
+            )
+
             miranda_df_with_genomic_position = miranda_df.assign(
                 genomic_regions=genomic_regions
             )
 
         return miranda_df_with_genomic_position
+
+
+class EngineNotSupportError(Exception):
+    pass
+
+
+class MirandaError(Exception):
+    pass
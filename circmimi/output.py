@@ -0,0 +1,571 @@
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+import tempfile as tp
+
+
+class InteractionJoiner:
+    """Join the normalized result tables into the rows of the legacy
+    `all_interactions.miRNA.tsv`.
+
+    The circRNA-miRNA table is joined with the miRNA-target table and the
+    circRNA-target P-values one chunk of circRNAs at a time, so that the
+    full circRNA x miRNA x target table is never held in memory.
+    """
+
+    PV_COLUMNS = (
+        'p_value',
+        'bh_corrected_p_value',
+        'bonferroni_corrected_p_values'
+    )
+
+    def __init__(self,
+                 circ_mirna_df,
+                 mir_target_db,
+                 circ_target_df_with_pv,
+                 pv_filter=True,
+                 chunk_size=100000):
+
+        self.circ_mirna_df = circ_mirna_df
+        self.mir_target_db = mir_target_db
+        self.circ_target_df_with_pv = circ_target_df_with_pv[
+            ['circ_id', 'target_gene'] + list(self.PV_COLUMNS)
+        ]
+        self.pv_filter = pv_filter
+        self.chunk_size = chunk_size
+
+    def _get_row_chunk_ids(self):
+        if self.chunk_size is None:
+            return np.zeros(len(self.circ_mirna_df), dtype=np.int64)
+
+        # split on the boundaries of the circRNAs, in the order of ev_id
+        ev_ids, num_rows = np.unique(
+            self.circ_mirna_df['ev_id'].values,
+            return_counts=True
+        )
+        chunk_ids = np.cumsum(num_rows) // self.chunk_size
+        ev_chunk_ids = pd.Series(chunk_ids, index=ev_ids)
+
+        return ev_chunk_ids.loc[self.circ_mirna_df['ev_id'].values].values
+
+    def _get_chunks(self):
+        if self.chunk_size is None:
+            yield self.circ_mirna_df
+            return
+
+        row_chunk_ids = self._get_row_chunk_ids()
+
+        for chunk_id in np.unique(row_chunk_ids):
+            yield self.circ_mirna_df[row_chunk_ids == chunk_id]
+
+    def join(self, circ_mirna_df):
+        res_df = circ_mirna_df.merge(
+            self.mir_target_db,
+            on='mirna',
+            how='inner'
+        ).sort_values(
+            [
+                'ev_id',
+                'mirna',
+                'target_gene'
+            ]
+        ).reset_index(drop=True)
+
+        category_df = res_df.pipe(get_category_df, to_binary=True)
+        res_df = pd.concat([res_df, category_df], axis=1)
+
+        res_df = res_df.merge(
+            self.circ_target_df_with_pv,
+            on=['circ_id', 'target_gene'],
+            how='left'
+        )
+
+        # only retain interactions with 'bh_corrected_p_value < 0.05'
+        if self.pv_filter:
+            res_df = res_df[res_df['bh_corrected_p_value'] < 0.05]
+
+        return res_df
+
+    def __iter__(self):
+        for circ_mirna_df in self._get_chunks():
+            yield self.join(circ_mirna_df)
+
+    def get_empty_result(self):
+        return self.join(self.circ_mirna_df.iloc[:0])
+
+    def write(self, out_file, format_='tsv'):
+        with TableWriter(out_file, format_=format_) as writer:
+            for res_df in self:
+                writer.write(res_df.drop('ev_id', axis=1))
+
+            if writer.is_empty:
+                writer.write(self.get_empty_result().drop('ev_id', axis=1))
+
+    def to_csv(self, out_file):
+        self.write(out_file, format_='tsv')
+
+    def close(self):
+        pass
+
+
+class SQLiteInteractionJoiner(InteractionJoiner):
+    """Out-of-core version of `InteractionJoiner`.
+
+    The three tables are spilled into a SQLite database under `work_dir`,
+    with the strings stored as codes shared by the tables, and the joiner
+    keeps no reference to them, so that they could be released from
+    memory. SQLite does the joins, the P-value filtering and the sorting on
+    disk, and the rows of each chunk of circRNAs (the same chunks as those
+    of `InteractionJoiner`) are read back from the database. The spilled
+    tables could also be written out by `write_spilled_table`.
+    """
+
+    SPILL_SIZE = 100000
+
+    def __init__(self,
+                 circ_mirna_df,
+                 mir_target_db,
+                 circ_target_df_with_pv,
+                 pv_filter=True,
+                 chunk_size=100000,
+                 work_dir='.'):
+
+        super().__init__(
+            circ_mirna_df,
+            mir_target_db,
+            circ_target_df_with_pv,
+            pv_filter=pv_filter,
+            chunk_size=chunk_size
+        )
+        self.work_dir = work_dir
+
+        self._tmp_dir = None
+        self._db_file = None
+        self._categories = {}
+        self._templates = {}
+        self._empty_res_df = self.join(self.circ_mirna_df.iloc[:0])
+
+        self._build_db({
+            'mir_target': mir_target_db,
+            'circ_mirna': circ_mirna_df,
+            'pv': circ_target_df_with_pv
+        })
+
+        self.circ_mirna_df = None
+        self.mir_target_db = None
+        self.circ_target_df_with_pv = None
+
+    @staticmethod
+    def _is_string_column(s):
+        return (s.dtype == object) or isinstance(s.dtype, pd.CategoricalDtype)
+
+    def _set_categories(self, tables):
+        # a column gets the same categories in all tables, so that the codes
+        # could be joined, and sorted as the values are sorted by pandas
+        for df in tables.values():
+            for col in df.columns:
+                if not self._is_string_column(df[col]):
+                    continue
+
+                if isinstance(df[col].dtype, pd.CategoricalDtype):
+                    categories = df[col].cat.categories
+                else:
+                    categories = pd.Index(df[col].dropna().unique()).sort_values()
+
+                if col in self._categories:
+                    known_categories = self._categories[col]
+                    categories = known_categories.append(
+                        categories[~categories.isin(known_categories)]
+                    )
+
+                self._categories[col] = categories
+
+    def _encode(self, df):
+        return df.assign(**{
+            col: pd.Categorical(df[col], categories=self._categories[col]).codes
+            for col in df.columns
+            if self._is_string_column(df[col])
+        })
+
+    def _decode(self, df, dtypes):
+        df = df.assign(**{
+            col: pd.Categorical.from_codes(
+                df[col].values.astype(np.int64),
+                categories=self._categories[col]
+            )
+            for col in df.columns
+            if (col in self._categories) and (col in dtypes)
+        })
+
+        return df[list(dtypes.keys())].astype(dtypes)
+
+    def _connect(self):
+        con = sqlite3.connect(self._db_file)
+        con.execute('PRAGMA journal_mode = OFF')
+        con.execute('PRAGMA synchronous = OFF')
+
+        return con
+
+    def _spill(self, con, table_name, df, **extra_cols):
+        self._templates[table_name] = df.iloc[:0]
+
+        for start in range(0, max(len(df), 1), self.SPILL_SIZE):
+            end = start + self.SPILL_SIZE
+
+            df.iloc[start:end].pipe(
+                self._encode
+            ).assign(
+                rid=np.arange(start, min(end, len(df))),
+                **{col: values[start:end] for col, values in extra_cols.items()}
+            ).to_sql(
+                table_name,
+                con,
+                index=False,
+                if_exists='append'
+            )
+
+    def _build_db(self, tables):
+        self._tmp_dir = tp.TemporaryDirectory(prefix='join.tmp.', dir=self.work_dir)
+        self._db_file = os.path.join(self._tmp_dir.name, 'join.sqlite')
+
+        self._set_categories(tables)
+
+        con = self._connect()
+        try:
+            # circ_mirna_df is sorted by ('ev_id', 'mirna'), so its row
+            # numbers keep that order
+            self._spill(con, 'mir_target', tables['mir_target'])
+            self._spill(
+                con,
+                'circ_mirna',
+                tables['circ_mirna'],
+                chunk_id=self._get_row_chunk_ids()
+            )
+            self._spill(con, 'pv', tables['pv'])
+
+            con.execute('CREATE INDEX circ_mirna_chunk_idx ON circ_mirna (chunk_id)')
+            con.execute('CREATE INDEX mir_target_mirna_idx ON mir_target (mirna)')
+            con.execute('CREATE INDEX pv_key_idx ON pv (circ_id, target_gene)')
+            con.commit()
+        finally:
+            con.close()
+
+    def _get_query(self):
+        mir_target_cols = [
+            col for col in self._templates['mir_target'].columns
+            if col != 'mirna'
+        ]
+
+        query = (
+            'SELECT cm.*, {}, {} '
+            'FROM circ_mirna AS cm '
+            'JOIN mir_target AS mt ON mt.mirna = cm.mirna '
+            'LEFT JOIN pv ON (pv.circ_id = cm.circ_id) AND (pv.target_gene = mt.target_gene) '
+            'WHERE cm.chunk_id = ? '
+        ).format(
+            ', '.join('mt."{}"'.format(col) for col in mir_target_cols),
+            ', '.join('pv."{}"'.format(col) for col in self.PV_COLUMNS)
+        )
+
+        # only retain interactions with 'bh_corrected_p_value < 0.05'
+        if self.pv_filter:
+            query += 'AND pv.bh_corrected_p_value < 0.05 '
+
+        query += 'ORDER BY cm.rid, mt.target_gene'
+
+        return query
+
+    def _get_res_df(self, rows_df):
+        columns_dtypes = {
+            **self._templates['circ_mirna'].dtypes.to_dict(),
+            **self._templates['mir_target'].dtypes.to_dict(),
+            **self._templates['pv'][list(self.PV_COLUMNS)].dtypes.to_dict()
+        }
+
+        res_df = self._decode(rows_df, columns_dtypes)
+        res_df = pd.concat(
+            [res_df, res_df.pipe(get_category_df, to_binary=True)],
+            axis=1
+        )
+
+        # the same columns and dtypes as from the merges of pandas
+        empty_res_df = self.get_empty_result()
+
+        return res_df[empty_res_df.columns].astype(empty_res_df.dtypes.to_dict())
+
+    def get_empty_result(self):
+        return self._empty_res_df
+
+    def __iter__(self):
+        con = self._connect()
+        try:
+            query = self._get_query()
+            chunk_ids = [
+                chunk_id for chunk_id, in con.execute(
+                    'SELECT DISTINCT chunk_id FROM circ_mirna ORDER BY chunk_id'
+                )
+            ]
+
+            for chunk_id in chunk_ids:
+                rows_df = pd.read_sql_query(query, con, params=(int(chunk_id),))
+                yield self._get_res_df(rows_df)
+        finally:
+            con.close()
+
+    def iter_spilled_table(self, table_name, where=None, order_by=('rid',)):
+        query = 'SELECT * FROM {}'.format(table_name)
+        if where is not None:
+            query += ' WHERE {}'.format(where)
+        query += ' ORDER BY {}'.format(', '.join(order_by))
+
+        dtypes = self._templates[table_name].dtypes.to_dict()
+
+        con = self._connect()
+        try:
+            for rows_df in pd.read_sql_query(query, con, chunksize=self.SPILL_SIZE):
+                yield self._decode(rows_df, dtypes)
+        finally:
+            con.close()
+
+    def write_spilled_table(self, table_name, out_file, format_='tsv',
+                            where=None, order_by=('rid',), drop_columns=()):
+        with TableWriter(out_file, format_=format_) as writer:
+            for df in self.iter_spilled_table(table_name, where=where, order_by=order_by):
+                writer.write(df.drop(list(drop_columns), axis=1))
+
+            if writer.is_empty:
+                writer.write(
+                    self._templates[table_name].drop(list(drop_columns), axis=1)
+                )
+
+    def close(self):
+        if self._tmp_dir is not None:
+            self._tmp_dir.cleanup()
+            self._tmp_dir = None
+            self._db_file = None
+
+
+class TableWriter:
+    """Write a table chunk by chunk as TSV, Parquet or Feather.
+
+    For Parquet and Feather (which need pyarrow), the string columns are
+    dictionary-encoded and the other columns keep their types. The
+    dictionaries only grow between the chunks, so the Feather file is
+    written one record batch at a time.
+
+    If there is a 'chr' column, the rows of a Parquet file are buffered by
+    chromosome, and each row group is written with the rows of a single
+    chromosome once it has `ROW_GROUP_SIZE` rows, so that the row groups
+    could be selected by chromosome. The rows of each chromosome keep their
+    order, but the file is no longer in the order of the chunks.
+    """
+
+    FORMATS = ('tsv', 'parquet', 'feather')
+    PARTITION_COL = 'chr'
+    ROW_GROUP_SIZE = 65536
+
+    def __init__(self, out_file, format_='tsv'):
+        if format_ not in self.FORMATS:
+            raise OutputFormatNotSupportError(format_)
+
+        self.out_file = out_file
+        self.format_ = format_
+        self.is_empty = True
+
+        self._out = None
+        self._schema = None
+        self._categories = {}
+        self._row_groups = {}
+
+        if self.format_ != 'tsv':
+            self._pa = import_pyarrow(self.format_)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _encode_strings(self, df):
+        str_cols = [
+            col for col in df.columns
+            if (df[col].dtype == object) or isinstance(df[col].dtype, pd.CategoricalDtype)
+        ]
+
+        encoded_cols = {}
+        for col in str_cols:
+            values = df[col].astype('string')
+
+            # append the new values to the categories of the previous chunks
+            categories = self._categories.get(col, pd.Index([], dtype=object))
+            uniques = pd.Index(values.dropna().unique(), dtype=object)
+            categories = categories.append(uniques[~uniques.isin(categories)])
+            self._categories[col] = categories
+
+            encoded_cols[col] = pd.Categorical(values, categories=categories)
+
+        return df.assign(**encoded_cols)
+
+    def _get_schema(self, df):
+        pa = self._pa
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+
+        # all dictionaries get the same index and value types
+        fields = [
+            pa.field(field.name, pa.dictionary(pa.int32(), pa.string()))
+            if pa.types.is_dictionary(field.type) else field
+            for field in schema
+        ]
+
+        return pa.schema(fields, metadata=schema.metadata)
+
+    def _to_arrow(self, df):
+        df = self._encode_strings(df)
+
+        if self._schema is None:
+            self._schema = self._get_schema(df)
+
+        return self._pa.Table.from_pandas(
+            df,
+            schema=self._schema,
+            preserve_index=False
+        )
+
+    def _open(self):
+        pa = self._pa
+
+        if self.format_ == 'parquet':
+            import pyarrow.parquet as pq
+            return pq.ParquetWriter(self.out_file, self._schema)
+
+        elif self.format_ == 'feather':
+            if pa.Codec.is_available('lz4_frame'):
+                compression = 'lz4'
+            else:
+                compression = None
+
+            return pa.ipc.new_file(
+                self.out_file,
+                self._schema,
+                options=pa.ipc.IpcWriteOptions(
+                    compression=compression,
+                    emit_dictionary_deltas=True
+                )
+            )
+
+    def _add_to_row_group(self, key, table):
+        tables = self._row_groups.setdefault(key, [])
+        tables.append(table)
+
+        if sum(map(len, tables)) >= self.ROW_GROUP_SIZE:
+            self._write_row_group(key)
+
+    def _write_row_group(self, key):
+        tables = self._row_groups.pop(key)
+        self._out.write_table(self._pa.concat_tables(tables))
+
+    def write(self, df):
+        if self.format_ == 'tsv':
+            if self._out is None:
+                self._out = open(self.out_file, 'w')
+
+            df.to_csv(self._out, sep='\t', index=False, header=self.is_empty)
+
+        else:
+            table = self._to_arrow(df)
+
+            if self._out is None:
+                self._out = self._open()
+
+            if self.format_ == 'feather':
+                self._out.write_table(table)
+
+            elif (self.PARTITION_COL in df.columns) and (len(df) > 0):
+                chr_codes, chrs = pd.factorize(df[self.PARTITION_COL], use_na_sentinel=False)
+                order = np.argsort(chr_codes, kind='stable')
+                offsets = np.searchsorted(chr_codes[order], np.arange(len(chrs) + 1))
+
+                for i, chr_ in enumerate(chrs):
+                    self._add_to_row_group(
+                        str(chr_),
+                        table.take(order[offsets[i]:offsets[i + 1]])
+                    )
+
+            else:
+                self._add_to_row_group(None, table)
+
+        self.is_empty = False
+
+    def close(self):
+        if self._out is not None:
+            for key in list(self._row_groups):
+                self._write_row_group(key)
+
+            self._out.close()
+            self._out = None
+
+
+def import_pyarrow(format_):
+    try:
+        import pyarrow
+    except ImportError:
+        raise MissingDependencyError(
+            "The '{}' format needs pyarrow, which can be installed with "
+            "`pip install circmimi[arrow]`.".format(format_)
+        )
+
+    return pyarrow
+
+
+def get_output_file(filename, format_):
+    return '{}.{}'.format(os.path.splitext(filename)[0], format_)
+
+
+def write_table(df, out_file, format_='tsv'):
+    with TableWriter(out_file, format_=format_) as writer:
+        writer.write(df)
+
+
+def _is_flag_set(s):
+    # the flags are int8, unless the database has values other than '0'/'1'
+    if pd.api.types.is_integer_dtype(s.dtype):
+        return (s == 1).values
+    else:
+        return (s == '1').values
+
+
+def get_category_df(res_df, to_binary=False):
+    AGO = (res_df['num_AGO_supported_binding_sites'] > 0).values
+    validated = _is_flag_set(res_df['miRTarBase']) | _is_flag_set(res_df['ENCORI'])
+
+    if to_binary:
+        category_df = pd.DataFrame(
+            {
+                'category_1': AGO & validated,
+                'category_2': AGO ^ validated,
+                'category_3': ~(AGO | validated)
+            },
+            index=res_df.index
+        ).astype(np.int8)
+    else:
+        category_df = pd.DataFrame(
+            {
+                'category': np.select(
+                    [AGO & validated, AGO | validated],
+                    ['1', '2'],
+                    default='3'
+                ).astype(object)
+            },
+            index=res_df.index
+        )
+
+    return category_df
+
+
+class OutputFormatNotSupportError(Exception):
+    pass
+
+
+class MissingDependencyError(Exception):
+    pass
@@ -1,7 +1,11 @@
+import os
+import shutil
+import tempfile as tp
+import numpy as np
 import pandas as pd
 from itertools import cycle
-from bisect import bisect
 from circmimi.bed import IntersectBED, Bed
+from circmimi.schema import Schema
 
 
 class RBPBindingSites:
@@ -9,77 +13,113 @@ class RBPBindingSites:
         + tuple(f'{title}_rbp' for title in Bed.BED_TITLE[:6]) \
         + ('overlap',)
 
-    def __init__(self, rbp_file, bedtools_bin="bedtools"):
+    def __init__(self, rbp_file, bedtools_bin="bedtools", engine='native'):
         self.rbp_file = rbp_file
         self.bedtools_bin = bedtools_bin
-        self.intersect_bed = IntersectBED(
-            bedtools_bin=self.bedtools_bin,
-            options='-wo'
-        )
-
-    @staticmethod
-    def _recover_blocks(bed_line):
-        bed_start = bed_line['start'] + 1
-        blockStarts = list(map(int, bed_line['blockStarts'].split(',')))
-        blockSizes = list(map(int, bed_line['blockSizes'].split(',')))
-
-        blocks = [Bed._region(bed_start + start, bed_start + start + size - 1)
-                  for start, size in zip(blockStarts, blockSizes)]
-
-        return blocks
+        self.engine = engine
+
+        if self.engine == 'native':
+            self._binding_sites_index = None
+        elif self.engine == 'bedtools':
+            self.intersect_bed = IntersectBED(
+                bedtools_bin=self.bedtools_bin,
+                options='-wo'
+            )
+        else:
+            raise OverlapEngineNotSupportError(self.engine)
 
     @staticmethod
-    def _shrink_site_to_region(r, s, offset=0):
-        bisect_result = bisect(r, s)
+    def _explode_blocks(df):
+        block_sizes = df['blockSizes'].str.split(',')
+        block_starts = df['blockStarts'].str.split(',').explode()
 
-        if bisect_result == 0:
-            s_in_r = r.start + offset - 1
-        elif bisect_result == 1:
-            s_in_r = s
-        elif bisect_result == 2:
-            s_in_r = r.end + offset
+        row_idx = np.repeat(np.arange(len(df)), block_sizes.str.len().values)
+        block_sizes = block_sizes.explode().values.astype(np.int64)
+        block_starts = block_starts.values.astype(np.int64)
 
-        return s_in_r
+        return row_idx, block_starts, block_sizes
 
     @classmethod
-    def _calculate_two_region_overlap(cls, r1, r2):
-        start_in_r1 = cls._shrink_site_to_region(r1, r2.start, offset=1)
-        end_in_r1 = cls._shrink_site_to_region(r1, r2.end)
-        overlap = end_in_r1 - start_in_r1 + 1
-        return overlap
+    def _append_real_overlap(cls, df):
+        row_idx, block_starts, block_sizes = cls._explode_blocks(df)
+
+        # 1-based, closed regions of the blocks and the RBP sites
+        block_starts = df['start'].values.astype(np.int64)[row_idx] + block_starts + 1
+        block_ends = block_starts + block_sizes - 1
+        rbp_starts = df['start_rbp'].values.astype(np.int64)[row_idx] + 1
+        rbp_ends = df['end_rbp'].values.astype(np.int64)[row_idx]
+
+        # shrink the sites to the blocks, where a site starting on the last
+        # base of a block is taken as after the block
+        start_in_block = np.where(
+            rbp_starts >= block_ends,
+            block_ends + 1,
+            np.maximum(rbp_starts, block_starts)
+        )
+        end_in_block = np.clip(rbp_ends, block_starts - 1, block_ends)
+        block_overlap = end_in_block - start_in_block + 1
+
+        # a single block overlaps the site as reported by the intersection
+        real_overlap = np.where(
+            df['blockCount'].values == 1,
+            df['overlap'].values.astype(np.int64),
+            np.bincount(
+                row_idx,
+                weights=block_overlap,
+                minlength=len(df)
+            ).astype(np.int64)
+        )
 
-    @classmethod
-    def _calculate_overlap(cls, bed_line):
-        blocks = cls._recover_blocks(bed_line)
-        rbp_block = Bed._region(bed_line['start_rbp'] + 1, bed_line['end_rbp'])
+        df_with_overlap = df.assign(
+            real_overlap=real_overlap,
+            rbp_region_len=lambda df: df['end_rbp'] - df['start_rbp'],
+            total_blocks_len=np.bincount(
+                row_idx,
+                weights=block_sizes,
+                minlength=len(df)
+            ).astype(np.int64)
+        )
 
-        overlap = 0
-        for b in blocks:
-            overlap += cls._calculate_two_region_overlap(b, rbp_block)
+        return df_with_overlap
 
-        return overlap
+    @staticmethod
+    def _get_split_rbp_name(idx):
+        return lambda df: df['name_rbp'].apply(lambda name: name.split('_')[idx])
 
-    @classmethod
-    def _get_real_overlap(cls, bed_line):
-        blockCount = bed_line['blockCount']
+    @property
+    def binding_sites_index(self):
+        if self._binding_sites_index is None:
+            self._binding_sites_index = BindingSitesIndex.load(self.rbp_file)
 
-        if blockCount == 1:
-            overlap = bed_line['overlap']
-        elif blockCount > 1:
-            overlap = cls._calculate_overlap(bed_line)
+        return self._binding_sites_index
 
-        return overlap
+    def _intersect(self, bed_df):
+        if self.engine == 'native':
+            intersect_result_df = self.binding_sites_index.intersect(bed_df)
+        else:
+            intersect_result_df = pd.DataFrame(
+                self.intersect_bed.intersect(bed_df, self.rbp_file),
+                columns=self._titles,
+                dtype='object'
+            ).assign(
+                sample_id=self._get_split_rbp_name(0),
+                RBP=self._get_split_rbp_name(1)
+            )
 
-    @staticmethod
-    def _get_split_rbp_name(idx):
-        return lambda df: df['name_rbp'].apply(lambda name: name.split('_')[idx])
+        return intersect_result_df
 
     def overlap(self, bed_df):
-        intersect_result_df = pd.DataFrame(
-            self.intersect_bed.intersect(bed_df, self.rbp_file),
-            columns=self._titles,
-            dtype='object'
-        ).astype(
+        return self._to_overlap_df(self._intersect(bed_df))
+
+    def overlap_by_chr(self, bed_df):
+        if self.engine == 'native':
+            for intersect_result_df in self.binding_sites_index.intersect_by_chr(bed_df):
+                yield self._to_overlap_df(intersect_result_df)
+        else:
+            yield self.overlap(bed_df)
+
+    def _to_overlap_df(self, intersect_result_df):
+        intersect_result_df = intersect_result_df.astype(
             {
                 'start': int,
                 'end': int,
@@ -88,45 +128,424 @@ class RBPBindingSites:
                 'end_rbp': int,
                 'overlap': int
             }
-        ).astype(
-            'object'
-        ).assign(
-            sample_id=self._get_split_rbp_name(0),
-            RBP=self._get_split_rbp_name(1)
-        ).assign(
-            real_overlap=lambda df: df.apply(self._get_real_overlap, axis=1)
-        ).assign(
-            rbp_region_len=lambda df: df['end_rbp'] - df['start_rbp'],
-            total_blocks_len=lambda df: df['blockSizes'].apply(
-                lambda sizes: sum(map(int, sizes.split(',')))
-            )
+        ).pipe(
+            Schema.apply,
+            columns=['start', 'end', 'start_rbp', 'end_rbp']
+        ).pipe(
+            self._append_real_overlap
         )
 
         return intersect_result_df
 
     @staticmethod
-    def _get_joined_overlap(group_df):
-        joined_overlap = sum(group_df['real_overlap'])
-        group_elts = tuple(group_df.index)
-        joined_overlap_df = group_df.assign(
-            joined_overlap=joined_overlap,
-            group_elements=','.join(map(str, group_elts))
+    def append_joined_overlap(df):
+        grouped_df = df.groupby(['name', 'sample_id'], sort=False)
+        group_ids = grouped_df.ngroup().values
+
+        # the index labels of all rows in the same group
+        group_elements = pd.Series(
+            df.index.astype(str)
+        ).groupby(
+            group_ids
+        ).agg(
+            ','.join
+        ).values
+
+        df_with_joined_overlap = df.assign(
+            joined_overlap=grouped_df['real_overlap'].transform('sum'),
+            group_elements=group_elements[group_ids]
         )
 
-        return joined_overlap_df
+        return df_with_joined_overlap
+
+
+class BindingSitesIndex:
+    """In-process replacement of `bedtools intersect -wo` for BED files.
+
+    The sites of each chromosome are split into classes by their lengths
+    (in powers of two), and the sites of each class are sorted by their
+    starts. All sites of a class overlapping a query start within the
+    longest site of the class before the query, so they are found by two
+    binary searches, and the long sites do not widen the search for the
+    short ones. As `bedtools intersect` without `-s`, the overlaps do not
+    depend on the strands. The names of the sites are not kept, only the
+    sample ids and the RBPs in them.
+
+    The index is built from the BED file a chunk at a time, and saved as
+    a directory of npy files next to the BED file, which is rebuilt only if
+    the BED file is changed. The arrays are memory-mapped and the loaded
+    indexes are cached in the process, so that only the chromosomes being
+    queried are read.
+    """
+
+    BED_COLS = Bed.BED_TITLE[:6]
+    INDEX_SUFFIX = '.idx'
+    INDEX_VERSION = 3
+    CHUNK_SIZE = 100000
+
+    RESULT_TITLES = tuple(
+        title for title in RBPBindingSites._titles if title != 'name_rbp'
+    ) + ('sample_id', 'RBP')
+
+    CODE_COLUMNS = ('score', 'strand', 'sample_id', 'RBP')
+
+    SITE_DTYPE = np.dtype(
+        [
+            ('start', np.int64),
+            ('end', np.int64),
+            ('line', np.int64)
+        ] + [
+            (col, np.int32) for col in CODE_COLUMNS
+        ]
+    )
+
+    # the number of the length classes of each chromosome
+    _NUM_CLASSES = 64
+
+    _loaded = {}
+    _tmp_dirs = []
+
+    def __init__(self, arrays):
+        self._arrays = arrays
+
+        chr_group_offsets = arrays['chr_group_offsets']
+        self._chr_groups = {
+            chr_: range(chr_group_offsets[i], chr_group_offsets[i + 1])
+            for i, chr_ in enumerate(arrays['chr_names'])
+        }
+
+    @staticmethod
+    def _get_source_stat(bed_file):
+        stat = os.stat(bed_file)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    @staticmethod
+    def _encode(values, names):
+        # codes of the values, shared by all chunks through `names`
+        codes, uniques = pd.factorize(values)
+
+        uniques_codes = np.array(
+            [names.setdefault(value, len(names)) for value in uniques],
+            dtype=np.int32
+        )
+
+        return uniques_codes[codes]
 
     @classmethod
-    def append_joined_overlap(cls, df):
-        groupby_df = df.groupby(
-            [
-                'name',
-                'sample_id'
-            ]
-        ).apply(
-            cls._get_joined_overlap
+    def _read_bed_chunks(cls, bed_file, chunksize):
+        return pd.read_csv(
+            bed_file,
+            sep='\t',
+            header=None,
+            usecols=range(6),
+            names=cls.BED_COLS,
+            dtype={
+                'chr': str,
+                'start': np.int64,
+                'end': np.int64,
+                'name': str,
+                'score': str,
+                'strand': str
+            },
+            comment='#',
+            chunksize=chunksize
         )
 
-        return groupby_df
+    @classmethod
+    def _spill_chunk(cls, bed_df, line_offset, all_names, spill_dir, group_sizes):
+        chr_codes = cls._encode(bed_df['chr'], all_names['chr'])
+
+        split_names = bed_df['name'].str.split('_', n=2)
+
+        records = np.empty(len(bed_df), dtype=cls.SITE_DTYPE)
+        records['start'] = bed_df['start'].values
+        records['end'] = bed_df['end'].values
+        records['line'] = np.arange(line_offset, line_offset + len(bed_df))
+
+        for col, values in [
+            ('score', bed_df['score']),
+            ('strand', bed_df['strand']),
+            ('sample_id', split_names.str[0]),
+            ('RBP', split_names.str[1])
+        ]:
+            records[col] = cls._encode(values, all_names[col])
+
+        site_lens = np.maximum(records['end'] - records['start'], 1)
+        len_classes = np.floor(np.log2(site_lens)).astype(np.int64)
+        group_keys = chr_codes.astype(np.int64) * cls._NUM_CLASSES + len_classes
+
+        order = np.argsort(group_keys, kind='stable')
+        group_keys = group_keys[order]
+        records = records[order]
+
+        keys, key_starts = np.unique(group_keys, return_index=True)
+        key_ends = np.append(key_starts[1:], len(group_keys))
+
+        for key, key_start, key_end in zip(keys, key_starts, key_ends):
+            spill_file = os.path.join(spill_dir, '{}.bin'.format(key))
+            with open(spill_file, 'ab') as spill_out:
+                records[key_start:key_end].tofile(spill_out)
+
+            group_sizes[key] = group_sizes.get(key, 0) + (key_end - key_start)
+
+    @classmethod
+    def _write_index(cls, bed_file, index_dir, chunksize):
+        spill_dir = os.path.join(index_dir, 'spill')
+        os.makedirs(spill_dir)
+
+        all_names = {col: {} for col in ('chr',) + cls.CODE_COLUMNS}
+        group_sizes = {}
+
+        # spill the sites of each chromosome and length class to a file
+        num_sites = 0
+        for bed_df in cls._read_bed_chunks(bed_file, chunksize):
+            cls._spill_chunk(bed_df, num_sites, all_names, spill_dir, group_sizes)
+            num_sites += len(bed_df)
+
+        def save_array(key, array):
+            np.save(os.path.join(index_dir, '{}.npy'.format(key)), array)
+
+        def open_array(key, dtype):
+            return np.lib.format.open_memmap(
+                os.path.join(index_dir, '{}.npy'.format(key)),
+                mode='w+',
+                dtype=dtype,
+                shape=(num_sites,)
+            )
+
+        arrays = {
+            'start': open_array('start', np.int64),
+            'end': open_array('end', np.int64),
+            'line': open_array('line', np.int64)
+        }
+        for col in cls.CODE_COLUMNS:
+            arrays[f'{col}_codes'] = open_array(f'{col}_codes', np.int32)
+
+        # then sort the groups one by one into the memory-mapped arrays
+        group_keys = sorted(group_sizes)
+        group_offsets = np.zeros(len(group_keys) + 1, dtype=np.int64)
+        group_max_len = np.zeros(len(group_keys), dtype=np.int64)
+
+        for i, key in enumerate(group_keys):
+            spill_file = os.path.join(spill_dir, '{}.bin'.format(key))
+            records = np.fromfile(spill_file, dtype=cls.SITE_DTYPE)
+            os.remove(spill_file)
+
+            records = records[np.lexsort((records['line'], records['start']))]
+
+            group_slice = slice(group_offsets[i], group_offsets[i] + len(records))
+            for col in ('start', 'end', 'line'):
+                arrays[col][group_slice] = records[col]
+            for col in cls.CODE_COLUMNS:
+                arrays[f'{col}_codes'][group_slice] = records[col]
+
+            group_offsets[i + 1] = group_slice.stop
+            group_max_len[i] = (records['end'] - records['start']).max()
+
+        for array in arrays.values():
+            array.flush()
+        del arrays
+
+        os.rmdir(spill_dir)
+
+        group_chr = np.array(group_keys, dtype=np.int64) // cls._NUM_CLASSES
+        chr_group_offsets = np.searchsorted(
+            group_chr,
+            np.arange(len(all_names['chr']) + 1)
+        ).astype(np.int64)
+
+        save_array('version', np.array(cls.INDEX_VERSION))
+        save_array('source_stat', cls._get_source_stat(bed_file))
+        save_array('chr_names', np.array(list(all_names['chr']), dtype=str))
+        save_array('chr_offsets', group_offsets[chr_group_offsets])
+        save_array('chr_group_offsets', chr_group_offsets)
+        save_array('group_offsets', group_offsets)
+        save_array('group_max_len', group_max_len)
+
+        for col in cls.CODE_COLUMNS:
+            save_array(f'{col}_names', np.array(list(all_names[col]), dtype=str))
+
+    @classmethod
+    def build(cls, bed_file, index_dir, chunksize=None):
+        if chunksize is None:
+            chunksize = cls.CHUNK_SIZE
+
+        tmp_index_dir = tp.mkdtemp(
+            dir=os.path.dirname(index_dir),
+            prefix=os.path.basename(index_dir) + '.tmp.'
+        )
+
+        try:
+            cls._write_index(bed_file, tmp_index_dir, chunksize)
+        except BaseException:
+            shutil.rmtree(tmp_index_dir, ignore_errors=True)
+            raise
+
+        if os.path.exists(index_dir):
+            shutil.rmtree(index_dir)
+
+        os.replace(tmp_index_dir, index_dir)
+
+    @classmethod
+    def _read_index(cls, index_dir, source_stat):
+        def load_array(key):
+            return np.load(os.path.join(index_dir, f'{key}.npy'), mmap_mode='r')
+
+        try:
+            if (int(load_array('version')) != cls.INDEX_VERSION) or \
+                    (not np.array_equal(load_array('source_stat'), source_stat)):
+                return None
+
+            arrays = {
+                os.path.splitext(fname)[0]: load_array(os.path.splitext(fname)[0])
+                for fname in os.listdir(index_dir)
+                if fname.endswith('.npy')
+            }
+        except (OSError, ValueError):
+            return None
+
+        return cls(arrays)
+
+    @classmethod
+    def load(cls, bed_file):
+        bed_file = os.path.abspath(bed_file)
+        source_stat = cls._get_source_stat(bed_file)
+        cache_key = (bed_file, tuple(source_stat))
+
+        if cache_key not in cls._loaded:
+            index_dir = bed_file + cls.INDEX_SUFFIX
+            binding_sites_index = cls._read_index(index_dir, source_stat)
+
+            if binding_sites_index is None:
+                try:
+                    cls.build(bed_file, index_dir)
+                except OSError:
+                    # the directory of the BED file is not writable
+                    tmp_dir = tp.TemporaryDirectory()
+                    cls._tmp_dirs.append(tmp_dir)
+
+                    index_dir = os.path.join(tmp_dir.name, 'index')
+                    cls.build(bed_file, index_dir)
+
+                binding_sites_index = cls._read_index(index_dir, source_stat)
+
+            cls._loaded[cache_key] = binding_sites_index
+
+        return cls._loaded[cache_key]
+
+    def _find_overlaps(self, chr_, starts, ends):
+        all_query = []
+        all_site = []
+        all_overlap = []
+
+        for group in self._chr_groups.get(chr_, range(0)):
+            group_start = self._arrays['group_offsets'][group]
+            group_slice = slice(group_start, self._arrays['group_offsets'][group + 1])
+            site_starts = self._arrays['start'][group_slice]
+            site_ends = self._arrays['end'][group_slice]
+            max_len = self._arrays['group_max_len'][group]
+
+            # the sites before `lo` end before the query starts, and the
+            # sites from `hi` start after the query ends.
+            lo = np.searchsorted(site_starts, starts - max_len, side='right')
+            hi = np.searchsorted(site_starts, ends, side='left')
+            num_candidates = np.maximum(hi - lo, 0)
+
+            query = np.repeat(np.arange(len(starts)), num_candidates)
+            candidate = np.arange(len(query)) - np.repeat(
+                np.cumsum(num_candidates) - num_candidates,
+                num_candidates
+            ) + np.repeat(lo, num_candidates)
+
+            overlap = np.minimum(ends[query], site_ends[candidate]) - \
+                np.maximum(starts[query], site_starts[candidate])
+            is_overlapped = overlap > 0
+
+            all_query.append(query[is_overlapped])
+            all_site.append(candidate[is_overlapped] + group_start)
+            all_overlap.append(overlap[is_overlapped])
+
+        if not all_query:
+            return (
+                np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.int64)
+            )
+
+        return (
+            np.concatenate(all_query),
+            np.concatenate(all_site),
+            np.concatenate(all_overlap)
+        )
+
+    def _get_sites_df(self, site):
+        sites_df = pd.DataFrame({
+            'chr_rbp': self._arrays['chr_names'][
+                np.searchsorted(self._arrays['chr_offsets'], site, side='right') - 1
+            ],
+            'start_rbp': self._arrays['start'][site],
+            'end_rbp': self._arrays['end'][site]
+        })
+
+        for col in ['score', 'strand', 'sample_id', 'RBP']:
+            codes = self._arrays[f'{col}_codes'][site]
+            sites_df[f'{col}_rbp'] = self._arrays[f'{col}_names'][codes]
+
+        sites_df = sites_df.rename(
+            {
+                'sample_id_rbp': 'sample_id',
+                'RBP_rbp': 'RBP'
+            },
+            axis=1
+        )
+
+        return sites_df
+
+    def _intersect_chr(self, chr_, chr_bed_df):
+        query, site, overlap = self._find_overlaps(
+            chr_,
+            chr_bed_df['start'].values.astype(np.int64),
+            chr_bed_df['end'].values.astype(np.int64)
+        )
+
+        # the same order as `bedtools intersect` on the sorted sites
+        order = np.lexsort((
+            self._arrays['line'][site],
+            self._arrays['start'][site],
+            query
+        ))
+        query = query[order]
+        site = site[order]
+        overlap = overlap[order]
+
+        intersect_result_df = pd.concat(
+            [
+                chr_bed_df.iloc[query].reset_index(drop=True),
+                self._get_sites_df(site),
+                pd.Series(overlap, name='overlap')
+            ],
+            axis=1
+        ).loc[:, self.RESULT_TITLES]
+
+        return intersect_result_df
+
+    def intersect_by_chr(self, bed_df):
+        for chr_, chr_bed_df in bed_df.groupby('chr', sort=False):
+            if chr_ in self._chr_groups:
+                yield self._intersect_chr(chr_, chr_bed_df)
+
+    def intersect(self, bed_df):
+        all_results = list(self.intersect_by_chr(bed_df))
+
+        if all_results:
+            intersect_result_df = pd.concat(all_results, ignore_index=True)
+        else:
+            intersect_result_df = self._intersect_chr(
+                None,
+                bed_df.iloc[:0]
+            )
+
+        return intersect_result_df
 
 
 class RBPBindingSitesFilters:
@@ -230,3 +649,121 @@ class PosMap:
             real_blocks.append(self._to_region(start_pos, end_pos))
 
         return tuple(real_blocks)
+
+
+class PosMapArray:
+    BLOCKS_TITLE = ('hit', 'chr', 'start', 'end', 'strand')
+
+    def __init__(self, regions_df):
+        self._regions_ids = pd.Index(regions_df['regions_id'])
+
+        regions = regions_df['regions'].explode()
+        regions_data = pd.DataFrame(
+            list(regions.values),
+            columns=['chr', 'start', 'end', 'strand']
+        )
+
+        self._chr = regions_data['chr'].values
+        self._start = regions_data['start'].values.astype(np.int64)
+        self._end = regions_data['end'].values.astype(np.int64)
+        self._strand = regions_data['strand'].values
+        self._lens = self._end - self._start + 1
+
+        num_exons = regions_df['regions'].apply(len).values.astype(np.int64)
+        self._num_exons = num_exons
+        self._first_exon = np.concatenate([[0], np.cumsum(num_exons)[:-1]])
+
+        # the exons of all isoforms are laid out one after another,
+        # `self._exon_starts` are the 0-based positions of the exons
+        # in this layout.
+        self._exon_starts = np.concatenate([[0], np.cumsum(self._lens)[:-1]])
+        self._total_lens = np.add.reduceat(self._lens, self._first_exon) \
+            if len(self._lens) else np.array([], dtype=np.int64)
+        self._iso_starts = self._exon_starts[self._first_exon] \
+            if len(self._lens) else np.array([], dtype=np.int64)
+
+    def _locate(self, iso, rel_pos):
+        total_len = self._total_lens[iso]
+        lap, pos_in_iso = np.divmod(rel_pos - 1, total_len)
+
+        exon = np.searchsorted(
+            self._exon_starts,
+            self._iso_starts[iso] + pos_in_iso,
+            side='right'
+        ) - 1
+
+        ordinal = lap * self._num_exons[iso] + (exon - self._first_exon[iso])
+
+        return ordinal
+
+    def get_real_blocks(self, regions_ids, rel_starts, rel_ends):
+        iso = self._regions_ids.get_indexer(regions_ids)
+        rel_starts = np.asarray(rel_starts, dtype=np.int64)
+        rel_ends = np.asarray(rel_ends, dtype=np.int64)
+
+        ordinal_start = self._locate(iso, rel_starts)
+        ordinal_end = self._locate(iso, rel_ends)
+        num_blocks = ordinal_end - ordinal_start + 1
+
+        hit = np.repeat(np.arange(len(iso)), num_blocks)
+        block_rank = np.arange(len(hit)) - np.repeat(
+            np.cumsum(num_blocks) - num_blocks,
+            num_blocks
+        )
+
+        iso = iso[hit]
+        lap, exon_rank = np.divmod(
+            ordinal_start[hit] + block_rank,
+            self._num_exons[iso]
+        )
+        exon = self._first_exon[iso] + exon_rank
+
+        exon_rel_start = lap * self._total_lens[iso] \
+            + self._exon_starts[exon] - self._iso_starts[iso]
+        exon_rel_end = exon_rel_start + self._lens[exon] - 1
+
+        offset_1 = np.maximum(rel_starts[hit] - 1, exon_rel_start) - exon_rel_start
+        offset_2 = np.minimum(rel_ends[hit] - 1, exon_rel_end) - exon_rel_start
+
+        strand = self._strand[exon]
+        is_plus = (strand == '+')
+        pos_1 = np.where(is_plus, self._start[exon] + offset_1, self._end[exon] - offset_1)
+        pos_2 = np.where(is_plus, self._start[exon] + offset_2, self._end[exon] - offset_2)
+
+        blocks_df = pd.DataFrame(
+            {
+                'hit': hit,
+                'chr': self._chr[exon],
+                'start': np.minimum(pos_1, pos_2),
+                'end': np.maximum(pos_1, pos_2),
+                'strand': strand
+            },
+            columns=self.BLOCKS_TITLE
+        )
+
+        return blocks_df
+
+    @staticmethod
+    def to_regions(blocks_df, num_hits):
+        all_blocks = list(zip(
+            blocks_df['chr'],
+            blocks_df['start'].tolist(),
+            blocks_df['end'].tolist(),
+            blocks_df['strand']
+        ))
+
+        offsets = np.searchsorted(
+            blocks_df['hit'].values,
+            np.arange(num_hits + 1)
+        )
+
+        regions = [
+            tuple(all_blocks[i:j])
+            for i, j in zip(offsets[:-1], offsets[1:])
+        ]
+
+        return regions
+
+
+class OverlapEngineNotSupportError(Exception):
+    pass
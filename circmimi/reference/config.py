@@ -19,6 +19,8 @@ CONFIG_TEMPL = """
     AGO_data =
     RBP_data =
     RBP_target =
+    binding_sites =
+    mir_target_stats =
 """
 
 
@@ -53,8 +55,8 @@ def get_refs(ref_dir):
     mir_target = prepend_dirname_to_file(ref_dir, config['refs']['mir_target'])
     other_transcripts = prepend_dirname_to_file(ref_dir, config['refs']['other_transcripts'])
     AGO_data = prepend_dirname_to_file(ref_dir, config['refs']['AGO_data'])
-    RBP_data = None #prepend_dirname_to_file(ref_dir, config['refs']['RBP_data'])
-    RBP_target = None #prepend_dirname_to_file(ref_dir, config['refs']['RBP_target'])
+    RBP_data = prepend_dirname_to_file(ref_dir, config['refs']['RBP_data'])
+    RBP_target = prepend_dirname_to_file(ref_dir, config['refs']['RBP_target'])
 
     return (anno_db,
             ref_file,
@@ -66,6 +68,15 @@ def get_refs(ref_dir):
             RBP_target)
 
 
+def get_extra_ref(ref_dir, key):
+    cfg_file = os.path.join(ref_dir, DEFAULT_REF_CONFIG)
+
+    configObj = RefConfig()
+    configObj.read(cfg_file)
+
+    return prepend_dirname_to_file(ref_dir, configObj['refs'].get(key, ''))
+
+
 def prepend_dirname_to_file(ref_dir, filename):
     if filename == '':
         return None
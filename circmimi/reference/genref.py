@@ -9,6 +9,7 @@ from circmimi.seq import parse_fasta
 from circmimi.reference import resource as rs
 from circmimi.reference.utils import cwd
 from circmimi.reference.mirbase import MatureMiRNAUpdater
+from circmimi.rbp import BindingSitesIndex
 
 
 class RefFile:
@@ -229,7 +230,7 @@ class MirTargetRef:
         self.ref_names = ref_names
 
 
-def generate(species, source, version, ref_dir):
+def generate(species, source, version, ref_dir, with_RBP=False):
     with cwd(ref_dir):
         species = species_list[species]
 
@@ -281,13 +282,17 @@ def generate(species, source, version, ref_dir):
                 rs.EncoriMiRNATargetData(species.key)
             ]
         )
-        ENCORI_RBP_files = Files(
-            [
-                rs.EncoriRBPData(species.key, source, version, only_AGO=True),
-                # rs.EncoriRBPData(species.key, source, version),
-                # rs.EncoriRBPTargetData(species.key)
-            ]
-        )
+        ENCORI_RBP_resources = [
+            rs.EncoriRBPData(species.key, source, version, only_AGO=True)
+        ]
+        if with_RBP:
+            ENCORI_RBP_resources.extend(
+                [
+                    rs.EncoriRBPData(species.key, source, version),
+                    rs.EncoriRBPTargetData(species.key)
+                ]
+            )
+        ENCORI_RBP_files = Files(ENCORI_RBP_resources)
 
         # download
         anno_file.download()
@@ -353,6 +358,12 @@ def generate(species, source, version, ref_dir):
         )
         others_ref.generate()
 
+        # index of the AGO binding sites
+        BindingSitesIndex.load(ENCORI_RBP_files[0].filename)
+
+        if with_RBP:
+            BindingSitesIndex.load(ENCORI_RBP_files[1].filename)
+
         # config
         info = {
             'species': species.key,
@@ -366,9 +377,15 @@ def generate(species, source, version, ref_dir):
             'mir_ref': mir_ref.filename,
             'mir_target': mir_target_ref.filename,
             'other_transcripts': others_ref.filename,
-            'AGO_data': ENCORI_RBP_files[0].filename,
-            # 'RBP_data': ENCORI_RBP_files[1].filename,
-            # 'RBP_target': ENCORI_RBP_files[2].filename
+            'AGO_data': ENCORI_RBP_files[0].filename
         }
 
+        if with_RBP:
+            ref_files.update(
+                {
+                    'RBP_data': ENCORI_RBP_files[1].filename,
+                    'RBP_target': ENCORI_RBP_files[2].filename
+                }
+            )
+
         return info, ref_files
@@ -0,0 +1,60 @@
+import os
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from circmimi.models import Chromosome, Strand, Exon
+from circmimi.exon_sites import ExonSitesIndex
+from circmimi.reference.config import RefConfig, DEFAULT_REF_CONFIG, get_refs
+
+
+def get_all_exons(anno_db_file):
+    engine = create_engine('sqlite:///{}'.format(anno_db_file))
+    Session = sessionmaker(bind=engine)
+    session = Session()
+
+    all_exons = session.query(
+        Chromosome.name,
+        Exon.start,
+        Exon.end,
+        Strand.name
+    ).join(
+        Chromosome,
+        Exon.chr_id == Chromosome.id
+    ).join(
+        Strand,
+        Exon.strand_id == Strand.id
+    ).all()
+
+    session.close()
+
+    exons_df = pd.DataFrame(all_exons, columns=['chr', 'start', 'end', 'strand'])
+
+    return exons_df
+
+
+def generate(ref_dir, engine='miranda', miranda_options=None, num_proc=1,
+             miranda_run_options=None):
+    anno_db, ref_file, mir_ref, *_ = get_refs(ref_dir)
+
+    exons_df = get_all_exons(anno_db)
+
+    exon_sites_index = ExonSitesIndex.build(
+        exons_df,
+        ref_file,
+        mir_ref,
+        work_dir=ref_dir,
+        num_proc=num_proc,
+        miranda_options=miranda_options,
+        engine=engine,
+        miranda_run_options=miranda_run_options
+    )
+
+    filename = 'binding_sites.{}.npz'.format(exon_sites_index.meta['engine'])
+    exon_sites_index.save(os.path.join(ref_dir, filename))
+
+    config = RefConfig()
+    config.read(os.path.join(ref_dir, DEFAULT_REF_CONFIG))
+    config['refs']['binding_sites'] = filename
+    config.write(ref_dir)
+
+    return filename
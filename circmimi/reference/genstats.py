@@ -0,0 +1,26 @@
+import os
+from circmimi.circmimi import get_mir_target_db
+from circmimi.stats import MiRNATargetBackground
+from circmimi.reference.config import RefConfig, DEFAULT_REF_CONFIG, get_refs
+
+
+def generate(ref_dir):
+    _, _, mir_ref, mir_target, *_ = get_refs(ref_dir)
+
+    mir_target_db = get_mir_target_db(mir_target)
+
+    background = MiRNATargetBackground.build(
+        mir_ref,
+        mir_target_db,
+        meta=MiRNATargetBackground.get_meta(mir_ref, mir_target)
+    )
+
+    filename = 'mir_target_stats.npz'
+    background.save(os.path.join(ref_dir, filename))
+
+    config = RefConfig()
+    config.read(os.path.join(ref_dir, DEFAULT_REF_CONFIG))
+    config['refs']['mir_target_stats'] = filename
+    config.write(ref_dir)
+
+    return filename
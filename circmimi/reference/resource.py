@@ -13,12 +13,12 @@ genome_filename = reference_genome.filename
 '''
 
 
-import subprocess as sp
 import ftplib
 import urllib.request
 import urllib.error
 import os
 import re
+from circmimi import trace
 
 
 class Resource:
@@ -41,7 +41,10 @@ class Resource:
             self.filename = dest_path.rstrip('.gz')
 
         else:
-            res = sp.run(['wget', self.url, '-P', dir_] + self.wget_options)
+            res = trace.run(
+                ['wget', self.url, '-P', dir_] + self.wget_options,
+                outputs=[dest_path]
+            )
 
             if res.returncode == 0:
                 self.filename = dest_path
@@ -50,7 +53,11 @@ class Resource:
 
     def unzip(self):
         if self.filename.endswith('.gz'):
-            res = sp.run(['gunzip', self.filename])
+            res = trace.run(
+                ['gunzip', self.filename],
+                inputs=[self.filename],
+                outputs=[re.sub(r'\.gz$', '', self.filename)]
+            )
 
             if res.returncode == 0:
                 self.filename = re.sub(r'\.gz$', '', self.filename)
@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+
+
+class Schema:
+    """Compact dtypes for the columns shared by the tables of the pipeline.
+
+    The string ids are stored as categoricals, the 0/1 flags (also the
+    '0'/'1' strings of the miRNA-target database) as int8, the positions as
+    int32 and the scores as float32. A column is only converted if all of
+    its values are kept exactly, so the results are the same as with the
+    default dtypes.
+    """
+
+    ID_COLUMNS = (
+        'chr',
+        'strand',
+        'circ_id',
+        'host_gene',
+        'mirna',
+        'query_id',
+        'reference_id',
+        'target_gene',
+        'RBP',
+        'sample_id'
+    )
+    FLAG_COLUMNS = (
+        'miRTarBase',
+        'miRDB',
+        'ENCORI',
+        'cross_boundary',
+        'AGO_support_yn'
+    )
+    FLAG_STRINGS = ('0', '1')
+    POSITION_COLUMNS = (
+        'pos1',
+        'pos2',
+        'start',
+        'end',
+        'start_rbp',
+        'end_rbp',
+        'query_start',
+        'query_end',
+        'ref_start',
+        'ref_end',
+        'aln_length',
+        'total_len'
+    )
+    SCORE_COLUMNS = (
+        'score',
+        'energy',
+        'identity',
+        'similarity'
+    )
+
+    @staticmethod
+    def _is_int_column(s, dtype):
+        if not pd.api.types.is_integer_dtype(s.dtype) or \
+                isinstance(s.dtype, pd.api.extensions.ExtensionDtype):
+            return False
+
+        info = np.iinfo(dtype)
+        values = s.values
+
+        return (len(values) == 0) or \
+            ((values.min() >= info.min) and (values.max() <= info.max))
+
+    @classmethod
+    def _is_flag_string_column(cls, s):
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            values = s.cat.categories
+        elif s.dtype == object:
+            values = pd.Index(s.unique())
+        else:
+            return False
+
+        return (not s.isna().any()) and values.isin(cls.FLAG_STRINGS).all()
+
+    @staticmethod
+    def _is_float32_exact(s):
+        if s.dtype != np.float64:
+            return False
+
+        values = s.values
+        return np.array_equal(
+            values.astype(np.float32).astype(np.float64),
+            values,
+            equal_nan=True
+        )
+
+    @classmethod
+    def get_dtypes(cls, df, columns=None):
+        if columns is None:
+            columns = df.columns
+
+        dtypes = {}
+
+        for col in columns:
+            s = df[col]
+
+            if col in cls.ID_COLUMNS:
+                if s.dtype == object:
+                    dtypes[col] = 'category'
+            elif col in cls.FLAG_COLUMNS:
+                if cls._is_int_column(s, np.int8) or cls._is_flag_string_column(s):
+                    dtypes[col] = np.int8
+            elif col in cls.POSITION_COLUMNS:
+                if cls._is_int_column(s, np.int32):
+                    dtypes[col] = np.int32
+            elif col in cls.SCORE_COLUMNS:
+                if cls._is_float32_exact(s):
+                    dtypes[col] = np.float32
+
+        return {
+            col: dtype
+            for col, dtype in dtypes.items()
+            if df[col].dtype != dtype
+        }
+
+    @classmethod
+    def apply(cls, df, columns=None):
+        return df.astype(cls.get_dtypes(df, columns=columns))
+
+    @staticmethod
+    def get_memory_usage(df):
+        return int(df.memory_usage(index=True, deep=True).sum())
@@ -15,7 +15,6 @@ Usage:
 
 import argparse
 import tempfile as tp
-import subprocess as sp
 import io
 import csv
 import textwrap
@@ -23,6 +22,7 @@ import re
 from itertools import groupby, chain
 from functools import partial
 from collections import namedtuple, deque
+from circmimi import trace
 
 
 class Blat:
@@ -37,7 +37,7 @@ class Blat:
     def _run(self, ref_file, fa_file):
         with tp.NamedTemporaryFile(dir=self.work_dir) as tmp_out:
             cmd = self._generate_cmd(ref_file, fa_file, tmp_out.name)
-            sp.run(cmd)
+            trace.run(cmd, inputs=[ref_file, fa_file], outputs=[tmp_out.name])
 
             result = BlatPsl(tmp_out.read().decode('utf-8'))
             return result
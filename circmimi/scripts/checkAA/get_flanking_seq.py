@@ -27,6 +27,7 @@ import re
 import tempfile as tp
 import subprocess as sp
 import logging
+from circmimi import trace
 
 
 logging.basicConfig(
@@ -144,7 +145,7 @@ def get_fasta(bed_file, ref_file, use_blocks=False, bedtools_bin='bedtools'):
     if use_blocks:
         cmd += ['-split']
 
-    res = sp.run(cmd, stdout=sp.PIPE, encoding='utf-8')
+    res = trace.run(cmd, inputs=[ref_file, bed_file], stdout=sp.PIPE, encoding='utf-8')
 
     return res.stdout
 
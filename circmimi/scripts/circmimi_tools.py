@@ -10,7 +10,10 @@ logger = logging.getLogger(__name__)
 @click.group()
 @click.version_option()
 @click.option('--debug', 'debug_mode', is_flag=True)
-def cli(debug_mode):
+@click.option('--trace-file', 'trace_file', metavar="TRACE_FILE",
+    help="Append a record of each call of the external tools to TRACE_FILE (JSON lines). "
+         "The same as setting the environment variable CIRCMIMI_TRACE_FILE.")
+def cli(debug_mode, trace_file):
     """
     A toolset for investigating the interactions between circRNA, miRNA, and mRNA.
     """
@@ -30,6 +33,61 @@ def cli(debug_mode):
     ch.setFormatter(formatter)
     root_logger.addHandler(ch)
 
+    if trace_file is not None:
+        from circmimi.trace import set_trace_file
+        set_trace_file(trace_file)
+
+
+def miranda_options(func):
+    options = [
+        click.option('--miranda-sc', 'sc', metavar='S', type=click.FLOAT, default=155, help='(Default: 155)'),
+        click.option('--miranda-en', 'en', metavar='-E', type=click.FLOAT, default=-20, help='(Default: -20)'),
+        click.option('--miranda-scale', 'scale', metavar='Z', type=click.FLOAT),
+        click.option('--miranda-strict', 'strict', is_flag=True),
+        click.option('--miranda-go', 'go', metavar='-X', type=click.FLOAT),
+        click.option('--miranda-ge', 'ge', metavar='-Y', type=click.FLOAT),
+        click.option('--miranda-batch-size', 'batch_size', metavar='N', type=click.IntRange(min=1),
+            help="Number of sequences per miRanda run. (Default: 100)"),
+        click.option('--miranda-timeout', 'timeout', metavar='SECONDS', type=click.FLOAT,
+            help="Time limit of each miRanda run. (Default: no limit)"),
+        click.option('--miranda-max-retries', 'max_retries', metavar='N', type=click.IntRange(min=0),
+            help="Number of retries of a failed miRanda run. (Default: 2)"),
+        click.option('--engine', 'engine', type=click.Choice(['miranda', 'seed']), default='miranda',
+            help="The engine for predicting the miRNA-binding sites. (Default: miranda)")
+    ]
+
+    for option in reversed(options):
+        func = option(func)
+
+    return func
+
+
+MIRANDA_RUN_OPTIONS = ('batch_size', 'timeout', 'max_retries')
+
+
+def get_miranda_options_list(miranda_options):
+    miranda_options_list = []
+    for k, v in miranda_options.items():
+        if k in MIRANDA_RUN_OPTIONS:
+            continue
+
+        if v is not None:
+            cmd = ['-' + k]
+            if k != 'strict':
+                cmd.append(str(v))
+
+            miranda_options_list.extend(cmd)
+
+    return miranda_options_list
+
+
+def get_miranda_run_options(miranda_options):
+    return {
+        k: v
+        for k, v in miranda_options.items()
+        if (k in MIRANDA_RUN_OPTIONS) and (v is not None)
+    }
+
 
 @cli.command('interactions')
 @click.option('-r', '--ref', 'ref_dir', type=click.Path(), metavar="REF_DIR", required=True)
@@ -41,18 +99,38 @@ def cli(debug_mode):
     help="Check if the circRNA has ambiguous alignments.", hidden=True)
 @click.option('--no-pvalue-filtering', 'pv_filter', flag_value=False, default=True,
     help="If this option is set, the results will contain all interactions without P-values filtering.")
-@click.option('--miranda-sc', 'sc', metavar='S', type=click.FLOAT, default=155, help='(Default: 155)')
-@click.option('--miranda-en', 'en', metavar='-E', type=click.FLOAT, default=-20, help='(Default: -20)')
-@click.option('--miranda-scale', 'scale', metavar='Z', type=click.FLOAT)
-@click.option('--miranda-strict', 'strict', is_flag=True)
-@click.option('--miranda-go', 'go', metavar='-X', type=click.FLOAT)
-@click.option('--miranda-ge', 'ge', metavar='-Y', type=click.FLOAT)
+@miranda_options
+@click.option('--exon-level', 'exon_level', is_flag=True,
+    help="Predict the miRNA-binding sites on the unique exons and junctions, and then assemble them for each isoform.")
+@click.option('--RBP', 'with_RBP', is_flag=True,
+    help="Also predict the circRNA-RBP-mRNA interactions. (The ref_dir must be generated with 'genref --with-RBP'.)")
+@click.option('--output-layout', 'output_layout', default='joined',
+    type=click.Choice(['joined', 'normalized', 'both']),
+    help="'joined': all_interactions.miRNA.tsv; 'normalized': the circRNA-miRNA and miRNA-target tables; 'both': all of them. (Default: joined)")
+@click.option('--output-format', 'output_format', default='tsv',
+    type=click.Choice(['tsv', 'parquet', 'feather']),
+    help="The format of the output tables. 'parquet' and 'feather' need pyarrow. (Default: tsv)")
+@click.option('--lean', 'lean', is_flag=True,
+    help="Release the intermediate tables as soon as they are used, and log the memory usage of each stage.")
+@click.option('--join-backend', 'join_backend', default='pandas',
+    type=click.Choice(['pandas', 'sqlite']),
+    help="'sqlite': join the final results on disk under the output directory, one part of the circRNAs at a time. (Default: pandas)")
+@click.option('--stats-json', 'stats_json', is_flag=True,
+    help="Save the time, CPU time, memory and row counts of each stage to 'run_stats.json'.")
 def predict_interactions(circ_file,
                          ref_dir,
                          out_prefix,
                          num_proc,
                          checkAA,
                          pv_filter,
+                         engine,
+                         exon_level,
+                         with_RBP,
+                         output_layout,
+                         output_format,
+                         lean,
+                         join_backend,
+                         stats_json,
                          **miranda_options):
 
     """
@@ -64,6 +142,16 @@ def predict_interactions(circ_file,
     logger.info('Preparing ...')
 
     from circmimi.utils import add_prefix
+    from circmimi.output import get_output_file, import_pyarrow, MissingDependencyError
+
+    if output_format != 'tsv':
+        try:
+            import_pyarrow(output_format)
+        except MissingDependencyError as e:
+            raise click.UsageError(str(e))
+
+    def get_out_file(filename):
+        return get_output_file(add_prefix(filename, out_prefix), output_format)
 
     output_dir = os.path.dirname(out_prefix)
     if output_dir == '':
@@ -75,19 +163,30 @@ def predict_interactions(circ_file,
     from circmimi.reference.config import get_refs
     anno_db, ref_file, mir_ref, mir_target, other_transcripts, AGO_data, RBP_data, RBP_target = get_refs(ref_dir)
 
+    if with_RBP:
+        if RBP_data is None:
+            raise click.UsageError(
+                "The RBP data are not found in {}. Please generate the references with 'genref --with-RBP'.".format(ref_dir)
+            )
+    else:
+        RBP_data = None
+        RBP_target = None
+
     if checkAA:
         other_ref_file = other_transcripts
     else:
         other_ref_file = None
 
-    miranda_options_list = []
-    for k, v in miranda_options.items():
-        if v is not None:
-            cmd = ['-' + k]
-            if k != 'strict':
-                cmd.append(str(v))
+    miranda_options_list = get_miranda_options_list(miranda_options)
 
-            miranda_options_list.extend(cmd)
+    from circmimi.reference.config import get_extra_ref
+
+    if exon_level:
+        binding_sites_file = get_extra_ref(ref_dir, 'binding_sites')
+    else:
+        binding_sites_file = None
+
+    mir_target_stats_file = get_extra_ref(ref_dir, 'mir_target_stats')
 
     from circmimi.circmimi import Circmimi
     circmimi_result = Circmimi(
@@ -102,7 +201,15 @@ def predict_interactions(circ_file,
         work_dir=output_dir,
         num_proc=num_proc,
         pv_filter=pv_filter,
-        miranda_options=miranda_options_list
+        miranda_options=miranda_options_list,
+        miranda_run_options=get_miranda_run_options(miranda_options),
+        engine=engine,
+        exon_level=exon_level,
+        binding_sites_file=binding_sites_file,
+        mir_target_stats_file=mir_target_stats_file,
+        normalized_output=(output_layout != 'joined'),
+        lean=lean,
+        join_backend=join_backend
     )
 
     logger.info('Starting the main pipeline.')
@@ -110,23 +217,42 @@ def predict_interactions(circ_file,
     logger.info('Pipeline completed.')
 
     logger.info('Saving results ...')
-    res_file = add_prefix('all_interactions.miRNA.tsv', out_prefix)
-    circmimi_result.save_result(res_file)
+    output_stage = circmimi_result.stats.start('output')
 
-    circ_target_pv_file = add_prefix('circRNA_target_gene.pvalue.tsv', out_prefix)
-    circmimi_result.circ_target_df_with_pv.to_csv(circ_target_pv_file, sep='\t', index=False)
+    if output_layout in ('joined', 'both'):
+        res_file = get_out_file('all_interactions.miRNA.tsv')
+        circmimi_result.save_result(res_file, format_=output_format)
+
+    if output_layout in ('normalized', 'both'):
+        circmimi_result.save_normalized_results(
+            get_out_file('circRNA_miRNA.tsv'),
+            get_out_file('miRNA_target.tsv'),
+            format_=output_format
+        )
+
+    circ_target_pv_file = get_out_file('circRNA_target_gene.pvalue.tsv')
+    circmimi_result.save_pvalue_result(circ_target_pv_file, format_=output_format)
 
     logger.info('miRNA part ... done')
 
-    # RBP_res_file = add_prefix('all_interactions.RBP.tsv', out_prefix)
-    # circmimi_result.save_RBP_result(RBP_res_file)
-    # logger.info('RBP part ... done')
+    if with_RBP:
+        RBP_res_file = get_out_file('all_interactions.RBP.tsv')
+        circmimi_result.save_RBP_result(RBP_res_file, format_=output_format)
+        logger.info('RBP part ... done')
 
-    summary_file = add_prefix('summary_list.tsv', out_prefix)
-    circmimi_result.save_circRNAs_summary(summary_file)
+    summary_file = get_out_file('summary_list.tsv')
+    circmimi_result.save_circRNAs_summary(summary_file, format_=output_format)
     logger.info('summary file ... done')
+
+    circmimi_result.close()
+    circmimi_result.stats.stop(output_stage)
     logger.info('All results are saved.')
 
+    if stats_json:
+        stats_file = add_prefix('run_stats.json', out_prefix)
+        circmimi_result.stats.save(stats_file)
+        logger.info('run statistics ... done')
+
     logger.info('Process completed.')
 
 
@@ -143,8 +269,15 @@ def predict_interactions(circ_file,
         The release version. If not specified, it will be automatically set to the latest version of the SOURCE.
     """)
 @click.option('--init', 'init', is_flag=True, help="Create an init template ref_dir.", hidden=True)
+@click.option('--binding-sites', 'binding_sites', is_flag=True,
+    help="Precompute the miRNA-binding sites of all annotated exons (with miRanda and the default parameters).")
+@click.option('--with-RBP', 'with_RBP', is_flag=True,
+    help="Also download the ENCORI RBP-binding sites and RBP targets for the RBP mode of 'interactions'.")
+@click.option('-p', '--num_proc', default=1, type=click.INT, metavar="NUM_PROC",
+    help="Number of processes")
 @click.argument('ref_dir')
-def generate_references(species, source, version, ref_dir, init):
+@click.pass_context
+def generate_references(ctx, species, source, version, ref_dir, init, binding_sites, with_RBP, num_proc):
     """
     Generate the references.                                          
 
@@ -161,13 +294,68 @@ def generate_references(species, source, version, ref_dir, init):
 
     if not init:
         from circmimi.reference import genref
-        info, ref_files = genref.generate(species, source, version, ref_dir)
+        info, ref_files = genref.generate(species, source, version, ref_dir, with_RBP=with_RBP)
 
         config['info'].update(info)
         config['refs'].update(ref_files)
 
     config.write(ref_dir)
 
+    if not init:
+        ctx.invoke(
+            generate_mir_target_stats,
+            ref_dir=ref_dir
+        )
+
+    if binding_sites and not init:
+        ctx.invoke(
+            generate_binding_sites,
+            ref_dir=ref_dir,
+            num_proc=num_proc
+        )
+
+
+@cli.command('gensites', hidden=True)
+@click.option('-r', '--ref', 'ref_dir', type=click.Path(), metavar="REF_DIR", required=True)
+@click.option('-p', '--num_proc', default=1, type=click.INT, metavar="NUM_PROC",
+    help="Number of processes")
+@miranda_options
+def generate_binding_sites(ref_dir, num_proc, engine, **miranda_options):
+    """
+    Precompute the miRNA-binding sites of all annotated exons.
+
+    The sites are reused by `interactions --exon-level` with the same
+    engine and parameters.
+    """
+
+    from circmimi.reference import gensites
+
+    logger.info('Predicting the miRNA-binding sites of all exons ...')
+    filename = gensites.generate(
+        ref_dir,
+        engine=engine,
+        miranda_options=get_miranda_options_list(miranda_options),
+        num_proc=num_proc,
+        miranda_run_options=get_miranda_run_options(miranda_options)
+    )
+    logger.info('The binding sites are saved in {}.'.format(filename))
+
+
+@cli.command('genstats', hidden=True)
+@click.option('-r', '--ref', 'ref_dir', type=click.Path(), metavar="REF_DIR", required=True)
+def generate_mir_target_stats(ref_dir):
+    """
+    Precompute the background counts of the miRNA-target genes.
+
+    The counts are used by the hypergeometric test of `interactions`.
+    """
+
+    from circmimi.reference import genstats
+
+    logger.info('Counting the miRNAs of the target genes ...')
+    filename = genstats.generate(ref_dir)
+    logger.info('The background counts are saved in {}.'.format(filename))
+
 
 @cli.command('gendb', hidden=True)
 @click.argument('gtf_path')
@@ -233,8 +421,8 @@ def check_annotation(circ_file, anno_db, out_file):
 @click.option('-p', '--num_proc', default=1, type=click.INT,
               metavar="NUM_PROC", help="Number of processes")
 def check_ambiguous(ref_file, other_ref_file, circ_file, out_file, num_proc):
-    import subprocess as sp
     import tempfile as tp
+    from circmimi import trace
 
     tmp_fa = tp.NamedTemporaryFile(
         dir='.',
@@ -242,9 +430,11 @@ def check_ambiguous(ref_file, other_ref_file, circ_file, out_file, num_proc):
         suffix='.fa'
     )
 
-    sp.run(['get_flanking_seq.py', ref_file, circ_file, tmp_fa.name])
-    sp.run(['checkAA_reads.py', '-rg', ref_file, '-ro', other_ref_file,
-            tmp_fa.name, out_file, '-p', str(num_proc)])
+    trace.run(['get_flanking_seq.py', ref_file, circ_file, tmp_fa.name],
+              inputs=[circ_file], outputs=[tmp_fa.name])
+    trace.run(['checkAA_reads.py', '-rg', ref_file, '-ro', other_ref_file,
+               tmp_fa.name, out_file, '-p', str(num_proc)],
+              inputs=[tmp_fa.name], outputs=[out_file])
 
 
 @check.command('RCS')
@@ -267,6 +457,7 @@ def check_RCS(ref_file,
               num_proc):
 
     import subprocess as sp
+    from circmimi import trace
 
     cmd1 = ['get_RCS.py', ref_file, circ_file, '--dist', dist, '-p', num_proc]
     cmd2 = ['RCS_filter.py', '-', '-m', min_matches, '-l', min_aln_len, '-b', min_bitscore]
@@ -277,9 +468,10 @@ def check_RCS(ref_file,
     cmd3 = [str(c) for c in cmd3]
 
     with open(out_file, 'w') as out:
-        p1 = sp.Popen(cmd1, stdout=sp.PIPE, encoding='UTF-8')
-        p2 = sp.Popen(cmd2, stdin=p1.stdout, stdout=sp.PIPE, encoding='UTF-8')
-        p3 = sp.Popen(cmd3, stdin=p2.stdout, stdout=out, encoding='UTF-8')
+        p1 = trace.TracedPopen(cmd1, inputs=[circ_file], stdout=sp.PIPE, encoding='UTF-8')
+        p2 = trace.TracedPopen(cmd2, stdin=p1.stdout, stdout=sp.PIPE, encoding='UTF-8')
+        p3 = trace.TracedPopen(cmd3, inputs=[circ_file], stdin=p2.stdout, stdout=out,
+                               outputs=[out_file], encoding='UTF-8')
 
         p1.wait()
         p2.wait()
@@ -531,7 +723,9 @@ def update_miRNAs(in_file, out_file, mapping_file, column_key, inplace, remove_d
 @click.option('--mir_ref_file')
 @click.option('--mir_target_file')
 @click.option('-o', '--out_prefix', default='./')
-def calculate_pvalue_of_interactions(interaction_file, out_prefix, mir_ref_file, mir_target_file):
+@click.option('--output-format', 'output_format', default='tsv',
+    type=click.Choice(['tsv', 'parquet', 'feather']))
+def calculate_pvalue_of_interactions(interaction_file, out_prefix, mir_ref_file, mir_target_file, output_format):
     """
     This command is used to calculate the P-value of the interaction between circRNA and target gene.
     """
@@ -539,6 +733,13 @@ def calculate_pvalue_of_interactions(interaction_file, out_prefix, mir_ref_file,
     import pandas as pd
     from circmimi.stats import do_the_hypergeometric_test
     from circmimi.circmimi import get_mir_target_db
+    from circmimi.output import get_output_file, write_table, import_pyarrow, MissingDependencyError
+
+    if output_format != 'tsv':
+        try:
+            import_pyarrow(output_format)
+        except MissingDependencyError as e:
+            raise click.UsageError(str(e))
 
     df = pd.read_csv(interaction_file, sep='\t', dtype='object')
     circ_mir_target_df = df[['circ_id', 'mirna', 'target_gene']].drop_duplicates().reset_index(drop=True)
@@ -551,7 +752,11 @@ def calculate_pvalue_of_interactions(interaction_file, out_prefix, mir_ref_file,
         mir_target_db
     )
 
-    circ_target_df_with_pv.to_csv(out_prefix + "circRNA_target_gene.pvalue.tsv", sep='\t', index=False)
+    write_table(
+        circ_target_df_with_pv,
+        get_output_file(out_prefix + "circRNA_target_gene.pvalue.tsv", output_format),
+        format_=output_format
+    )
 
     result_df = df.merge(
         circ_target_df_with_pv[[
@@ -565,7 +770,11 @@ def calculate_pvalue_of_interactions(interaction_file, out_prefix, mir_ref_file,
         how='left'
     )
 
-    result_df.to_csv(out_prefix + "all_interactions.miRNA.pvalue.tsv", sep='\t', index=False)
+    write_table(
+        result_df,
+        get_output_file(out_prefix + "all_interactions.miRNA.pvalue.tsv", output_format),
+        format_=output_format
+    )
 
 
 if __name__ == "__main__":
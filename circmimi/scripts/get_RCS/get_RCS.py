@@ -8,6 +8,7 @@ import multiprocessing as mp
 from collections import namedtuple
 from collections.abc import Iterable
 from operator import itemgetter
+from circmimi import trace
 
 
 Bed6 = namedtuple('Bed6', ('chr_', 'start', 'end', 'name', 'score', 'strand'))
@@ -21,7 +22,7 @@ def get_fasta(bed_file, ref_file, bedtools_bin='bedtools'):
     cmd += ['-s']
     # cmd += ['-name']
 
-    res = sp.run(cmd, stdout=sp.PIPE, encoding='utf-8')
+    res = trace.run(cmd, inputs=[ref_file, bed_file], stdout=sp.PIPE, encoding='utf-8')
 
     return res.stdout
 
@@ -35,7 +36,7 @@ def blastn(query, subject, blastn_bin='blastn'):
     cmd += ['-strand', 'minus']
     # cmd += ['-word_size', '11']
 
-    res = sp.run(cmd, stdout=sp.PIPE, encoding='utf-8')
+    res = trace.run(cmd, inputs=[query, subject], stdout=sp.PIPE, encoding='utf-8')
 
     return res.stdout
 
@@ -2,13 +2,13 @@
 from __future__ import print_function
 
 import argparse
-import subprocess as sp
 import os
 import sys
 import shutil
 import random
 import time
 import re
+from circmimi import trace
 
 
 def mp_blat(reference_file, fasta_file, output_file, num_of_process=1, tmp_path=".", blat_bin="blat", blat_opt=""):
@@ -17,7 +17,11 @@ def mp_blat(reference_file, fasta_file, output_file, num_of_process=1, tmp_path=
 
     if num_of_process == 1:
         # do blat directly
-        sp.call([blat_bin, reference_file, fasta_file, output_file] + blat_opt)
+        trace.call(
+            [blat_bin, reference_file, fasta_file, output_file] + blat_opt,
+            inputs=[reference_file, fasta_file],
+            outputs=[output_file]
+        )
     elif num_of_process > 1:
 
         # split file
@@ -106,7 +110,13 @@ def mp_blat(reference_file, fasta_file, output_file, num_of_process=1, tmp_path=
 
         proc = []
         for i in range(len(tmp_fa_files)):
-            proc.append(sp.Popen([blat_bin, reference_file, tmp_fa_files[i], tmp_res_files[i]] + blat_opt))
+            proc.append(
+                trace.TracedPopen(
+                    [blat_bin, reference_file, tmp_fa_files[i], tmp_res_files[i]] + blat_opt,
+                    inputs=[reference_file, tmp_fa_files[i]],
+                    outputs=[tmp_res_files[i]]
+                )
+            )
 
         for p in proc:
             p.wait()
@@ -0,0 +1,259 @@
+import numpy as np
+import pandas as pd
+from circmimi.miranda import Miranda
+from circmimi.seq import parse_fasta
+
+
+_BASES = np.frombuffer(b'ACGTN', dtype=np.uint8)
+
+_ENCODE_TABLE = np.full(256, 4, dtype=np.uint8)
+for _code, _bases in enumerate([b'Aa', b'Cc', b'Gg', b'TtUu']):
+    _ENCODE_TABLE[np.frombuffer(_bases, dtype=np.uint8)] = _code
+
+
+class SeedMatcher:
+    """Canonical seed-match prediction of miRNA-binding sites.
+
+    The miRNA seed (positions 2-7) is searched on the targets as a 6mer core,
+    and then extended to the canonical site types by checking the match of
+    position 8 (m8) and the 'A' opposite to position 1 (A1).
+
+    The results are reported with the columns of `Miranda.RESULT_TITLE`,
+    where 'score' is the rank of the site type (8mer: 4, 7mer-m8: 3,
+    7mer-A1: 2, 6mer: 1) and 'energy' is not available (NaN).
+    """
+
+    name = 'seed'
+
+    SITE_TYPES = ('8mer', '7mer-m8', '7mer-A1', '6mer')
+    SITE_SCORES = {
+        '8mer': 4.0,
+        '7mer-m8': 3.0,
+        '7mer-A1': 2.0,
+        '6mer': 1.0
+    }
+
+    # (m8, A1) of each site type
+    _SITE_FLAGS = {
+        '8mer': (1, 1),
+        '7mer-m8': (1, 0),
+        '7mer-A1': (0, 1),
+        '6mer': (0, 0)
+    }
+
+    _CORE_LEN = 6
+
+    # (the longest site, the flanking length needed to call a site)
+    site_span = (8, 1)
+
+    def __init__(self,
+                 mir_ref_file,
+                 work_dir='.',
+                 num_proc=1,
+                 options=None,
+                 run_options=None,
+                 site_types=SITE_TYPES):
+
+        self.mir_ref_file = mir_ref_file
+        self.work_dir = work_dir
+        self.num_proc = num_proc
+        self.site_types = site_types
+
+        with open(mir_ref_file) as fa_in:
+            mir_df = pd.DataFrame(
+                parse_fasta(fa_in.read()),
+                columns=['name', 'seq']
+            )
+
+        self._mir_names = mir_df['name'].values
+        self._mir_bases = self._encode_mirnas(mir_df['seq'])
+
+    @staticmethod
+    def _encode_mirnas(mir_seqs):
+        mir_bases = np.full((len(mir_seqs), 8), 4, dtype=np.uint8)
+
+        for idx, seq in enumerate(mir_seqs):
+            bases = _encode(seq[:8])
+            mir_bases[idx, :len(bases)] = bases
+
+        return mir_bases
+
+    @classmethod
+    def _kmer_codes(cls, bases, k):
+        num_kmers = max(len(bases) - k + 1, 0)
+        codes = np.zeros(num_kmers, dtype=np.int32)
+        invalid = np.zeros(num_kmers, dtype=bool)
+
+        for i in range(k):
+            window = bases[i:(i + num_kmers)]
+            codes = codes * 4 + np.minimum(window, 3)
+            invalid |= (window == 4)
+
+        codes[invalid] = -1
+
+        return codes
+
+    def _get_core_codes(self):
+        # the 6mer core on the target is the reverse complement of the
+        # miRNA positions 2-7.
+        core = 3 - self._mir_bases[:, 6:0:-1]
+        invalid = (self._mir_bases[:, 1:7] == 4).any(axis=1)
+
+        codes = np.zeros(len(core), dtype=np.int32)
+        for i in range(self._CORE_LEN):
+            codes = codes * 4 + core[:, i]
+
+        codes[invalid] = -1
+
+        return codes
+
+    @staticmethod
+    def _concat_seqs(seqs):
+        seq_lens = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        seq_offsets = np.concatenate([[0], np.cumsum(seq_lens + 1)])[:-1]
+        all_seq = 'N'.join(seqs)
+        return all_seq, seq_offsets, seq_lens
+
+    def _find_cores(self, target_codes):
+        mir_codes = self._get_core_codes()
+        num_codes = 4 ** self._CORE_LEN
+
+        valid_mirs = np.flatnonzero(mir_codes >= 0)
+        valid_mirs = valid_mirs[np.argsort(mir_codes[valid_mirs], kind='stable')]
+        code_counts = np.bincount(mir_codes[valid_mirs], minlength=num_codes)
+        code_starts = np.concatenate([[0], np.cumsum(code_counts)])[:-1]
+
+        positions = np.flatnonzero(target_codes >= 0)
+        num_hits_per_pos = code_counts[target_codes[positions]]
+
+        positions = positions[num_hits_per_pos > 0]
+        num_hits_per_pos = num_hits_per_pos[num_hits_per_pos > 0]
+
+        hit_pos = np.repeat(positions, num_hits_per_pos)
+        hit_rank = np.arange(len(hit_pos)) - np.repeat(
+            np.cumsum(num_hits_per_pos) - num_hits_per_pos,
+            num_hits_per_pos
+        )
+        hit_mir = valid_mirs[code_starts[target_codes[hit_pos]] + hit_rank]
+
+        return hit_pos, hit_mir
+
+    def predict(self, seq_df):
+        if seq_df.empty:
+            return pd.DataFrame([], columns=Miranda.RESULT_TITLE).astype(
+                Miranda.RESULT_DTYPES
+            )
+
+        ref_names = seq_df['name'].values
+        all_seq, seq_offsets, seq_lens = self._concat_seqs(list(seq_df['seq']))
+        bases = _encode(all_seq)
+        target_codes = self._kmer_codes(bases, self._CORE_LEN)
+
+        hit_pos, hit_mir = self._find_cores(target_codes)
+
+        hit_ref = np.searchsorted(seq_offsets, hit_pos, side='right') - 1
+        core_start = hit_pos - seq_offsets[hit_ref]
+        core_end = core_start + self._CORE_LEN
+
+        # m8: the base before the core pairs with the miRNA position 8
+        # A1: the base after the core is an 'A'
+        has_prev = core_start > 0
+        has_next = core_end < seq_lens[hit_ref]
+        prev_base = bases[np.where(has_prev, hit_pos - 1, hit_pos)]
+        next_base = bases[np.where(has_next, hit_pos + self._CORE_LEN, hit_pos)]
+
+        m8_base = self._mir_bases[hit_mir, 7]
+        m8 = (has_prev & (m8_base != 4) & (prev_base == 3 - m8_base)).astype(int)
+        a1 = (has_next & (next_base == 0)).astype(int)
+
+        site_types = self._get_site_types(m8, a1)
+
+        selected = np.isin(site_types, self.site_types)
+        order = np.lexsort((
+            core_start[selected],
+            hit_mir[selected],
+            hit_ref[selected]
+        ))
+        selected = np.flatnonzero(selected)[order]
+
+        hit_pos = hit_pos[selected]
+        hit_mir = hit_mir[selected]
+        hit_ref = hit_ref[selected]
+        core_start = core_start[selected]
+        site_types = site_types[selected]
+        m8 = m8[selected]
+        a1 = a1[selected]
+
+        site_len = self._CORE_LEN + m8 + a1
+        num_paired = self._CORE_LEN + m8
+
+        aln_mirna = np.empty(len(selected), dtype=object)
+        aln_map = np.empty(len(selected), dtype=object)
+        aln_utr = np.empty(len(selected), dtype=object)
+
+        for is_m8, is_a1 in self._SITE_FLAGS.values():
+            in_group = (m8 == is_m8) & (a1 == is_a1)
+            (
+                aln_mirna[in_group],
+                aln_map[in_group],
+                aln_utr[in_group]
+            ) = self._get_alignments(
+                bases,
+                hit_pos[in_group],
+                hit_mir[in_group],
+                is_m8,
+                is_a1
+            )
+
+        sites_df = pd.DataFrame({
+            'query_id': self._mir_names[hit_mir],
+            'reference_id': ref_names[hit_ref],
+            'score': pd.Series(site_types).map(self.SITE_SCORES).values,
+            'energy': np.nan,
+            'query_start': 2 - a1,
+            'query_end': 7 + m8,
+            'ref_start': core_start - m8 + 1,
+            'ref_end': core_start + self._CORE_LEN + a1,
+            'aln_length': site_len,
+            'identity': 100.0 * num_paired / site_len,
+            'similarity': 100.0 * num_paired / site_len,
+            'aln_mirna': aln_mirna,
+            'aln_map': aln_map,
+            'aln_utr': aln_utr
+        }, columns=Miranda.RESULT_TITLE).astype(Miranda.RESULT_DTYPES)
+
+        return sites_df
+
+    @classmethod
+    def _get_site_types(cls, m8, a1):
+        site_type_table = np.empty((2, 2), dtype=object)
+        for site_type, (is_m8, is_a1) in cls._SITE_FLAGS.items():
+            site_type_table[is_m8, is_a1] = site_type
+
+        return site_type_table[m8, a1]
+
+    def _get_alignments(self, bases, hit_pos, hit_mir, is_m8, is_a1):
+        site_len = self._CORE_LEN + is_m8 + is_a1
+
+        # the miRNA is shown from 3' to 5', so that it is aligned to the
+        # target site shown from 5' to 3'.
+        query_start = 2 - is_a1
+        query_end = 7 + is_m8
+        mir_cols = np.arange(query_end - 1, query_start - 2, -1)
+        aln_mirna = _to_strings(self._mir_bases[hit_mir][:, mir_cols])
+
+        aln_map = '|' * (self._CORE_LEN + is_m8) + ' ' * is_a1
+
+        utr_idx = (hit_pos - is_m8)[:, None] + np.arange(site_len)
+        aln_utr = _to_strings(bases[utr_idx])
+
+        return aln_mirna, aln_map, aln_utr
+
+
+def _encode(seq):
+    return _ENCODE_TABLE[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+
+
+def _to_strings(codes):
+    chars = _BASES[codes]
+    return np.ascontiguousarray(chars).view(f'S{chars.shape[1]}').ravel().astype(str)
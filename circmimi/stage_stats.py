@@ -0,0 +1,145 @@
+import os
+import time
+import json
+from circmimi import __version__, trace
+from circmimi.utils import get_memory_usage
+
+
+class StageRecord:
+    def __init__(self, name):
+        self.name = name
+        self.rows_in = None
+        self.rows_out = None
+
+        self.wall_time = None
+        self.cpu_time = None
+        self.children_cpu_time = None
+        self.peak_rss = None
+        self.peak_rss_delta = None
+        self.bytes_written = None
+        self.children_output_bytes = None
+
+        self._start = None
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'children_cpu_time': self.children_cpu_time,
+            'peak_rss': self.peak_rss,
+            'peak_rss_delta': self.peak_rss_delta,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'bytes_written': self.bytes_written,
+            'children_output_bytes': self.children_output_bytes
+        }
+
+
+class StageStats:
+    """Wall time, CPU time, peak RSS and row counts of the pipeline stages.
+
+    The CPU time of the subprocesses (miRanda, bedtools, BLAT, ...) is
+    counted separately as `children_cpu_time`. `bytes_written` is the
+    number of bytes written by the CircMiMi process only, including the
+    temporary files, and is only available on Linux. The files written by
+    the subprocesses are counted in `children_output_bytes`, as the sizes
+    of their outputs recorded by `trace`.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    @staticmethod
+    def _get_bytes_written():
+        try:
+            with open('/proc/self/io') as f:
+                for line in f:
+                    key, value = line.split(':')
+                    if key == 'wchar':
+                        return int(value)
+        except (OSError, ValueError):
+            pass
+
+        return None
+
+    @staticmethod
+    def _delta(end, start):
+        if (start is None) or (end is None):
+            return None
+
+        return end - start
+
+    def start(self, name, rows_in=None):
+        record = StageRecord(name)
+        record.rows_in = rows_in
+
+        record._start = (
+            os.times(),
+            time.perf_counter(),
+            get_memory_usage()[1],
+            self._get_bytes_written(),
+            trace.get_output_bytes()
+        )
+
+        return record
+
+    def stop(self, record, rows_out=None):
+        times_start, wall_start, peak_rss_start, bytes_written_start, \
+            output_bytes_start = record._start
+
+        times_end = os.times()
+        peak_rss_end = get_memory_usage()[1]
+
+        record.rows_out = rows_out
+        record.wall_time = round(time.perf_counter() - wall_start, 6)
+        record.cpu_time = round(
+            (times_end.user + times_end.system) -
+            (times_start.user + times_start.system),
+            6
+        )
+        record.children_cpu_time = round(
+            (times_end.children_user + times_end.children_system) -
+            (times_start.children_user + times_start.children_system),
+            6
+        )
+        record.peak_rss = peak_rss_end
+        record.peak_rss_delta = self._delta(peak_rss_end, peak_rss_start)
+        record.bytes_written = self._delta(
+            self._get_bytes_written(),
+            bytes_written_start
+        )
+        record.children_output_bytes = trace.get_output_bytes() - output_bytes_start
+
+        self.records.append(record)
+
+        return record
+
+    def get_total(self):
+        def get_sum(key):
+            values = [getattr(record, key) for record in self.records]
+
+            if any(value is None for value in values):
+                return None
+
+            return round(sum(values), 6)
+
+        return {
+            'wall_time': get_sum('wall_time'),
+            'cpu_time': get_sum('cpu_time'),
+            'children_cpu_time': get_sum('children_cpu_time'),
+            'peak_rss': get_memory_usage()[1],
+            'bytes_written': get_sum('bytes_written'),
+            'children_output_bytes': get_sum('children_output_bytes')
+        }
+
+    def to_dict(self):
+        return {
+            'circmimi_version': __version__,
+            'stages': [record.to_dict() for record in self.records],
+            'total': self.get_total()
+        }
+
+    def save(self, out_file):
+        with open(out_file, 'w') as json_out:
+            json.dump(self.to_dict(), json_out, indent=2)
@@ -1,7 +1,9 @@
+import os
 import re
 import numpy as np
+import pandas as pd
+from scipy import sparse
 from scipy.stats import hypergeom
-from statsmodels.stats import multitest
 from operator import itemgetter
 
 
@@ -13,82 +15,315 @@ def _count_miRNAs(mir_ref_file):
     return num_miRNAs
 
 
-def _calc_hypergeom_pvalue(s, rvs_dict):
-    k = s['#miRNAs_share']
-    M = s['#miRNAs']
-    n = s['#miRNAs_target_gene']
-    N = s['#miRNAs_circRNAs']
+class MiRNATargetBackground:
+    """Background counts of the hypergeometric test.
 
-    rv = rvs_dict[(M, n, N)]
-    x = np.arange(k, min(n, N))
-    pvalue = rv.pmf(x).sum()
+    The number of miRNAs in the miRNA reference and the number of miRNAs
+    of each target gene only depend on the reference files, so they can
+    be precomputed into a small npz file, with the target genes sorted for
+    the lookup.
+    """
 
-    return pvalue
+    def __init__(self, num_miRNAs, target_genes, num_miRNAs__target_gene, meta=None):
+        self.num_miRNAs = num_miRNAs
+        self.target_genes = target_genes
+        self.num_miRNAs__target_gene = num_miRNAs__target_gene
+        self.meta = meta or {}
+
+    @staticmethod
+    def get_meta(mir_ref_file, mir_target_file):
+        meta = {
+            'mir_ref': os.path.basename(mir_ref_file),
+            'mir_ref_size': str(os.path.getsize(mir_ref_file)),
+            'mir_target': os.path.basename(mir_target_file),
+            'mir_target_size': str(os.path.getsize(mir_target_file))
+        }
+
+        return meta
+
+    def is_compatible(self, meta):
+        return self.meta == meta
+
+    @classmethod
+    def build(cls, mir_ref_file, mir_target_db, meta=None):
+        num_miRNAs__target_gene = mir_target_db[[
+            'target_gene',
+            'mirna'
+        ]].drop_duplicates().groupby('target_gene', observed=True)['mirna'].count()
+
+        return cls(
+            _count_miRNAs(mir_ref_file),
+            num_miRNAs__target_gene.index.values.astype(str),
+            num_miRNAs__target_gene.values.astype(np.int64),
+            meta=meta
+        )
+
+    def get_num_miRNAs__target_gene(self, target_genes):
+        """
+        The counts of the target genes, with NaN for the genes which are
+        not in the background (e.g. the interactions from another database).
+        """
+        target_genes = np.asarray(target_genes)
+
+        if len(self.target_genes) == 0:
+            return np.full(len(target_genes), np.nan)
+
+        idx = np.searchsorted(self.target_genes, target_genes).clip(
+            max=len(self.target_genes) - 1
+        )
+        is_found = self.target_genes[idx] == target_genes
+
+        if is_found.all():
+            return self.num_miRNAs__target_gene[idx]
+
+        return np.where(is_found, self.num_miRNAs__target_gene[idx], np.nan)
+
+    def save(self, stats_file):
+        arrays = {
+            'num_miRNAs': np.array(self.num_miRNAs),
+            'target_genes': self.target_genes,
+            'num_miRNAs__target_gene': self.num_miRNAs__target_gene
+        }
+
+        for key, value in self.meta.items():
+            arrays[f'meta_{key}'] = np.array(value)
+
+        with open(stats_file, 'wb') as out:
+            np.savez_compressed(out, **arrays)
+
+    @classmethod
+    def load(cls, stats_file):
+        with np.load(stats_file) as data:
+            meta = {
+                key[len('meta_'):]: str(data[key])
+                for key in data.files
+                if key.startswith('meta_')
+            }
+
+            return cls(
+                int(data['num_miRNAs']),
+                data['target_genes'],
+                data['num_miRNAs__target_gene'],
+                meta=meta
+            )
+
+
+def _calc_hypergeom_pvalues(k, M, n, N):
+    # P(k <= X < min(n, N)), i.e. the sum of pmf over np.arange(k, min(n, N))
+    upper = np.minimum(n, N)
+    upper_tail = hypergeom.sf(k - 1, M, n, N)
+    sf_pvalues = upper_tail - hypergeom.pmf(upper, M, n, N)
+
+    # take the lower tail if the upper one is close to 1, which would leave
+    # only the rounding error of the subtraction
+    cdf_pvalues = hypergeom.cdf(upper - 1, M, n, N) - hypergeom.cdf(k - 1, M, n, N)
+    pvalues = np.where(upper_tail > 0.5, cdf_pvalues, sf_pvalues)
+    pvalues = np.where(k < upper, np.clip(pvalues, 0, None), 0.0)
+
+    return pvalues
 
 
 def do_the_calculation_for_hypergeom_pvalue(circ_target_df):
-    all_M_n_N = circ_target_df[[
+    k_M_n_N_df = circ_target_df[[
+        '#miRNAs_share',
         '#miRNAs',
         '#miRNAs_target_gene',
         '#miRNAs_circRNAs'
-    ]].drop_duplicates().values
-
-    all_M_n_N_tuple = [tuple(row) for row in all_M_n_N]
+    ]]
 
-    rvs = np.apply_along_axis(lambda row: hypergeom(*row), 1, all_M_n_N)
-    rvs_dict = dict(zip(all_M_n_N_tuple, rvs))
+    # the pairs with a target gene missing from the background get NaN
+    is_counted = k_M_n_N_df.notna().all(axis=1).values
+    all_k_M_n_N = k_M_n_N_df.values[is_counted].astype(np.int64)
+    p_values = np.full(len(circ_target_df), np.nan)
 
-    p_values = circ_target_df.apply(_calc_hypergeom_pvalue, rvs_dict=rvs_dict, axis=1)
+    if len(all_k_M_n_N) > 0:
+        # only the distinct (k, M, n, N) need to be evaluated
+        uniq_k_M_n_N, inverse_idx = np.unique(all_k_M_n_N, axis=0, return_inverse=True)
+        p_values[is_counted] = _calc_hypergeom_pvalues(*uniq_k_M_n_N.T)[inverse_idx.ravel()]
 
     circ_target_df_with_pv = circ_target_df.assign(p_value=p_values)
 
     return circ_target_df_with_pv
 
 
-def do_the_hypergeometric_test(circ_mi_target_df, mir_ref_file, mir_target_db):
-    num_miRNAs = _count_miRNAs(mir_ref_file)
-    num_miRNAs__circRNA = circ_mi_target_df[['circ_id', 'mirna']].drop_duplicates().groupby('circ_id').agg('count')
-    num_miRNAs__circRNA_target_gene = circ_mi_target_df.groupby(['circ_id', 'target_gene']).agg('count')
-    num_miRNAs__target_gene = mir_target_db[['target_gene', 'mirna']].drop_duplicates().groupby('target_gene').agg('count')
-
-    circ_target_df = num_miRNAs__circRNA_target_gene.reset_index().rename(
-        {
-            'mirna': '#miRNAs_share'
-        },
-        axis=1
-    ).merge(
-        num_miRNAs__circRNA,
-        on='circ_id',
-        how='left'
-    ).rename(
-        {
-            'mirna': '#miRNAs_circRNAs'
-        },
-        axis=1
-    ).assign(
-        **{
-            '#miRNAs': num_miRNAs
-        }
-    ).merge(
-        num_miRNAs__target_gene,
-        on='target_gene',
-        how='left'
-    ).rename(
-        {
-            'mirna': '#miRNAs_target_gene'
-        },
-        axis=1
+def _adjust_pvalues_by_group(pvalues, groups):
+    """
+    Benjamini-Hochberg and Bonferroni corrections within each group,
+    the same as statsmodels' multipletests with 'fdr_bh' and 'bonferroni'.
+    """
+    group_codes = pd.factorize(groups)[0]
+
+    # the NaN p-values are not counted, and are sorted after the others
+    group_sizes = np.bincount(
+        group_codes,
+        weights=~np.isnan(pvalues)
+    ).astype(np.int64)[group_codes]
+
+    bonferroni_pvalues = np.minimum(pvalues * group_sizes, 1)
+
+    # sort by (group, p-value), then take the cumulative minima from the
+    # largest p-value of each group
+    order = np.lexsort((pvalues, group_codes))
+    sorted_codes = group_codes[order]
+    sorted_sizes = group_sizes[order]
+
+    group_offsets = np.r_[0, np.flatnonzero(np.diff(sorted_codes)) + 1]
+    ranks = np.arange(1, len(order) + 1) - np.repeat(
+        group_offsets,
+        np.diff(np.r_[group_offsets, len(order)])
     )
 
+    bh_raw = pvalues[order] / (ranks / sorted_sizes)
+    bh_sorted = pd.Series(
+        bh_raw[::-1]
+    ).groupby(
+        sorted_codes[::-1]
+    ).cummin(
+    ).values[::-1]
+
+    bh_pvalues = np.empty_like(bh_sorted)
+    bh_pvalues[order] = np.minimum(bh_sorted, 1)
+
+    return bh_pvalues, bonferroni_pvalues
+
+
+def _get_binary_matrix(row_values, col_values, rows, cols):
+    row_idx = rows.get_indexer(row_values)
+    col_idx = cols.get_indexer(col_values)
+
+    binary_matrix = sparse.csr_matrix(
+        (
+            np.ones(len(row_idx), dtype=np.int64),
+            (row_idx, col_idx)
+        ),
+        shape=(len(rows), len(cols))
+    )
+
+    return binary_matrix
+
+
+def _get_share_matrix_from_db(circ_mirna_df, mir_target_db):
+    """
+    The product of the circRNA x miRNA and the miRNA x target gene binding
+    matrices. Only the miRNAs with any target gene are counted for the
+    circRNAs.
+    """
+    circ_mirna_pairs = circ_mirna_df[['circ_id', 'mirna']].drop_duplicates()
+
+    mir_target_pairs = mir_target_db.loc[
+        mir_target_db['mirna'].isin(circ_mirna_pairs['mirna'].unique()),
+        ['mirna', 'target_gene']
+    ].dropna().drop_duplicates()
+    mirnas = pd.Index(mir_target_pairs['mirna'].unique())
+    target_genes = pd.Index(np.sort(mir_target_pairs['target_gene'].unique()))
+
+    circ_mirna_pairs = circ_mirna_pairs[circ_mirna_pairs['mirna'].isin(mirnas)]
+    circ_ids = pd.Index(np.sort(circ_mirna_pairs['circ_id'].unique()))
+
+    circ_mirna_matrix = _get_binary_matrix(
+        circ_mirna_pairs['circ_id'],
+        circ_mirna_pairs['mirna'],
+        circ_ids,
+        mirnas
+    )
+    mir_target_matrix = _get_binary_matrix(
+        mir_target_pairs['mirna'],
+        mir_target_pairs['target_gene'],
+        mirnas,
+        target_genes
+    )
+
+    share_matrix = circ_mirna_matrix @ mir_target_matrix
+    num_miRNAs__circRNA = np.asarray(circ_mirna_matrix.sum(axis=1)).ravel()
+
+    return circ_ids, target_genes, share_matrix, num_miRNAs__circRNA
+
+
+def _get_share_matrix_from_interactions(circ_mir_target_df):
+    """
+    The circRNA x target gene counts of the given circRNA-miRNA-target gene
+    interactions, so that only the interactions in the table are counted.
+    """
+    circ_mirna_pairs = circ_mir_target_df[['circ_id', 'mirna']].dropna().drop_duplicates()
+    circ_mir_target_df = circ_mir_target_df[
+        ['circ_id', 'mirna', 'target_gene']
+    ].dropna().drop_duplicates()
+
+    circ_ids = pd.Index(np.sort(circ_mirna_pairs['circ_id'].unique()))
+    target_genes = pd.Index(np.sort(circ_mir_target_df['target_gene'].unique()))
+
+    share_matrix = _get_binary_matrix(
+        circ_mir_target_df['circ_id'],
+        circ_mir_target_df['target_gene'],
+        circ_ids,
+        target_genes
+    )
+    num_miRNAs__circRNA = np.bincount(
+        circ_ids.get_indexer(circ_mirna_pairs['circ_id']),
+        minlength=len(circ_ids)
+    )
+
+    return circ_ids, target_genes, share_matrix, num_miRNAs__circRNA
+
+
+def _get_circ_target_counts(circ_mirna_df, mir_target_db, background):
+    """
+    Count the miRNAs shared by each circRNA and target gene. If the table
+    has the 'target_gene' column, only its interactions are counted,
+    otherwise all target genes of the miRNAs are taken from the database.
+    """
+    if 'target_gene' in circ_mirna_df.columns:
+        circ_ids, target_genes, share_matrix, num_miRNAs__circRNA = \
+            _get_share_matrix_from_interactions(circ_mirna_df)
+    else:
+        circ_ids, target_genes, share_matrix, num_miRNAs__circRNA = \
+            _get_share_matrix_from_db(circ_mirna_df, mir_target_db)
+
+    share_matrix.sort_indices()
+    share_matrix = share_matrix.tocoo()
+
+    num_miRNAs__target_gene = background.get_num_miRNAs__target_gene(
+        target_genes.values.astype(str)
+    )
+    if np.isnan(num_miRNAs__target_gene).any():
+        num_miRNAs__target_gene = pd.array(num_miRNAs__target_gene, dtype='Int64')
+
+    circ_target_df = pd.DataFrame({
+        'circ_id': circ_ids.values[share_matrix.row],
+        'target_gene': target_genes.values[share_matrix.col],
+        '#miRNAs_share': share_matrix.data.astype(np.int64),
+        '#miRNAs_circRNAs': num_miRNAs__circRNA[share_matrix.row].astype(np.int64),
+        '#miRNAs_target_gene': num_miRNAs__target_gene[share_matrix.col],
+        '#miRNAs': background.num_miRNAs
+    })
+
+    return circ_target_df
+
+
+def do_the_hypergeometric_test(circ_mirna_df, mir_ref_file, mir_target_db, background=None):
+    if background is None:
+        background = MiRNATargetBackground.build(mir_ref_file, mir_target_db)
+
+    circ_target_df = _get_circ_target_counts(
+        circ_mirna_df,
+        mir_target_db,
+        background
+    )[[
+        'circ_id',
+        'target_gene',
+        '#miRNAs_share',
+        '#miRNAs_circRNAs',
+        '#miRNAs',
+        '#miRNAs_target_gene'
+    ]]
+
     # do the test
     circ_target_df_with_pv = do_the_calculation_for_hypergeom_pvalue(circ_target_df)
 
     # adjusting p-values
-    bonferroni_corrected_p_values = circ_target_df_with_pv.groupby('circ_id')['p_value'].transform(
-        lambda pvs: multitest.multipletests(pvs, method='bonferroni')[1]
-    )
-    bh_corrected_p_values = circ_target_df_with_pv.groupby('circ_id')['p_value'].transform(
-        lambda pvs: multitest.multipletests(pvs, method='fdr_bh')[1]
+    bh_corrected_p_values, bonferroni_corrected_p_values = _adjust_pvalues_by_group(
+        circ_target_df_with_pv['p_value'].values,
+        circ_target_df_with_pv['circ_id'].values
     )
 
     circ_target_df_with_pv = circ_target_df_with_pv.assign(
@@ -0,0 +1,261 @@
+import os
+import sys
+import time
+import json
+import locale
+import threading
+import subprocess as sp
+
+
+TRACE_FILE_ENV = 'CIRCMIMI_TRACE_FILE'
+
+_write_lock = threading.Lock()
+
+_output_bytes = 0
+_output_bytes_lock = threading.Lock()
+
+
+def get_trace_file():
+    return os.environ.get(TRACE_FILE_ENV) or None
+
+
+def set_trace_file(trace_file):
+    """Trace the external tools to `trace_file`, including the ones launched
+    by the helper scripts, which inherit the environment variable."""
+    os.environ[TRACE_FILE_ENV] = os.path.abspath(trace_file)
+
+
+def _get_files_size(files):
+    total_size = 0
+
+    for file_ in files:
+        try:
+            total_size += os.path.getsize(file_)
+        except (OSError, TypeError):
+            pass
+
+    return total_size
+
+
+def _get_returncode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    else:
+        return os.WEXITSTATUS(status)
+
+
+def _get_stdout_size(stdout, encoding=None, errors=None):
+    if stdout is None:
+        return 0
+
+    # the size of the text output is that of its encoded bytes
+    if isinstance(stdout, str):
+        if encoding is None:
+            encoding = locale.getpreferredencoding(False)
+
+        stdout = stdout.encode(encoding, errors or 'strict')
+
+    return len(stdout)
+
+
+def get_output_bytes():
+    """The total `output_bytes` of the finished tools launched by this
+    process, whether they are traced or not."""
+    return _output_bytes
+
+
+def _add_output_bytes(num_bytes):
+    global _output_bytes
+
+    with _output_bytes_lock:
+        _output_bytes += num_bytes
+
+
+def write_trace_record(record, trace_file=None):
+    if trace_file is None:
+        trace_file = get_trace_file()
+
+    if trace_file is None:
+        return
+
+    line = json.dumps(record) + '\n'
+
+    with _write_lock:
+        with open(trace_file, 'a') as trace_out:
+            trace_out.write(line)
+
+
+class TracedPopen(sp.Popen):
+    """`subprocess.Popen` which records the call to the trace file.
+
+    The process is reaped by `os.wait4` in `wait` and `poll`, which also
+    gives its resource usage, so that `max_rss`, `user_time` and `sys_time`
+    are of this process only (and its waited-for children, e.g. the
+    processes of mp_blat.py). On Linux, the high-water mark of the RSS is carried over
+    the fork, so `max_rss` is at least the RSS of the parent process when
+    the tool is launched. The sizes of the `inputs` and `outputs` files are
+    recorded as `input_bytes` and `output_bytes`. The `start` and `end`
+    timestamps show whether the parallel launches overlap.
+
+    Nothing is recorded if no trace file is set, but the `output_bytes` are
+    always added to `get_output_bytes()`.
+    """
+
+    def __init__(self, args, inputs=(), outputs=(), **kwargs):
+        self.trace_file = get_trace_file()
+        self.trace_outputs = list(outputs)
+        self.trace_record = None
+        self.defer_trace = False
+        self._outputs_counted = False
+
+        if self.trace_file is not None:
+            self._trace_input_bytes = _get_files_size(inputs)
+
+        self._trace_start = time.time()
+        self._trace_wall_start = time.perf_counter()
+
+        super().__init__(args, **kwargs)
+
+    def _is_traced(self):
+        return (self.trace_file is not None) and hasattr(os, 'wait4')
+
+    def _wait4(self, options):
+        """Reap the process with `os.wait4`, and return False if it is still
+        running."""
+        try:
+            pid, status, rusage = os.wait4(self.pid, options)
+        except ChildProcessError:
+            # already reaped, which is then left to `subprocess.Popen`
+            return True
+
+        if pid != self.pid:
+            return False
+
+        self.returncode = _get_returncode(status)
+        self._set_trace_record(status, rusage)
+
+        return True
+
+    def _finish(self, returncode):
+        if (returncode is not None) and (not self.defer_trace):
+            self.write_trace()
+
+        return returncode
+
+    def poll(self):
+        # a running process is not polled again by `subprocess.Popen`, which
+        # would reap it without the resource usage if it just exited
+        if self._is_traced() and (self.returncode is None) and \
+                (not self._wait4(os.WNOHANG)):
+            return None
+
+        return self._finish(super().poll())
+
+    def wait(self, timeout=None):
+        if self._is_traced() and (self.returncode is None):
+            if timeout is None:
+                self._wait4(0)
+            else:
+                end_time = time.monotonic() + timeout
+                delay = 0.0005
+
+                while not self._wait4(os.WNOHANG):
+                    remaining = end_time - time.monotonic()
+                    if remaining <= 0:
+                        raise sp.TimeoutExpired(self.args, timeout)
+
+                    time.sleep(min(delay, remaining))
+                    delay = min(delay * 2, 0.05)
+
+        return self._finish(super().wait(timeout=timeout))
+
+    def _set_trace_record(self, status, rusage):
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        max_rss = rusage.ru_maxrss
+        if sys.platform != 'darwin':
+            max_rss *= 1024
+
+        args = self.args
+        if isinstance(args, (str, bytes, os.PathLike)):
+            args = [args]
+
+        cmd = [os.fsdecode(arg) if isinstance(arg, (bytes, os.PathLike)) else str(arg)
+               for arg in args]
+
+        self.trace_record = {
+            'tool': os.path.basename(cmd[0]) if cmd else '',
+            'cmd': cmd,
+            'pid': self.pid,
+            'parent_pid': os.getpid(),
+            'start': self._trace_start,
+            'end': time.time(),
+            'wall_time': round(time.perf_counter() - self._trace_wall_start, 6),
+            'returncode': _get_returncode(status),
+            'user_time': round(rusage.ru_utime, 6),
+            'sys_time': round(rusage.ru_stime, 6),
+            'max_rss': max_rss,
+            'input_bytes': self._trace_input_bytes,
+            'output_bytes': None
+        }
+
+    def write_trace(self, stdout_bytes=0):
+        if self._outputs_counted:
+            return
+
+        self._outputs_counted = True
+
+        output_bytes = _get_files_size(self.trace_outputs) + stdout_bytes
+        _add_output_bytes(output_bytes)
+
+        if self.trace_record is None:
+            return
+
+        self.trace_record['output_bytes'] = output_bytes
+
+        write_trace_record(self.trace_record, trace_file=self.trace_file)
+        self.trace_record = None
+
+
+def run(args, inputs=(), outputs=(), input=None, timeout=None, check=False, **kwargs):
+    """Traced version of `subprocess.run`.
+
+    The size of the captured stdout is added to `output_bytes`.
+    """
+    if input is not None:
+        kwargs['stdin'] = sp.PIPE
+
+    with TracedPopen(args, inputs=inputs, outputs=outputs, **kwargs) as process:
+        process.defer_trace = True
+
+        try:
+            stdout, stderr = process.communicate(input, timeout=timeout)
+        except BaseException:
+            process.kill()
+            process.wait()
+            process.write_trace()
+            raise
+
+        returncode = process.poll()
+
+    process.write_trace(
+        stdout_bytes=_get_stdout_size(
+            stdout,
+            encoding=kwargs.get('encoding'),
+            errors=kwargs.get('errors')
+        )
+    )
+
+    if check and returncode:
+        raise sp.CalledProcessError(
+            returncode,
+            process.args,
+            output=stdout,
+            stderr=stderr
+        )
+
+    return sp.CompletedProcess(process.args, returncode, stdout, stderr)
+
+
+def call(args, inputs=(), outputs=(), timeout=None, **kwargs):
+    """Traced version of `subprocess.call`."""
+    return run(args, inputs=inputs, outputs=outputs, timeout=timeout, **kwargs).returncode
@@ -1,4 +1,5 @@
-import os.path
+import os
+import sys
 
 
 def add_prefix(filename, prefix, auto_dot=False):
@@ -12,3 +13,40 @@ def add_prefix(filename, prefix, auto_dot=False):
         filename = prefix + filename
 
     return filename
+
+
+def get_memory_usage():
+    """Return the current and the peak RSS of this process in bytes.
+
+    Either value is None if it is not available on this platform.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        rss = None
+
+    try:
+        import resource
+    except ImportError:
+        peak_rss = None
+    else:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        if sys.platform != 'darwin':
+            peak_rss *= 1024
+
+    return rss, peak_rss
+
+
+def format_size(num_bytes):
+    if num_bytes is None:
+        return 'N/A'
+
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if num_bytes < 1024:
+            return '{:.1f} {}'.format(num_bytes, unit)
+        num_bytes /= 1024
+
+    return '{:.1f} TB'.format(num_bytes)
@@ -33,15 +33,17 @@ setup(
         'click>=7.0',
         'sqlalchemy>=1.3.8',
         'numpy>=1.17.2',
-        'pandas>=0.25.1',
+        'pandas>=1.5',
         'openpyxl',
         'networkx>=2.4',
         'lxml>=4.5.0',
         'scipy>=1.7.3',
-        'statsmodels>=0.13.1',
         'requests',
         'tqdm'
     ],
+    extras_require={
+        'arrow': ['pyarrow>=8.0.0']
+    },
     entry_points={
         'console_scripts': [
             'circmimi_tools = circmimi.scripts.circmimi_tools:cli',
@@ -0,0 +1,103 @@
+from bisect import bisect
+
+import numpy as np
+import pandas as pd
+
+from circmimi.bed import Bed
+from circmimi.rbp import RBPBindingSites
+
+
+def shrink_site_to_region(r, s, offset=0):
+    bisect_result = bisect(r, s)
+
+    if bisect_result == 0:
+        s_in_r = r.start + offset - 1
+    elif bisect_result == 1:
+        s_in_r = s
+    elif bisect_result == 2:
+        s_in_r = r.end + offset
+
+    return s_in_r
+
+
+def get_real_overlap(bed_line):
+    # the row-wise calculation of the earlier versions
+    if bed_line['blockCount'] == 1:
+        return bed_line['overlap']
+
+    bed_start = bed_line['start'] + 1
+    blocks = [
+        Bed._region(bed_start + int(start), bed_start + int(start) + int(size) - 1)
+        for start, size in zip(
+            bed_line['blockStarts'].split(','),
+            bed_line['blockSizes'].split(',')
+        )
+    ]
+    rbp_block = Bed._region(bed_line['start_rbp'] + 1, bed_line['end_rbp'])
+
+    overlap = 0
+    for b in blocks:
+        start_in_b = shrink_site_to_region(b, rbp_block.start, offset=1)
+        end_in_b = shrink_site_to_region(b, rbp_block.end)
+        overlap += end_in_b - start_in_b + 1
+
+    return overlap
+
+
+def get_random_intersections(num_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+
+    for _ in range(num_rows):
+        start = int(rng.integers(0, 1000))
+        block_count = int(rng.integers(1, 5))
+        block_sizes = rng.integers(1, 30, size=block_count)
+        gaps = rng.integers(1, 30, size=block_count)
+        block_starts = np.concatenate([[0], np.cumsum(block_sizes + gaps)[:-1]])
+        end = start + int(block_starts[-1] + block_sizes[-1])
+
+        start_rbp = int(rng.integers(start - 10, end))
+        end_rbp = int(rng.integers(max(start_rbp, start) + 1, end + 10))
+
+        rows.append({
+            'start': start,
+            'end': end,
+            'blockCount': block_count,
+            'blockSizes': ','.join(map(str, block_sizes)),
+            'blockStarts': ','.join(map(str, block_starts)),
+            'start_rbp': start_rbp,
+            'end_rbp': end_rbp,
+            'overlap': min(end, end_rbp) - max(start, start_rbp)
+        })
+
+    return pd.DataFrame(rows)
+
+
+def test_real_overlap_is_the_same_as_the_row_wise_calculation():
+    df = get_random_intersections(5000)
+
+    res_df = RBPBindingSites._append_real_overlap(df)
+
+    assert res_df['real_overlap'].tolist() == df.apply(get_real_overlap, axis=1).tolist()
+    assert res_df['total_blocks_len'].tolist() == [
+        sum(map(int, sizes.split(','))) for sizes in df['blockSizes']
+    ]
+
+
+def test_site_starting_on_the_last_base_of_a_block():
+    df = pd.DataFrame(
+        {
+            'start': [100, 100],
+            'end': [130, 130],
+            'blockCount': [2, 2],
+            'blockSizes': ['10,10', '10,10'],
+            'blockStarts': ['0,20', '0,20'],
+            'start_rbp': [109, 108],
+            'end_rbp': [125, 125],
+            'overlap': [16, 17]
+        }
+    )
+
+    res_df = RBPBindingSites._append_real_overlap(df)
+
+    assert res_df['real_overlap'].tolist() == [5, 7]
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from circmimi.output import get_category_df
+from circmimi.schema import Schema
+
+
+EXAMPLE_FILE = os.path.join(
+    os.path.dirname(__file__),
+    '..',
+    'examples',
+    'circRNAs.gencode_format.all_interactions.miRNA.head_20.tsv'
+)
+
+
+def test_flag_strings_to_int8():
+    df = pd.DataFrame(
+        {
+            'miRTarBase': ['1', '0', '1'],
+            'miRDB': pd.Categorical(['0', '0', '1']),
+            'ENCORI': ['1', '0', np.nan],
+            'cross_boundary': ['0', '1', '2']
+        }
+    )
+
+    dtypes = Schema.get_dtypes(df)
+
+    assert dtypes == {'miRTarBase': np.int8, 'miRDB': np.int8}
+    assert df.pipe(Schema.apply)['miRDB'].tolist() == [0, 0, 1]
+
+
+def test_example_result_table():
+    object_df = pd.read_csv(EXAMPLE_FILE, sep='\t', dtype='object')
+    default_df = pd.read_csv(EXAMPLE_FILE, sep='\t')
+    schema_df = default_df.pipe(Schema.apply)
+
+    for col in ('miRTarBase', 'miRDB', 'ENCORI', 'cross_boundary'):
+        assert schema_df[col].dtype == np.int8
+
+    # the converted columns keep their values
+    for col in Schema.get_dtypes(default_df):
+        assert schema_df[col].astype(str).tolist() == object_df[col].tolist()
+
+    assert Schema.get_memory_usage(schema_df) < Schema.get_memory_usage(object_df)
+
+    pd.testing.assert_frame_equal(
+        get_category_df(schema_df, to_binary=True),
+        get_category_df(
+            object_df.astype({'num_AGO_supported_binding_sites': int}),
+            to_binary=True
+        )
+    )
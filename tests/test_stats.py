@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import hypergeom
+
+from circmimi.stats import (
+    MiRNATargetBackground,
+    _calc_hypergeom_pvalues,
+    do_the_hypergeometric_test
+)
+
+
+def calc_hypergeom_pvalue(k, M, n, N):
+    # the per-row calculation of the earlier versions
+    return hypergeom(M, n, N).pmf(np.arange(k, min(n, N))).sum()
+
+
+def get_random_k_M_n_N(size, seed=0):
+    rng = np.random.default_rng(seed)
+
+    M = rng.integers(1, 3000, size=size)
+    n = (rng.random(size) * (M + 1)).astype(np.int64)
+    N = (rng.random(size) * (M + 1)).astype(np.int64)
+    k = (rng.random(size) * (np.minimum(n, N) + 2)).astype(np.int64)
+
+    return k, M, n, N
+
+
+def assert_same_pvalues(k, M, n, N):
+    pvalues = _calc_hypergeom_pvalues(k, M, n, N)
+    expected = np.array([
+        calc_hypergeom_pvalue(*k_M_n_N)
+        for k_M_n_N in zip(k, M, n, N)
+    ])
+
+    np.testing.assert_allclose(pvalues, expected, rtol=1e-12, atol=1e-300)
+    np.testing.assert_array_equal(pvalues == 0, expected == 0)
+
+
+def test_hypergeom_pvalues():
+    assert_same_pvalues(*get_random_k_M_n_N(1000))
+
+
+def test_hypergeom_pvalues_of_no_shared_miRNAs():
+    k, M, n, N = get_random_k_M_n_N(300, seed=1)
+
+    assert_same_pvalues(np.zeros_like(k), M, n, N)
+
+
+def test_hypergeom_pvalues_of_more_targeting_than_circRNA_miRNAs():
+    k, M, n, N = get_random_k_M_n_N(300, seed=2)
+    n, N = np.maximum(n, N), np.minimum(n, N)
+    k = np.minimum(k, N)
+
+    assert (n > N).any()
+    assert_same_pvalues(k, M, n, N)
+
+
+def test_hypergeom_pvalues_of_edges():
+    k = np.array([0, 0, 0, 3, 5, 5, 2, 0])
+    M = np.array([10, 10, 10, 10, 10, 10, 10, 1])
+    n = np.array([0, 4, 10, 8, 5, 9, 6, 1])
+    N = np.array([5, 0, 3, 3, 7, 5, 2, 1])
+
+    assert_same_pvalues(k, M, n, N)
+
+
+def test_num_miRNAs_of_target_genes_not_in_the_background():
+    background = MiRNATargetBackground(10, np.array(['GENE2', 'GENE4']), np.array([3, 4]))
+
+    np.testing.assert_array_equal(
+        background.get_num_miRNAs__target_gene(np.array(['GENE1', 'GENE2', 'GENE3', 'GENE4', 'GENE5'])),
+        [np.nan, 3, np.nan, 4, np.nan]
+    )
+    np.testing.assert_array_equal(
+        background.get_num_miRNAs__target_gene(np.array(['GENE4', 'GENE2'])),
+        [4, 3]
+    )
+
+
+def test_pvalues_of_target_genes_not_in_the_background():
+    background = MiRNATargetBackground(10, np.array(['GENE1', 'GENE3']), np.array([3, 4]))
+    circ_mir_target_df = pd.DataFrame(
+        {
+            'circ_id': ['circ1', 'circ1', 'circ1', 'circ1', 'circ2', 'circ2'],
+            'mirna': ['miR-1', 'miR-2', 'miR-1', 'miR-3', 'miR-1', 'miR-2'],
+            'target_gene': ['GENE1', 'GENE1', 'GENE2', 'GENE3', 'GENE1', 'GENE4']
+        }
+    )
+
+    res_df = do_the_hypergeometric_test(
+        circ_mir_target_df,
+        None,
+        None,
+        background=background
+    ).set_index(['circ_id', 'target_gene'])
+
+    missing = [('circ1', 'GENE2'), ('circ2', 'GENE4')]
+    assert res_df.loc[missing, ['p_value', 'bh_corrected_p_value']].isna().all(axis=None)
+    assert res_df.loc[missing, '#miRNAs_target_gene'].isna().all()
+
+    # the other pairs are corrected as if the missing ones were not tested
+    counted_df = res_df.drop(missing)
+    assert counted_df['p_value'].notna().all()
+    assert counted_df.loc[('circ2', 'GENE1'), 'bonferroni_corrected_p_values'] == \
+        counted_df.loc[('circ2', 'GENE1'), 'p_value']
@@ -0,0 +1,80 @@
+import pandas as pd
+import pytest
+
+from circmimi.circmimi import Circmimi
+from circmimi.output import InteractionJoiner, SQLiteInteractionJoiner
+
+
+SUMMARY_COLUMNS = [
+    '#circRNA_miRNA',
+    '#circRNA_mRNA',
+    '#circRNA_miRNA_mRNA',
+    '#category_1',
+    '#category_2',
+    '#category_3'
+]
+
+
+def get_tables(num_hits):
+    circ_mirna_df = pd.DataFrame(
+        {
+            'ev_id': [0, 0, 1][:num_hits],
+            'circ_id': ['chr1:100|200(+)', 'chr1:100|200(+)', 'chr2:100|300(-)'][:num_hits],
+            'mirna': ['hsa-miR-1', 'hsa-miR-2', 'hsa-miR-1'][:num_hits],
+            'num_AGO_supported_binding_sites': [1, 0, 0][:num_hits]
+        }
+    ).astype({'ev_id': 'int', 'circ_id': 'object', 'mirna': 'object'})
+    mir_target_db = pd.DataFrame(
+        {
+            'mirna': ['hsa-miR-1', 'hsa-miR-1', 'hsa-miR-2'],
+            'target_gene': ['GENE1', 'GENE2', 'GENE1'],
+            'miRTarBase': ['1', '0', '0'],
+            'ENCORI': ['0', '0', '1']
+        }
+    )
+    circ_target_df_with_pv = pd.DataFrame(
+        {
+            'circ_id': ['chr1:100|200(+)', 'chr1:100|200(+)', 'chr2:100|300(-)', 'chr2:100|300(-)'],
+            'target_gene': ['GENE1', 'GENE2', 'GENE1', 'GENE2'],
+            'p_value': [0.01, 0.01, 0.01, 0.01],
+            'bh_corrected_p_value': [0.01, 0.01, 0.01, 0.01],
+            'bonferroni_corrected_p_values': [0.01, 0.01, 0.01, 0.01]
+        }
+    )
+
+    if num_hits == 0:
+        circ_target_df_with_pv = circ_target_df_with_pv.iloc[:0]
+
+    return circ_mirna_df, mir_target_db, circ_target_df_with_pv
+
+
+@pytest.fixture(params=['pandas', 'sqlite'])
+def get_joiner(request, tmp_path):
+    def _get_joiner(num_hits):
+        tables = get_tables(num_hits)
+
+        if request.param == 'sqlite':
+            joiner = SQLiteInteractionJoiner(*tables, chunk_size=1, work_dir=tmp_path)
+        else:
+            joiner = InteractionJoiner(*tables, chunk_size=1)
+
+        request.addfinalizer(joiner.close)
+
+        return joiner
+
+    return _get_joiner
+
+
+def test_streamed_summary_counts_without_hits(get_joiner):
+    summary_counts = Circmimi._get_streamed_summary_counts(get_joiner(0))
+
+    assert summary_counts.empty
+    assert list(summary_counts.columns) == SUMMARY_COLUMNS
+
+
+def test_streamed_summary_counts(get_joiner):
+    summary_counts = Circmimi._get_streamed_summary_counts(get_joiner(3))
+
+    assert summary_counts.loc[0, '#circRNA_miRNA_mRNA'] == 3
+    assert summary_counts.loc[1, '#circRNA_miRNA_mRNA'] == 2
+    assert summary_counts['#category_1'].tolist() == [1, 0]